@@ -1,4 +1,14 @@
+from collections import OrderedDict
+
+from django.core.paginator import InvalidPage
+from django.http import StreamingHttpResponse
 from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from api.renderers import StreamingJSONRenderer
+from core.paginators import KeysetPaginator
 
 
 class LargeTablePageNumberPagination(pagination.PageNumberPagination):
@@ -6,3 +16,123 @@ class LargeTablePageNumberPagination(pagination.PageNumberPagination):
     max_page_size = 10000
     page_size = 1000
     page_size_query_param = 'page_size'
+
+
+class LargeTableKeysetPagination(LargeTablePageNumberPagination):
+    """Keyset (seek) pagination with opaque `next`/`previous` cursors
+
+    Requests having the `page` query parameter keep using page numbers (with
+    `OFFSET`), so old links still work - their count may also be an estimate
+    (see `DynamicModelQuerySet.count`), so they never need a full `COUNT(*)`.
+    """
+
+    cursor_query_param = 'cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.queryset = queryset
+        self.keyset = self.page_query_param not in request.query_params
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view=view)
+
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        self.request = request
+        self.count = queryset.count()
+        paginator = KeysetPaginator(queryset, page_size)
+        cursor = request.query_params.get(self.cursor_query_param)
+        try:
+            self.page = paginator.get_page(cursor or None)
+        except ValueError:
+            raise NotFound('Invalid cursor.')
+        return list(self.page)
+
+    def paginate_queryset_lazily(self, queryset, request, view=None):
+        """Same as `paginate_queryset` but return a lazy iterator of rows
+
+        Rows are fetched using a server-side cursor while they're consumed
+        (see `get_streaming_response`).
+        """
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        self.queryset = queryset
+        self.request = request
+        self.keyset = self.page_query_param not in request.query_params
+        if self.keyset:
+            self.count = queryset.count()
+            paginator = KeysetPaginator(queryset, page_size)
+            cursor = request.query_params.get(self.cursor_query_param)
+            try:
+                self.page = paginator.stream_page(cursor or None)
+            except ValueError:
+                raise NotFound('Invalid cursor.')
+            return iter(self.page)
+
+        paginator = self.django_paginator_class(queryset, page_size)
+        page_number = request.query_params.get(self.page_query_param, 1)
+        if page_number in self.last_page_strings:
+            page_number = paginator.num_pages
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            raise NotFound(self.invalid_page_message.format(
+                page_number=page_number, message=str(exc)
+            ))
+        return self.page.object_list.iterator()
+
+    def get_page_head(self):
+        if self.keyset:
+            count = self.count
+        else:
+            count = self.page.paginator.count
+        return OrderedDict([
+            ('count', count),
+            ('count_is_estimate', getattr(self.queryset, 'count_is_estimate', False)),
+        ])
+
+    def get_page_links(self):
+        """Return the links (only available after the rows are consumed)"""
+        return OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+        ])
+
+    def get_streaming_response(self, rows):
+        """Stream the paginated response for (already serialized) `rows`
+
+        The links are written after the results, since the keyset cursors
+        depend on the rows read.
+        """
+        renderer = StreamingJSONRenderer()
+        return StreamingHttpResponse(
+            renderer.render_stream(self.get_page_head(), 'results', rows,
+                                   self.get_page_links),
+            content_type=renderer.media_type,
+        )
+
+    def _cursor_link(self, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super().get_next_link()
+        return self._cursor_link(self.page.next_cursor)
+
+    def get_previous_link(self):
+        if not self.keyset:
+            return super().get_previous_link()
+        return self._cursor_link(self.page.previous_cursor)
+
+    def get_paginated_response(self, data):
+        response_data = self.get_page_head()
+        response_data['next'] = self.get_next_link()
+        response_data['previous'] = self.get_previous_link()
+        response_data['results'] = data
+        return Response(response_data)
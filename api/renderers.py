@@ -0,0 +1,132 @@
+import json
+from collections import OrderedDict
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from api.serializers import pyarrow
+
+
+class StreamingJSONRenderer(JSONRenderer):
+    """Render a JSON object having a (possibly huge) list incrementally
+
+    Used by views returning a `StreamingHttpResponse`: list items are
+    rendered in batches while they're consumed, so the whole list is never
+    in memory. Uses the same JSON options as `JSONRenderer`.
+    """
+
+    batch_size = 1000
+
+    def _render_object_body(self, data):
+        # Render an object without its braces
+        return self.render(data)[1:-1] if data else b''
+
+    def render_stream(self, head, key, items, tail=None):
+        """Yield the JSON for `{**head, key: list(items), **tail()}`
+
+        `tail` is a callable, evaluated only after all items are rendered
+        (for values which depend on them).
+        """
+        body = self._render_object_body(head)
+        yield b'{' + body + (b',' if body else b'') + self.render(key) + b':['
+
+        batch, first_batch = [], True
+        for item in items:
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                yield (b'' if first_batch else b',') + self.render(batch)[1:-1]
+                batch, first_batch = [], False
+        if batch:
+            yield (b'' if first_batch else b',') + self.render(batch)[1:-1]
+
+        body = self._render_object_body(tail() if tail is not None else None)
+        yield b']' + (b',' if body else b'') + body + b'}'
+
+
+class ColumnarJSONRenderer(JSONRenderer):
+    """Render a page of rows as one list of values per field
+
+    The field names are not repeated on each row, making the response
+    smaller and faster to decode. Responses which are not pages (like
+    errors) are rendered as regular JSON.
+    """
+
+    format = 'columnar'
+
+    def render_columns(self, head, fields, rows, tail):
+        """Return the JSON for a page, with `fields` as `(name, type)`"""
+        columns = OrderedDict((name, []) for name, _ in fields)
+        appenders = [(name, columns[name].append) for name, _ in fields]
+        for row in rows:
+            for name, append in appenders:
+                append(row[name])
+
+        data = OrderedDict(head)
+        data['fields'] = [OrderedDict([('name', name), ('type', type_)])
+                          for name, type_ in fields]
+        data['columns'] = columns
+        data.update(tail())
+        return self.render(data)
+
+
+class ArrowRenderer(BaseRenderer):
+    """Render a page of rows as an Apache Arrow IPC stream
+
+    Rows are converted to record batches while they're read, but the stream
+    is written only after the whole page is read (and kept in memory, as
+    Arrow arrays): the page information (`count`, `next` etc.) is
+    JSON-encoded in the schema metadata, which comes first in the stream and
+    needs all rows to be known. Responses which are not pages (like errors)
+    are rendered as JSON. Needs `pyarrow` (see `ArrowRenderer.available`).
+    """
+
+    media_type = 'application/vnd.apache.arrow.stream'
+    format = 'arrow'
+    charset = None
+    render_style = 'binary'
+    batch_size = 10000
+    available = pyarrow is not None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return JSONRenderer().render(data)
+
+    def render_batches(self, schema, converters, head, rows, tail):
+        """Return the IPC stream bytes for a page of `rows` (in memory)
+
+        `converters` are `(name, function)` pairs, in `schema` order, used
+        to convert non-null values before they go to Arrow.
+        """
+        batches = []
+        columns = [[] for _ in converters]
+        appenders = [(name, convert, column.append)
+                     for (name, convert), column in zip(converters, columns)]
+
+        def flush():
+            arrays = [pyarrow.array(column, type=field.type)
+                      for column, field in zip(columns, schema)]
+            batches.append(arrays)
+            for column in columns:
+                column.clear()
+
+        length = 0
+        for row in rows:
+            for name, convert, append in appenders:
+                value = row[name]
+                append(convert(value) if value is not None else None)
+            length += 1
+            if length == self.batch_size:
+                flush()
+                length = 0
+        if length or not batches:
+            flush()
+
+        info = OrderedDict(head)
+        info.update(tail())
+        schema = schema.with_metadata({key: json.dumps(value)
+                                       for key, value in info.items()})
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, schema) as writer:
+            for arrays in batches:
+                writer.write_batch(
+                    pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+                )
+        return sink.getvalue().to_pybytes()
@@ -1,7 +1,17 @@
+import base64
+import json
+
 from rest_framework import serializers
 from rest_framework.reverse import reverse
 
 from core.models import Dataset, Field, Link, Table
+from core.templatetags.utils import obfuscate
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # Optional, used only by the Arrow data format
+    pyarrow = None
 
 
 class LinkSerializer(serializers.ModelSerializer):
@@ -72,8 +82,122 @@ class DatasetDetailSerializer(serializers.ModelSerializer):
         )
 
 
-class GenericSerializer(serializers.ModelSerializer):
+class TableRowSerializer(serializers.BaseSerializer):
+    """Serialize rows from `values()` querysets of a dynamic table
+
+    Does not use model instances nor serializer fields: each value is
+    converted by a function chosen once per table (see `make_row_serializer`),
+    giving the same output as a `ModelSerializer`.
+    """
 
-    class Meta:
-        model = None
-        fields = '__all__'
+    converters = ()
+
+    @classmethod
+    def project(cls, fieldnames):
+        """Return a subclass serializing only `fieldnames` (in this order)"""
+        converters = dict(cls.converters)
+        return type(cls.__name__, (cls, ), {
+            'converters': tuple((name, converters[name]) for name in fieldnames),
+        })
+
+    def to_representation(self, row):
+        return {
+            name: convert(row[name]) if row[name] is not None else None
+            for name, convert in self.converters
+        }
+
+
+def _identity(value):
+    return value
+
+
+def _binary_to_string(value):
+    return base64.b64encode(value).decode('ascii')
+
+
+def _date_to_string(value):
+    return value.isoformat()
+
+
+def _make_converter(field, Model):
+    model_field = Model._meta.get_field(field.name)
+    if field.type == 'binary':
+        convert = _binary_to_string
+    elif field.type == 'date':
+        convert = _date_to_string
+    elif field.type == 'datetime':
+        convert = serializers.DateTimeField().to_representation
+    elif field.type == 'decimal':
+        convert = serializers.DecimalField(
+            max_digits=model_field.max_digits,
+            decimal_places=model_field.decimal_places,
+        ).to_representation
+    else:
+        convert = _identity
+
+    if field.obfuscate:
+        return lambda value: convert(obfuscate(value))
+    return convert
+
+
+def visible_fields(fields):
+    """Return the fields shown by the data API (sorted by name)"""
+    return sorted((field for field in fields
+                   if field.name != 'search_data' and field.show),
+                  key=lambda field: field.name)
+
+
+def make_row_serializer(fields, Model):
+    """Create a `TableRowSerializer` subclass for the visible `fields`"""
+    fields = visible_fields(fields)
+    return type(
+        Model.__name__ + 'RowSerializer',
+        (TableRowSerializer, ),
+        {'converters': tuple((field.name, _make_converter(field, Model))
+                             for field in fields)},
+    )
+
+
+def _arrow_type(field, Model):
+    if field.type == 'decimal':
+        model_field = Model._meta.get_field(field.name)
+        return pyarrow.decimal128(model_field.max_digits,
+                                  model_field.decimal_places)
+    return {
+        'binary': pyarrow.binary(),
+        'bool': pyarrow.bool_(),
+        'date': pyarrow.date32(),
+        'datetime': pyarrow.timestamp('us', tz='UTC'),
+        'float': pyarrow.float64(),
+        'integer': pyarrow.int32(),
+    }.get(field.type, pyarrow.string())
+
+
+def _arrow_converter(field):
+    if field.type == 'binary':
+        convert = bytes
+    elif field.type == 'json':
+        convert = json.dumps
+    else:
+        convert = _identity
+
+    if field.obfuscate:
+        return lambda value: convert(obfuscate(value))
+    return convert
+
+
+def make_arrow_schema(fields, Model):
+    """Return the Arrow schema and value converters for the visible `fields`
+
+    Raises `RuntimeError` if `pyarrow` is not installed.
+    """
+    if pyarrow is None:
+        raise RuntimeError('pyarrow is needed for the Arrow data format')
+    fields = visible_fields(fields)
+    schema = pyarrow.schema([
+        pyarrow.field(field.name, _arrow_type(field, Model), nullable=True)
+        for field in fields
+    ])
+    converters = tuple((field.name, _arrow_converter(field))
+                       for field in fields)
+    return schema, converters
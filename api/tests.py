@@ -1,3 +1,43 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+from rest_framework.test import APIRequestFactory
+
+from api.renderers import ArrowRenderer
+from api.views import DatasetDataListView, data_cache_vary, dataset_data
+
+
+class ArrowFormatTests(SimpleTestCase):
+
+    @mock.patch.object(ArrowRenderer, 'available', False)
+    def test_not_acceptable_without_pyarrow(self):
+        factory = APIRequestFactory()
+        requests = [
+            factory.get('/api/dataset/a/b/data', {'format': 'arrow'}),
+            factory.get('/api/dataset/a/b/data',
+                        HTTP_ACCEPT=ArrowRenderer.media_type),
+        ]
+        for request in requests:
+            response = dataset_data(request, slug='a', tablename='b')
+            response.render()
+            assert response.status_code == 406
+            assert response['Content-Type'] == 'application/json'
+            assert b'pyarrow' in response.content
+
+
+class DataCacheTests(SimpleTestCase):
+
+    def test_key_has_the_negotiated_format(self):
+        factory = APIRequestFactory()
+        view = DatasetDataListView(format_kwarg=None)
+        keys = set()
+        # e.g. `warm_cache` (no header), curl and JSON clients
+        for accept in (None, '*/*', 'application/json'):
+            headers = {'HTTP_ACCEPT': accept} if accept else {}
+            request = view.initialize_request(
+                factory.get('/api/dataset/a/b/data', **headers)
+            )
+            request.accepted_renderer, _ = \
+                view.perform_content_negotiation(request)
+            keys.add(data_cache_vary(request))
+        assert keys == {('json', 'testserver')}
@@ -0,0 +1,12 @@
+from django.core.cache import caches
+from rest_framework.throttling import ScopedRateThrottle
+
+
+class SharedScopedRateThrottle(ScopedRateThrottle):
+    """Rate limit per user (or IP address) counted by all worker processes
+
+    The default cache is local to each process, so the file-based responses
+    cache (shared by all workers) is used instead.
+    """
+
+    cache = caches['responses']
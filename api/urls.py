@@ -9,6 +9,10 @@ urlpatterns = [
     path('datasets', views.dataset_list, name='dataset-list'),
     path('dataset/<slug>', views.dataset_detail, name='dataset-detail'),
     path('dataset/<slug>/<tablename>/data', views.dataset_data, name='dataset-table-data'),
+    path('dataset/<slug>/<tablename>/facets/<fieldname>', views.dataset_facets, name='dataset-table-facets'),
+    path('dataset/<slug>/<tablename>/exports', views.dataset_export, name='dataset-table-export'),
+    path('exports/<int:pk>', views.export_detail, name='export-detail'),
+    path('exports/<int:pk>/download', views.export_download, name='export-download'),
     path('especiais/grafo/sociedades', graph_views.GetResourceNetworkView.as_view(), name='resource-graph'),
     path('especiais/grafo/sociedades/caminhos', graph_views.GetPartnershipPathsView.as_view(), name='partnership-paths'),
     path('especiais/grafo/sociedades/subsequentes', graph_views.GetCompanySubsequentPartnershipsGraphView.as_view(), name='subsequent-partnerships'),
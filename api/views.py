@@ -1,29 +1,109 @@
-from collections import Sequence
+import os
+from django.http import Http404, HttpResponse
+from django.db.models import Max
 from django.shortcuts import get_object_or_404
-from rest_framework import serializers, viewsets
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from rest_framework import serializers, status, viewsets
+from rest_framework.exceptions import NotAcceptable, ValidationError
 from rest_framework.generics import ListAPIView
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.reverse import reverse
+from rest_framework.settings import api_settings
 
-from core.models import Dataset, Table, Link
-from core.templatetags.utils import obfuscate
+from core.metadata import get_dataset_or_404, get_metadata, get_table_or_404
+from core.models import (FACETS_LIMIT, PAGINATION_KEYS, ExportJob, Table,
+                         normalize_querystring)
+from core.cache import cache_table_response
+from core.views import serve_file, table_etag, table_last_modified
+from api.renderers import ArrowRenderer, ColumnarJSONRenderer
+from api.throttling import SharedScopedRateThrottle
 from api.serializers import (DatasetDetailSerializer,
                              DatasetSerializer,
-                             GenericSerializer)
+                             make_arrow_schema,
+                             make_row_serializer,
+                             pyarrow,
+                             visible_fields)
 
+from utils.http import make_etag
+from utils.registry import Registry
 from . import paginators
 
 
+def _datasets_tables(slug=None):
+    tables = Table.objects.all()
+    if slug is None:
+        tables = tables.filter(dataset__show=True)
+    else:
+        tables = tables.for_dataset(slug)
+    return tables
+
+
+def datasets_etag(request, slug=None):
+    """ETag for datasets' metadata
+
+    Changes when any of their tables is imported or has its cache invalidated.
+    """
+    if not hasattr(request, '_datasets_tables_state'):
+        request._datasets_tables_state = list(
+            _datasets_tables(slug).order_by('id')
+                                  .values_list('id', 'import_date',
+                                               'cache_generation')
+        )
+    return make_etag(
+        slug,
+        request._datasets_tables_state,
+        normalize_querystring(request.GET, ignore=()),
+        request.META.get('HTTP_ACCEPT'),
+        request.get_host(),
+    )
+
+
+def datasets_last_modified(request, slug=None):
+    return _datasets_tables(slug).aggregate(Max('import_date'))['import_date__max']
+
+
+def data_cache_vary(request):
+    # Responses change with the negotiated format (not the raw `Accept`
+    # header, which varies a lot between clients) and with the host (links)
+    return (request.accepted_renderer.format, request.get_host())
+
+
+def data_etag(request, slug, tablename, **kwargs):
+    return table_etag(request, slug, tablename, *data_cache_vary(request))
+
+
+def data_last_modified(request, slug, tablename, **kwargs):
+    return table_last_modified(request, slug, tablename)
+
+
+datasets_condition = method_decorator(
+    condition(etag_func=datasets_etag, last_modified_func=datasets_last_modified)
+)
+data_condition = method_decorator(
+    condition(etag_func=data_etag, last_modified_func=data_last_modified)
+)
+data_cache = method_decorator(
+    cache_table_response('api-data', vary=data_cache_vary)
+)
+
+
 class DatasetViewSet(viewsets.ModelViewSet):
 
     serializer_class = DatasetSerializer
 
     def get_queryset(self):
-        return Dataset.objects.filter(show=True)
+        return get_metadata().visible_datasets()
 
+    @datasets_condition
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @datasets_condition
     def retrieve(self, request, slug):
-        queryset = Dataset.objects.all()  # TODO: use self.get_queryset()
-        obj = get_object_or_404(queryset, slug=slug)
+        obj = get_dataset_or_404(slug)  # TODO: use self.get_queryset()
         serializer = DatasetDetailSerializer(
             obj,
             context=self.get_serializer_context(),
@@ -31,56 +111,282 @@ class DatasetViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
 
+# Metadata needed to serve each table's data, by table id (see
+# `get_table_metadata`)
+TABLE_METADATA_CACHE = Registry()
+
+
+class TableMetadata:
+    """Model, fields and serializers of a table (shared, must not change)"""
+
+    def __init__(self, table):
+        self.table = table
+        self.import_date = table.import_date
+        self.cache_generation = table.cache_generation
+        self.Model = table.get_model()
+        self.fields = tuple(table.fields)
+        self.serializer_class = make_row_serializer(self.fields, self.Model)
+        self.fieldnames = tuple(name for name, _ in
+                                self.serializer_class.converters)
+        self.field_types = tuple((field.name, field.type)
+                                 for field in visible_fields(self.fields))
+        # `(schema, converters)` for the Arrow format
+        self.arrow_schema = None
+        if pyarrow is not None:
+            self.arrow_schema = make_arrow_schema(self.fields, self.Model)
+
+
+def get_table_metadata(slug, tablename):
+    """Return the (cached) `TableMetadata` for a dataset's table
+
+    Only the table id, import date and cache generation are queried for each
+    call; the cached metadata is rebuilt if the table was imported again or
+    its cache was invalidated (e.g. metadata changed with `update_data`).
+    """
+    table_id, import_date, cache_generation = get_object_or_404(
+        Table.objects.for_dataset(slug).filter(name=tablename)
+                     .values_list('id', 'import_date', 'cache_generation'),
+    )
+
+    def build():
+        table = get_table_or_404(slug, tablename)
+        if table.import_date != import_date or \
+                table.cache_generation != cache_generation:
+            # The metadata snapshot is not up to date yet
+            table = Table.objects.select_related('dataset').get(id=table_id)
+        return TableMetadata(table)
+
+    return TABLE_METADATA_CACHE.get(table_id, (import_date, cache_generation),
+                                    build)
+
+
 class DatasetDataListView(ListAPIView):
 
-    pagination_class = paginators.LargeTablePageNumberPagination
+    pagination_class = paginators.LargeTableKeysetPagination
+    renderer_classes = (
+        list(api_settings.DEFAULT_RENDERER_CLASSES) +
+        [ColumnarJSONRenderer, ArrowRenderer]
+    )
 
-    def get_table(self):
-        dataset = get_object_or_404(Dataset, slug=self.kwargs['slug'])
-        return get_object_or_404(Table, dataset=dataset, name=self.kwargs['tablename'])
+    fields_query_param = 'fields'
 
-    def get_model_class(self):
-        return self.get_table().get_model()
+    def perform_content_negotiation(self, request, force=False):
+        renderer, media_type = super().perform_content_negotiation(request,
+                                                                   force)
+        if isinstance(renderer, ArrowRenderer) and not renderer.available:
+            if force:  # Rendering an error: use the default renderer
+                renderer = self.get_renderers()[0]
+                return renderer, renderer.media_type
+            raise NotAcceptable(
+                'The Arrow format is not available (pyarrow is not installed).'
+            )
+        return renderer, media_type
+
+    @property
+    def metadata(self):
+        if not hasattr(self, '_metadata'):
+            self._metadata = get_table_metadata(self.kwargs['slug'],
+                                                self.kwargs['tablename'])
+        return self._metadata
+
+    def get_fieldnames(self):
+        """Return the field names requested in `?fields=a,b,c` (or all)
+
+        Raises `ValidationError` if any of them is not shown by the API.
+        """
+        if not hasattr(self, '_fieldnames'):
+            value = self.request.query_params.get(self.fields_query_param, '')
+            fieldnames = []
+            for fieldname in value.split(','):
+                fieldname = fieldname.strip()
+                if fieldname and fieldname not in fieldnames:
+                    fieldnames.append(fieldname)
+            invalid = [fieldname for fieldname in fieldnames
+                       if fieldname not in self.metadata.fieldnames]
+            if invalid:
+                raise ValidationError({
+                    self.fields_query_param: 'Invalid field(s): {}.'.format(
+                        ', '.join(invalid)
+                    ),
+                })
+            self._fieldnames = fieldnames or self.metadata.fieldnames
+        return self._fieldnames
 
     def get_queryset(self):
         querystring = self.request.query_params.copy()
-        for pagination_key in ('limit', 'offset'):
-            if pagination_key in querystring:
-                del querystring[pagination_key]
-
-        Model = self.get_model_class()
-        queryset = Model.objects.filter_by_querystring(querystring)
+        for key in ('limit', 'offset', self.fields_query_param):
+            if key in querystring:
+                del querystring[key]
 
-        return queryset
+        queryset = self.metadata.Model.objects.filter_by_querystring(querystring)
+        # Only the requested fields are selected, plus the ordering fields
+        # (keyset pagination needs them on each row)
+        fieldnames = self.get_fieldnames()
+        fieldnames = list(fieldnames) + [
+            fieldname.lstrip('-')
+            for fieldname in queryset.keyset_ordering()
+            if fieldname.lstrip('-') not in fieldnames
+        ]
+        return queryset.values(*fieldnames)
 
     def get_serializer_class(self):
-        table = self.get_table()
-        Model = table.get_model()
-        fields = sorted([field.name
-                         for field in table.fields
-                         if field.name != 'search_data' and field.show])
-
-        # TODO: move this monkey patch to a metaclass
-        GenericSerializer.Meta.model = Model
-        GenericSerializer.Meta.fields = fields
-        return GenericSerializer
-
-    def get_serializer(self, *args, **kwargs):
-        Model = self.get_model_class()  # TODO: avoid to call it twice
-        obfuscate_fields = [field.name
-                            for field in self.get_table().fields
-                            if field.obfuscate and field.show]
-        if obfuscate_fields:
-            objects = args[0]
-            if not isinstance(objects, Sequence):
-                objects = [objects]
-            for obj in objects:
-                for field_name in obfuscate_fields:
-                    value = obfuscate(getattr(obj, field_name))
-                    setattr(obj, field_name, value)
-
-        return super().get_serializer(*args, **kwargs)
+        serializer_class = self.metadata.serializer_class
+        fieldnames = self.get_fieldnames()
+        if fieldnames is not self.metadata.fieldnames:
+            serializer_class = serializer_class.project(fieldnames)
+        return serializer_class
+
+    @data_condition
+    @data_cache
+    def list(self, request, *args, **kwargs):
+        # Rows are read from a server-side cursor and are not kept in memory
+        # (JSON is streamed; columnar and Arrow keep only their columns)
+        renderer = request.accepted_renderer
+        if not isinstance(renderer, (JSONRenderer, ArrowRenderer)):
+            return super().list(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        rows = self.paginator.paginate_queryset_lazily(queryset, request,
+                                                       view=self)
+        if rows is None:
+            return super().list(request, *args, **kwargs)
+
+        fieldnames = self.get_fieldnames()
+        if isinstance(renderer, ArrowRenderer):
+            schema, converters = self.metadata.arrow_schema
+            if fieldnames is not self.metadata.fieldnames:
+                converters = dict(converters)
+                converters = [(name, converters[name]) for name in fieldnames]
+                schema = pyarrow.schema([schema.field(name)
+                                         for name in fieldnames])
+            content = renderer.render_batches(
+                schema, converters, self.paginator.get_page_head(), rows,
+                self.paginator.get_page_links,
+            )
+            return HttpResponse(content, content_type=renderer.media_type)
+
+        serialize = self.get_serializer().to_representation
+        rows = (serialize(row) for row in rows)
+        if isinstance(renderer, ColumnarJSONRenderer):
+            field_types = dict(self.metadata.field_types)
+            content = renderer.render_columns(
+                self.paginator.get_page_head(),
+                [(name, field_types[name]) for name in fieldnames],
+                rows, self.paginator.get_page_links,
+            )
+            return HttpResponse(content, content_type=renderer.media_type)
+        return self.paginator.get_streaming_response(rows)
+
+
+class DatasetFacetsView(APIView):
+    max_limit = 1000
+
+    @data_condition
+    def get(self, request, slug, tablename, fieldname):
+        table = get_table_or_404(slug, tablename)
+        for field in table.fields:
+            if field.name == fieldname and field.has_choices and \
+                    field.frontend_filter:
+                break
+        else:
+            raise Http404('Field does not exist.')
+        querystring = request.query_params.copy()
+        prefix = querystring.pop('prefix', [''])[0]
+        limit = querystring.pop('limit', [str(FACETS_LIMIT)])[0]
+        try:
+            limit = min(int(limit), self.max_limit)
+        except ValueError:
+            raise ValidationError({'limit': 'Invalid limit.'})
+
+        facets = table.get_facets(field.name, querystring, limit=limit,
+                                  prefix=prefix or None)
+        return Response({
+            'field': field.name,
+            'results': [{'value': value, 'count': count}
+                        for value, count in facets],
+        })
+
+
+def serialize_export_job(job, request):
+    data = {
+        'id': job.id,
+        'dataset': job.table.dataset.slug,
+        'table': job.table.name,
+        'querystring': job.querystring,
+        'status': job.status,
+        'created_at': job.created_at,
+        'finished_at': job.finished_at,
+        'url': reverse('api:export-detail', kwargs={'pk': job.id},
+                       request=request),
+        'download_url': None,
+    }
+    if job.status == ExportJob.STATUS_FINISHED:
+        data['size'] = job.size
+        data['download_url'] = reverse('api:export-download',
+                                       kwargs={'pk': job.id}, request=request)
+    elif job.status == ExportJob.STATUS_FAILED:
+        data['error'] = job.error
+    return data
+
+
+class DatasetExportView(APIView):
+    """Submit a background export of the filtered table (as gzipped CSV)
+
+    The same filters as the data API are accepted in the querystring. Equal
+    requests (for the same table version) share the same job. Submissions
+    are limited by the `exports` throttle rate.
+    """
+    throttle_classes = [SharedScopedRateThrottle]
+    throttle_scope = 'exports'
+
+    def post(self, request, slug, tablename):
+        table = get_table_or_404(slug, tablename)
+        querystring = request.query_params.copy()
+        for key in PAGINATION_KEYS:
+            querystring.pop(key, None)
+
+        job = ExportJob.objects.submit(table, querystring)
+        if job.status == ExportJob.STATUS_FINISHED:
+            response_status = status.HTTP_200_OK
+        else:
+            response_status = status.HTTP_202_ACCEPTED
+        return Response(serialize_export_job(job, request),
+                        status=response_status)
+
+
+class ExportJobView(APIView):
+
+    def get(self, request, pk):
+        job = get_object_or_404(
+            ExportJob.objects.select_related('table', 'table__dataset'),
+            pk=pk,
+        )
+        return Response(serialize_export_job(job, request))
+
+
+def export_download(request, pk):
+    job = get_object_or_404(
+        ExportJob.objects.select_related('table', 'table__dataset'),
+        pk=pk,
+        status=ExportJob.STATUS_FINISHED,
+    )
+    if job.cache_generation != job.table.cache_generation or \
+            job.import_date != job.table.import_date:
+        # Data or metadata changed (e.g. a field is obfuscated now)
+        raise Http404('Export is outdated, please request it again.')
+    try:
+        stat = os.stat(job.path)
+    except FileNotFoundError:
+        raise Http404('Export file not found.')
+    etag = f'"export-{job.id}-{int(stat.st_mtime)}-{stat.st_size}"'
+    download_name = f'{job.table.dataset.slug}-{job.table.name}-{job.id}.csv.gz'
+    return serve_file(request, job.path, 'application/gzip', download_name,
+                      etag)
+
 
 dataset_list = DatasetViewSet.as_view({'get': 'list'})
 dataset_detail = DatasetViewSet.as_view({'get': 'retrieve'}, lookup_field='slug')
 dataset_data = DatasetDataListView.as_view()
+dataset_facets = DatasetFacetsView.as_view()
+dataset_export = DatasetExportView.as_view()
+export_detail = ExportJobView.as_view()
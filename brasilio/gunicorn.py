@@ -0,0 +1,27 @@
+"""gunicorn settings (see Procfile)
+
+With `PRELOAD_MODELS=true` the application, metadata and all dynamic models
+are loaded by the master process before forking the workers: they boot
+instantly and share this memory (copy-on-write). The garbage collector is
+disabled in the master and objects are frozen before each fork, so
+collections in the workers don't write to (and copy) the shared pages
+(`gc.freeze` needs Python 3.7+; on older versions only the preload is done).
+"""
+import gc
+
+import environ
+
+
+env = environ.Env()
+environ.Env.read_env('.env')
+
+preload_app = env('PRELOAD_MODELS', bool, default=False)
+
+if preload_app and hasattr(gc, 'freeze'):
+    gc.disable()
+
+    def pre_fork(server, worker):
+        gc.freeze()
+
+    def post_fork(server, worker):
+        gc.enable()
@@ -11,6 +11,9 @@ env = environ.Env(DEBUG=(bool, False))
 environ.Env.read_env('.env')
 
 ALLOWED_HOSTS = env('ALLOWED_HOSTS', default='').split(',')
+# Public host name of the site, used by `warm_cache` in its requests (cached
+# responses vary on the host, so they must use the one the site is served on)
+SITE_HOST = env('SITE_HOST', default='')
 BASE_DIR = root()
 DEBUG = env('DEBUG')
 PRODUCTION = env('PRODUCTION', bool)
@@ -123,10 +126,49 @@ STATICFILES_DIRS = [
 
 # Data-related settings
 DATA_URL = env('DATA_URL')
+# Querysets estimated (by the planner) to have fewer rows than this are
+# counted with `COUNT(*)`; bigger ones use the estimate
+EXACT_COUNT_THRESHOLD = env('EXACT_COUNT_THRESHOLD', int, default=100000)
+# Create all dynamic models (and load metadata) when the WSGI application is
+# loaded - use with gunicorn's `preload_app` (see `brasilio/gunicorn.py`)
+PRELOAD_MODELS = env('PRELOAD_MODELS', bool, default=False)
+# Rows of each section stored in document profiles and shown in document
+# pages (see `core.document_profile`)
+DOCUMENT_PROFILE_ROWS = env('DOCUMENT_PROFILE_ROWS', int, default=100)
+# Document page sections are queried at the same time by a pool of threads
+# (per process); sections slower than the timeout (in seconds) are shown as
+# unavailable
+DOCUMENT_SECTION_WORKERS = env('DOCUMENT_SECTION_WORKERS', int, default=16)
+DOCUMENT_SECTION_TIMEOUT = env('DOCUMENT_SECTION_TIMEOUT', float, default=5)
+# Running export jobs are considered failed (and can be submitted again)
+# after this many seconds; finished exports are deleted after this many days
+# or when their table is imported again (see `export_worker`)
+EXPORT_JOB_TIMEOUT = env('EXPORT_JOB_TIMEOUT', int, default=6 * 3600)
+EXPORT_MAX_AGE = env('EXPORT_MAX_AGE', int, default=7)
+
+# Rendered dynamic-table pages are shared by all workers in a file-based
+# cache (see `core.cache`)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': env('RESPONSE_CACHE_DIR', default='/tmp/brasilio-responses'),
+        'TIMEOUT': env('RESPONSE_CACHE_TIMEOUT', int, default=24 * 3600),
+        'OPTIONS': {
+            'MAX_ENTRIES': env('RESPONSE_CACHE_MAX_ENTRIES', int, default=10000),
+        },
+    },
+}
 
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
     'PAGE_SIZE': 100,
+    'DEFAULT_THROTTLE_RATES': {
+        # Export jobs submitted per user (or IP address, if anonymous)
+        'exports': env('EXPORT_THROTTLE_RATE', default='10/hour'),
+    },
 }
 
 CORS_ORIGIN_ALLOW_ALL = True
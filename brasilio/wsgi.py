@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/2.0/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "brasilio.settings")
 
 application = get_wsgi_application()
+
+if settings.PRELOAD_MODELS:
+    # Runs in gunicorn's master process when `preload_app` is set
+    from core.metadata import preload
+    preload()
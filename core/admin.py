@@ -1,26 +1,64 @@
 from django.contrib import admin
 
 from core import models
+from core.metadata import metadata_changed
 
 
-class DatasetAdmin(admin.ModelAdmin):
-    pass
+class MetadataAdmin(admin.ModelAdmin):
+    """Admin for metadata models: changes are seen by all processes
+
+    The cache generation of the affected tables is incremented, so their
+    dynamic models, table metadata and cached responses are built again.
+    `table_lookup` is `(Table lookup, object attribute)` used to find them.
+    """
+    table_lookup = ('dataset_id', 'dataset_id')
+
+    def affected_tables(self, objs):
+        lookup, attribute = self.table_lookup
+        values = {getattr(obj, attribute) for obj in objs}
+        # Listed before deletions (which may cascade to the tables)
+        return list(models.Table.objects.filter(**{lookup + '__in': values})
+                                        .values_list('id', flat=True))
+
+    def changed(self, table_ids):
+        models.Table.objects.filter(id__in=table_ids).invalidate_cache()
+        metadata_changed()
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        self.changed(self.affected_tables([obj]))
+
+    def delete_model(self, request, obj):
+        table_ids = self.affected_tables([obj])
+        super().delete_model(request, obj)
+        self.changed(table_ids)
+
+    def delete_queryset(self, request, queryset):
+        table_ids = self.affected_tables(queryset)
+        super().delete_queryset(request, queryset)
+        self.changed(table_ids)
+
+
+class DatasetAdmin(MetadataAdmin):
+    table_lookup = ('dataset_id', 'id')
 admin.site.register(models.Dataset, DatasetAdmin)
 
 
-class LinkAdmin(admin.ModelAdmin):
+class LinkAdmin(MetadataAdmin):
     pass
 admin.site.register(models.Link, LinkAdmin)
 
 
-class VersionAdmin(admin.ModelAdmin):
+class VersionAdmin(MetadataAdmin):
+    table_lookup = ('version_id', 'id')
 
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('dataset')
 admin.site.register(models.Version, VersionAdmin)
 
 
-class TableAdmin(admin.ModelAdmin):
+class TableAdmin(MetadataAdmin):
+    table_lookup = ('id', 'id')
 
     def get_queryset(self, request):
         return super().get_queryset(request)\
@@ -28,9 +66,20 @@ class TableAdmin(admin.ModelAdmin):
 admin.site.register(models.Table, TableAdmin)
 
 
-class FieldAdmin(admin.ModelAdmin):
+class FieldAdmin(MetadataAdmin):
+    table_lookup = ('id', 'table_id')
 
     def get_queryset(self, request):
         return super().get_queryset(request)\
                       .select_related('dataset', 'version', 'table')
 admin.site.register(models.Field, FieldAdmin)
+
+
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('table', 'querystring', 'status', 'created_at', 'finished_at')
+    list_filter = ('status',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request)\
+                      .select_related('table', 'table__dataset', 'table__version')
+admin.site.register(models.ExportJob, ExportJobAdmin)
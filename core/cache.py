@@ -0,0 +1,162 @@
+import atexit
+import hashlib
+import threading
+import time
+from functools import wraps
+
+from django.core.cache import caches
+from django.db import DatabaseError
+from django.http import HttpResponse, StreamingHttpResponse
+
+from core.models import ResponseCacheStats, Table, normalize_querystring
+
+
+RESPONSE_CACHE_ALIAS = 'responses'
+RESPONSE_CACHE_MAX_SIZE = 2 * 1024 * 1024
+# Incremented when the format of the cached values changes
+RESPONSE_CACHE_VERSION = 2
+# Headers set by views which are stored with the content (and replayed)
+RESPONSE_CACHE_HEADERS = ('Allow', 'Content-Disposition', 'Vary')
+# Hit/miss counters are kept per process and added to the database at most
+# once in this many seconds (and when the process exits)
+STATS_FLUSH_INTERVAL = 60
+
+
+def table_import_state(request, slug, tablename):
+    """Return `(id, import date, cache generation)` of a table (or `None`)
+
+    Only the metadata table is queried (once per request), so conditional
+    and cached requests can be answered without touching the dynamic table.
+    """
+    if not hasattr(request, '_table_import_state'):
+        request._table_import_state = Table.objects.for_dataset(slug)\
+                                                   .filter(name=tablename)\
+                                                   .values_list('id', 'import_date', 'cache_generation')\
+                                                   .first()
+    return request._table_import_state
+
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'flushed_at': time.monotonic()}
+
+
+def flush_stats():
+    """Add this process' counters to `ResponseCacheStats`
+
+    Counters which could not be stored are lost (they're approximate).
+    """
+    with _stats_lock:
+        hits, misses = _stats['hits'], _stats['misses']
+        _stats.update(hits=0, misses=0, flushed_at=time.monotonic())
+    if hits or misses:
+        try:
+            ResponseCacheStats.add(hits, misses)
+        except DatabaseError:
+            pass
+
+
+atexit.register(flush_stats)
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+        flush = time.monotonic() - _stats['flushed_at'] >= STATS_FLUSH_INTERVAL
+    if flush:
+        flush_stats()
+
+
+def get_stats():
+    flush_stats()
+    return ResponseCacheStats.current()
+
+
+def reset_stats():
+    flush_stats()
+    ResponseCacheStats.reset()
+
+
+def _cached_headers(response):
+    return {name: response[name] for name in RESPONSE_CACHE_HEADERS
+            if response.has_header(name)}
+
+
+def _store_streaming_content(cache, key, content_type, headers, chunks):
+    # Yield the chunks, storing the content if it's not too big
+    content, size = [], 0
+    for chunk in chunks:
+        if content is not None:
+            size += len(chunk)
+            if size > RESPONSE_CACHE_MAX_SIZE:
+                content = None
+            else:
+                content.append(chunk)
+        yield chunk
+    if content is not None:
+        cache.set(key, (content_type, b''.join(content), headers),
+                  version=RESPONSE_CACHE_VERSION)
+
+
+def cache_table_response(kind, vary=None):
+    """Cache the successful GET responses of a view for a dataset's table
+
+    The view must receive `slug` and `tablename` as keyword arguments. The
+    cache key has the table id, its import date and cache generation (so an
+    import or `Table.invalidate_cache` invalidates it) and the normalized
+    querystring. `vary(request)` may return more values for the key or
+    `None` if the request must not be cached. Responses which are not
+    rendered yet (like DRF's `Response`) and the ones bigger than
+    `RESPONSE_CACHE_MAX_SIZE` are not cached. The content is stored with
+    `RESPONSE_CACHE_HEADERS`. The `X-Cache` header tells if the response
+    came from the cache.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            slug, tablename = kwargs.get('slug'), kwargs.get('tablename')
+            if request.method != 'GET' or not slug or not tablename:
+                return view(request, *args, **kwargs)
+            extra = vary(request) if vary is not None else ()
+            state = table_import_state(request, slug, tablename)
+            if extra is None or state is None:
+                return view(request, *args, **kwargs)
+
+            table_id, import_date, generation = state
+            querystring = normalize_querystring(request.GET, ignore=())
+            key = hashlib.sha1(
+                repr((querystring, tuple(extra))).encode('utf-8')
+            ).hexdigest()
+            import_date = import_date.timestamp() if import_date else ''
+            key = f'response:{kind}:{table_id}:{generation}:{import_date}:{key}'
+            cache = caches[RESPONSE_CACHE_ALIAS]
+            cached = cache.get(key, version=RESPONSE_CACHE_VERSION)
+            if cached is not None:
+                _count('hits')
+                content_type, content, headers = cached
+                response = HttpResponse(content, content_type=content_type)
+                for name, value in headers.items():
+                    response[name] = value
+                response['X-Cache'] = 'HIT'
+                return response
+
+            _count('misses')
+            response = view(request, *args, **kwargs)
+            response['X-Cache'] = 'MISS'
+            if response.status_code != 200 or \
+                    not getattr(response, 'is_rendered', True):
+                return response
+            content_type = response['Content-Type']
+            headers = _cached_headers(response)
+            if isinstance(response, StreamingHttpResponse):
+                response.streaming_content = _store_streaming_content(
+                    cache, key, content_type, headers,
+                    response.streaming_content,
+                )
+            elif len(response.content) <= RESPONSE_CACHE_MAX_SIZE:
+                cache.set(key, (content_type, response.content, headers),
+                          version=RESPONSE_CACHE_VERSION)
+            return response
+
+        return wrapper
+
+    return decorator
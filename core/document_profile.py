@@ -0,0 +1,516 @@
+import json
+from collections import defaultdict
+from decimal import Decimal
+from textwrap import dedent
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from core.metadata import get_metadata
+from core.models import (SHADOW_TABLE_SUFFIX, DocumentProfileSection,
+                         NormalizeName, Unaccent, normalized_fieldname)
+from core.paginators import KeysetPaginator
+from core.util import get_company_by_document
+
+
+# Tables used by the document page - each precomputed section is stale after
+# the documents or its own table are imported again
+TABLES = (
+    'documentos-brasil:documents',
+    'eleicoes-brasil:candidatos',
+    'eleicoes-brasil:filiados',
+    'gastos-deputados:cota_parlamentar',
+    'gastos-diretos:gastos',
+    'socios-brasil:socios',
+    'socios-brasil:empresas',
+    'socios-brasil:holdings',
+)
+
+
+def get_datasets():
+    metadata = get_metadata()
+    datasets = defaultdict(dict)
+    for slug in TABLES:
+        dataset_slug, tablename = slug.split(':')
+        datasets[dataset_slug][tablename] = \
+            metadata.get_table(dataset_slug, tablename)
+
+    return datasets
+
+
+def profile_key(document):
+    """CNPJ root for companies, the CPF itself for people"""
+    return document[:8] if len(document) == 14 else document
+
+
+def is_headquarter(document):
+    return document[:12].endswith('0001')
+
+
+# Sections of the page of each kind of document
+COMPANY_SECTIONS = ('branches', 'partners', 'companies', 'camara_spending',
+                    'federal_spending')
+PERSON_SECTIONS = ('companies', 'applications', 'filiations',
+                   'camara_spending', 'federal_spending')
+
+
+def section_names(document):
+    return COMPANY_SECTIONS if len(document) == 14 else PERSON_SECTIONS
+
+
+def _fieldnames(table, queryset):
+    """All table fields plus the ones needed for keyset pagination"""
+    fieldnames = [field.name for field in table.fields]
+    for fieldname in queryset.keyset_ordering():
+        if fieldname.lstrip('-') not in fieldnames:
+            fieldnames.append(fieldname.lstrip('-'))
+    return fieldnames
+
+
+class Section:
+    """The first rows and the total row count of a document page section
+
+    Rows are dicts with all the table's fields plus the ones needed for
+    keyset pagination (see `_fieldnames`).
+    """
+
+    def __init__(self, table, rows, count):
+        self.table = table
+        self.rows = rows
+        self.count = count
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    @property
+    def is_truncated(self):
+        return self.count > len(self.rows)
+
+    @classmethod
+    def from_json(cls, table, rows, count):
+        """Return the section for rows read as JSON text from a profile table
+
+        Numbers are decoded as `Decimal`s (so decimals keep their digits) and
+        dates and datetimes are converted back from strings.
+        """
+        converters = {
+            field.name: field.to_python
+            for field in table.get_model()._meta.fields
+            if isinstance(field, (models.DateField, models.DecimalField,
+                                  models.FloatField))
+        }
+        rows = [
+            {name: converters[name](value)
+                   if name in converters and value is not None else value
+             for name, value in row.items()}
+            for row in json.loads(rows, parse_float=Decimal)
+        ]
+        return cls(table, rows, count)
+
+
+def document_data(obj):
+    """Return the data of `obj` (a `Documents` row) used by its page"""
+    return {
+        'document': obj.document,
+        'document_type': obj.document_type,
+        'name': obj.name,
+    }
+
+
+def get_company_state(document):
+    Empresas = get_datasets()['socios-brasil']['empresas'].get_model()
+    state = Empresas.objects.filter(cnpj=document)\
+                            .values_list('uf', flat=True)\
+                            .first()
+    return state or ''
+
+
+def section_queries(obj):
+    """Return `{name: (table, queryset)}` for the sections of `obj`'s page
+
+    `obj` is the document data (see `document_data`). Querysets are lazy,
+    so only the ones used run queries.
+    """
+    datasets = get_datasets()
+    documents_table = datasets['documentos-brasil']['documents']
+    applications_table = datasets['eleicoes-brasil']['candidatos']
+    filiations_table = datasets['eleicoes-brasil']['filiados']
+    camara_spending_table = datasets['gastos-deputados']['cota_parlamentar']
+    federal_spending_table = datasets['gastos-diretos']['gastos']
+    partners_table = datasets['socios-brasil']['socios']
+    holdings_table = datasets['socios-brasil']['holdings']
+    Candidatos = applications_table.get_model()
+    Documents = documents_table.get_model()
+    FiliadosPartidos = filiations_table.get_model()
+    GastosDeputados = camara_spending_table.get_model()
+    GastosDiretos = federal_spending_table.get_model()
+    Holdings = holdings_table.get_model()
+    Socios = partners_table.get_model()
+
+    document = obj['document']
+    queries = {}
+    if len(document) == 14:
+        branches = Documents.objects.filter(
+            docroot=document[:8],
+            document_type='CNPJ',
+        )
+        branches_cnpjs = branches.order_by().values('document')
+
+        queries['branches'] = (
+            documents_table,
+            branches.order_by('document'),
+        )
+        queries['partners'] = (
+            partners_table,
+            Socios.objects.filter(cnpj__in=branches_cnpjs)
+                          .order_by('nome_socio'),
+        )
+        queries['companies'] = (
+            holdings_table,
+            Holdings.objects.filter(cnpj_socia__in=branches_cnpjs)
+                            .order_by('razao_social'),
+        )
+        # all appearances of the company's documents
+        queries['camara_spending'] = (
+            camara_spending_table,
+            GastosDeputados.objects.filter(txtcnpjcpf__in=branches_cnpjs)
+                                   .order_by('-datemissao'),
+        )
+        queries['federal_spending'] = (
+            federal_spending_table,
+            GastosDiretos.objects.filter(codigo_favorecido__in=branches_cnpjs)
+                                 .order_by('-data_pagamento'),
+        )
+
+    else:
+        name = obj['name']
+        # DISTINCT ON expressions must start the ORDER BY clause
+        queries['companies'] = (
+            partners_table,
+            Socios.objects.filter_name('nome_socio', name)
+                          .distinct('razao_social', 'cnpj')
+                          .order_by('razao_social', 'cnpj'),
+        )
+        queries['applications'] = (
+            applications_table,
+            Candidatos.objects.filter(cpf_candidato=document),
+        )
+        queries['filiations'] = (
+            filiations_table,
+            FiliadosPartidos.objects.filter_name('nome_do_filiado', name),
+        )
+
+        # all appearances of 'obj.document'
+        queries['camara_spending'] = (
+            camara_spending_table,
+            GastosDeputados.objects.filter(txtcnpjcpf=document)
+                                   .order_by('-datemissao'),
+        )
+        queries['federal_spending'] = (
+            federal_spending_table,
+            GastosDiretos.objects.filter(codigo_favorecido=document)
+                                 .order_by('-data_pagamento'),
+        )
+
+    return queries
+
+
+def profile_tablename(name):
+    return f'document_profile__{name}'
+
+
+def profile_sections():
+    """Return `{name: (table, queryset, match, documents)}` for all sections
+
+    Sections are precomputed for all documents of a kind at once (see
+    `build_section`): the rows of `queryset` (ordered as in
+    `section_queries`) belong to the `documents` (a `values` queryset with
+    `profile_key` and `profile_match`) having `profile_match` equal to the
+    `match` expression.
+    """
+    datasets = get_datasets()
+    documents_table = datasets['documentos-brasil']['documents']
+    applications_table = datasets['eleicoes-brasil']['candidatos']
+    filiations_table = datasets['eleicoes-brasil']['filiados']
+    camara_spending_table = datasets['gastos-deputados']['cota_parlamentar']
+    federal_spending_table = datasets['gastos-diretos']['gastos']
+    partners_table = datasets['socios-brasil']['socios']
+    holdings_table = datasets['socios-brasil']['holdings']
+    Candidatos = applications_table.get_model()
+    Documents = documents_table.get_model()
+    FiliadosPartidos = filiations_table.get_model()
+    GastosDeputados = camara_spending_table.get_model()
+    GastosDiretos = federal_spending_table.get_model()
+    Holdings = holdings_table.get_model()
+    Socios = partners_table.get_model()
+
+    def documents(document_type, key, match):
+        return Documents.objects.filter(document_type=document_type)\
+                                .annotate(profile_key=F(key),
+                                          profile_match=match)\
+                                .order_by()\
+                                .values('profile_key', 'profile_match')
+
+    def name_match(Model, fieldname):
+        """`(match, documents)` for rows with a person's name (as compared by
+        `filter_name`)"""
+        if fieldname in Model.extra['names']:
+            return (F(normalized_fieldname(fieldname)),
+                    documents('CPF', 'document', NormalizeName(F('name'))))
+        return F(fieldname), documents('CPF', 'document', Unaccent(F('name')))
+
+    # Company pages show the rows of all branches (CNPJ root is the key)
+    branches = documents('CNPJ', 'docroot', F('document'))
+    # People are matched by their CPF or their name
+    people = documents('CPF', 'document', F('document'))
+    return {
+        'company_branches': (
+            documents_table,
+            Documents.objects.filter(document_type='CNPJ')
+                             .order_by('document'),
+            F('document'), branches,
+        ),
+        'company_partners': (
+            partners_table, Socios.objects.order_by('nome_socio'),
+            F('cnpj'), branches,
+        ),
+        'company_companies': (
+            holdings_table, Holdings.objects.order_by('razao_social'),
+            F('cnpj_socia'), branches,
+        ),
+        'company_camara_spending': (
+            camara_spending_table,
+            GastosDeputados.objects.order_by('-datemissao'),
+            F('txtcnpjcpf'), branches,
+        ),
+        'company_federal_spending': (
+            federal_spending_table,
+            GastosDiretos.objects.order_by('-data_pagamento'),
+            F('codigo_favorecido'), branches,
+        ),
+        'person_companies': (
+            partners_table,
+            Socios.objects.distinct('razao_social', 'cnpj')
+                          .order_by('razao_social', 'cnpj'),
+            *name_match(Socios, 'nome_socio'),
+        ),
+        'person_applications': (
+            applications_table, Candidatos.objects.all(),
+            F('cpf_candidato'), people,
+        ),
+        'person_filiations': (
+            filiations_table, FiliadosPartidos.objects.all(),
+            *name_match(FiliadosPartidos, 'nome_do_filiado'),
+        ),
+        'person_camara_spending': (
+            camara_spending_table,
+            GastosDeputados.objects.order_by('-datemissao'),
+            F('txtcnpjcpf'), people,
+        ),
+        'person_federal_spending': (
+            federal_spending_table,
+            GastosDiretos.objects.order_by('-data_pagamento'),
+            F('codigo_favorecido'), people,
+        ),
+    }
+
+
+def profile_section_name(section, document):
+    kind = 'company' if len(document) == 14 else 'person'
+    return f'{kind}_{section}'
+
+
+def section_import_dates(table):
+    """Import dates of the tables a section is built from (documents and
+    `table`), as stored in `DocumentProfileSection.import_dates`"""
+    documents_table = get_datasets()['documentos-brasil']['documents']
+    return {
+        f'{source.dataset.slug}:{source.name}':
+            source.import_date.isoformat() if source.import_date else None
+        for source in (documents_table, table)
+    }
+
+
+def section_sql(table, queryset, match, documents, target, limit):
+    """Return `(sql, params)` to fill `target` with a profile section
+
+    Rows are matched to all documents in one query: `ROW_NUMBER()` keeps the
+    first `limit` rows of each key (in the section's ordering) and the
+    `GROUP BY` counts all of them. Keys without rows are not stored.
+    """
+    quote_name = connection.ops.quote_name
+    source = queryset.model.objects.annotate(profile_match=match)\
+                                   .order_by()\
+                                   .values(*_fieldnames(table, queryset),
+                                           'profile_match')
+    source_sql, source_params = source.query.sql_with_params()
+    documents_sql, documents_params = documents.query.sql_with_params()
+    ordering = ', '.join(
+        quote_name(fieldname.lstrip('-')) +
+        (' DESC' if fieldname.startswith('-') else '')
+        for fieldname in queryset.keyset_ordering()
+    )
+    distinct, distinct_ordering = '', ''
+    if queryset.query.distinct_fields:
+        # Distinct rows per document
+        columns = ', '.join(f'source.{quote_name(fieldname)}'
+                            for fieldname in queryset.query.distinct_fields)
+        distinct = f'DISTINCT ON (documents.profile_key, {columns})'
+        distinct_ordering = f'ORDER BY documents.profile_key, {columns}'
+    sql = dedent(f'''
+        INSERT INTO {target} (key, count, rows)
+        SELECT
+            profile_key,
+            COUNT(*),
+            JSONB_AGG(row ORDER BY position) FILTER (WHERE position <= %s)
+        FROM (
+            SELECT
+                profile_key,
+                TO_JSONB(matched) - 'profile_key' - 'profile_match' AS row,
+                ROW_NUMBER() OVER (
+                    PARTITION BY profile_key ORDER BY {ordering}
+                ) AS position
+            FROM (
+                SELECT {distinct} documents.profile_key, source.*
+                FROM ({source_sql}) AS source
+                INNER JOIN ({documents_sql}) AS documents
+                    ON source.profile_match = documents.profile_match
+                {distinct_ordering}
+            ) AS matched
+        ) AS ranked
+        GROUP BY profile_key
+    ''').strip()
+    return sql, [limit, *source_params, *documents_params]
+
+
+def build_section(name, limit=None):
+    """Precompute section `name` (see `profile_sections`) for all documents
+
+    The side table is filled by one query with another name and then
+    replaces the current one in a transaction, together with the import
+    dates of its source tables (read before the query, so imports while it
+    runs make the section stale).
+    """
+    limit = limit or settings.DOCUMENT_PROFILE_ROWS
+    table, queryset, match, documents = profile_sections()[name]
+    import_dates = section_import_dates(table)
+    profile_table = profile_tablename(name)
+    new_table = profile_table + SHADOW_TABLE_SUFFIX
+    sql, params = section_sql(table, queryset, match, documents, new_table,
+                              limit)
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {new_table}')
+        cursor.execute(dedent(f'''
+            CREATE TABLE {new_table} (
+                key VARCHAR(14) NOT NULL,
+                count BIGINT NOT NULL,
+                rows JSONB NOT NULL
+            )
+        ''').strip())
+        cursor.execute(sql, params)
+        cursor.execute(f'CREATE UNIQUE INDEX {new_table}_key '
+                       f'ON {new_table} (key)')
+        cursor.execute(f'ANALYZE {new_table}')
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {profile_table}')
+        cursor.execute(f'ALTER TABLE {new_table} RENAME TO {profile_table}')
+        cursor.execute(f'ALTER INDEX {new_table}_key '
+                       f'RENAME TO {profile_table}_key')
+        DocumentProfileSection.objects.update_or_create(
+            name=name,
+            defaults={'import_dates': import_dates,
+                      'built_at': timezone.now()},
+        )
+
+
+def stale_sections():
+    """Names of the sections never built or built before the last import of
+    some of their tables"""
+    sections = profile_sections()
+    built = dict(DocumentProfileSection.objects.values_list('name',
+                                                            'import_dates'))
+    return [name for name, (table, *_) in sections.items()
+            if built.get(name) != section_import_dates(table)]
+
+
+def get_stored_section(name, document, table):
+    """Return the precomputed `Section` `name` (of `table`) of `document`'s
+    page
+
+    Returns `None` if the section was not built or is stale (its rows must be
+    queried).
+    """
+    profile_name = profile_section_name(name, document)
+    import_dates = DocumentProfileSection.objects\
+        .filter(name=profile_name)\
+        .values_list('import_dates', flat=True)\
+        .first()
+    if import_dates is None or import_dates != section_import_dates(table):
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT count, rows::text FROM {profile_tablename(profile_name)} '
+            f'WHERE key = %s',
+            [profile_key(document)],
+        )
+        row = cursor.fetchone()
+    if row is None:  # The document has no rows in this section
+        return Section(table, [], 0)
+    count, rows = row
+    return Section.from_json(table, rows, count)
+
+
+def get_stored_page(name, obj, per_page=None):
+    """Return `(page, count)` for the first page of section `name` of `obj`'s
+    page, read from the precomputed section
+
+    Returns `None` if the section is stale or has no fields needed for
+    pagination (it must be queried with `get_section_page`).
+    """
+    per_page = per_page or settings.DOCUMENT_PROFILE_ROWS
+    table, queryset = section_queries(obj)[name]
+    paginator = KeysetPaginator(queryset, per_page)
+    section = get_stored_section(name, obj['document'], table)
+    if section is None:
+        return None
+    rows = section.rows[:per_page]
+    if not all(fieldname in row
+               for row in rows[:1] for fieldname in paginator.ordering):
+        return None
+    return paginator.first_page(rows, section.count > len(rows)), section.count
+
+
+def get_section_page(name, obj, cursor=None, per_page=None):
+    """Return a page of section `name` of `obj`'s page
+
+    The page is a `KeysetPage` of row dicts (`per_page` rows, default:
+    `settings.DOCUMENT_PROFILE_ROWS`). Raises `ValueError` if the cursor is
+    invalid.
+    """
+    per_page = per_page or settings.DOCUMENT_PROFILE_ROWS
+    table, queryset = section_queries(obj)[name]
+    queryset = queryset.values(*_fieldnames(table, queryset))
+    return KeysetPaginator(queryset, per_page).get_page(cursor)
+
+
+def count_section(name, obj):
+    """Return the number of rows of section `name` of `obj`'s page"""
+    _, queryset = section_queries(obj)[name]
+    return queryset.count()
+
+
+def get_document(document):
+    """Return the `Documents` row whose page is built for `document`
+
+    For companies it's the headquarter (or some branch, if there's no
+    headquarter). Raises `Documents.DoesNotExist` if not found.
+    """
+    if len(document) == 14:
+        return get_company_by_document(document)
+
+    Documents = get_datasets()['documentos-brasil']['documents'].get_model()
+    return Documents.objects.get(document=document)
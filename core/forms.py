@@ -4,7 +4,7 @@ from django import forms
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.utils.translation import ugettext_lazy as _
 
-from core.models import Dataset
+from core.metadata import get_metadata
 from core.util import get_company_by_document
 
 
@@ -21,10 +21,9 @@ def _resolve_field_by_type(person_type):
 
 def _get_obj(field, identifier, person_type):
     if person_type == 'pessoa-fisica':
-        Socios = Dataset.objects.get(slug='socios-brasil')\
-                                .get_table('socios')\
-                                .get_model()
-        return Socios.objects.filter(**{field: identifier}).first()
+        Socios = get_metadata().get_table('socios-brasil', 'socios')\
+                               .get_model()
+        return Socios.objects.filter_name(field, identifier).first()
     elif person_type == 'pessoa-juridica':
         try:
             return get_company_by_document(numbers_only(identifier))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from core import cache
+
+
+class Command(BaseCommand):
+    help = 'Show hit/miss counters of the shared response cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', required=False, action='store_true',
+                            help='Reset the counters after showing them')
+
+    def handle(self, *args, **kwargs):
+        stats = cache.get_stats()
+        total = stats['hits'] + stats['misses']
+        ratio = stats['hits'] / total if total else 0
+        print('Response cache: {} hits, {} misses ({:.1%} hit ratio).'
+              .format(stats['hits'], stats['misses'], ratio))
+        if kwargs['reset']:
+            cache.reset_stats()
+            print('Counters reset.')
@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from core.models import ExportJob
+
+
+class Command(BaseCommand):
+    help = ('Run pending export jobs (large filtered CSV downloads) and delete '
+            'old exports')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', required=False, action='store_true',
+                            help='Exit when there are no pending jobs')
+        parser.add_argument('--sleep', required=False, type=float, default=5,
+                            help='Seconds to wait when there are no pending jobs')
+        parser.add_argument('--clean-up-interval', required=False, type=float,
+                            default=600,
+                            help='Seconds between deletions of old exports')
+
+    def clean_up(self):
+        failed = ExportJob.objects.fail_stale()
+        if failed:
+            print('{} stale jobs marked as failed.'.format(failed))
+        deleted = ExportJob.objects.clean_up()
+        if deleted:
+            print('{} old exports deleted.'.format(deleted))
+
+    def handle(self, *args, **kwargs):
+        run_once = kwargs['once']
+        sleep = kwargs['sleep']
+        clean_up_interval = kwargs['clean_up_interval']
+
+        last_clean_up = 0
+        while True:
+            if time.time() - last_clean_up >= clean_up_interval:
+                self.clean_up()
+                last_clean_up = time.time()
+            job = ExportJob.objects.claim_next()
+            if job is None:
+                if run_once:
+                    break
+                connection.close()  # Do not keep an idle connection open
+                time.sleep(sleep)
+                continue
+
+            print('Exporting {}...'.format(job), end='', flush=True)
+            start = time.time()
+            job.run()
+            end = time.time()
+            if job.status == ExportJob.STATUS_FINISHED:
+                print('  done in {:.3f}s ({} bytes).'.format(end - start, job.size))
+            else:
+                print('  ERROR: {}'.format(job.error))
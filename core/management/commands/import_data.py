@@ -1,13 +1,17 @@
 import os
 import time
 
-from django.core.management.base import BaseCommand
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
-from django.db.utils import ProgrammingError
+from django.db.utils import DatabaseError, ProgrammingError
 from django.utils import timezone
 from rows.utils import pgimport, ProgressBar
 
-from core.models import Field, Table
+from core.document_profile import TABLES as DOCUMENT_PROFILE_TABLES
+from core.metadata import metadata_changed
+from core.models import Table
+from core.util import parallel_pgimport
 
 
 class Command(BaseCommand):
@@ -22,6 +26,30 @@ class Command(BaseCommand):
         parser.add_argument('--no-vacuum', required=False, action='store_true')
         parser.add_argument('--no-create-filter-indexes', required=False, action='store_true')
         parser.add_argument('--no-fill-choices', required=False, action='store_true')
+        parser.add_argument('--no-snapshot', required=False, action='store_true')
+        parser.add_argument('--no-warm-cache', required=False, action='store_true')
+        parser.add_argument('--no-document-profiles', required=False, action='store_true')
+        parser.add_argument(
+            '--workers', required=False, type=int, default=1,
+            help='Number of concurrent COPY streams used to import data',
+        )
+        parser.add_argument(
+            '--index-workers', required=False, type=int, default=1,
+            help='Number of indexes to be created concurrently',
+        )
+        parser.add_argument(
+            '--maintenance-work-mem', required=False,
+            help='maintenance_work_mem used when creating indexes (e.g.: 1GB)',
+        )
+        parser.add_argument(
+            '--max-parallel-maintenance-workers', required=False, type=int,
+            help='max_parallel_maintenance_workers used when creating indexes',
+        )
+        parser.add_argument(
+            '--shadow-table', required=False, action='store_true',
+            help=('Import into a shadow table and swap it with the current '
+                  'one at the end, so the data is available during import'),
+        )
 
     def handle(self, *args, **kwargs):
         dataset_slug = kwargs['dataset_slug']
@@ -32,8 +60,20 @@ class Command(BaseCommand):
         vacuum = not kwargs['no_vacuum']
         create_filter_indexes = not kwargs['no_create_filter_indexes']
         fill_choices = not kwargs['no_fill_choices']
+        write_snapshot = not kwargs['no_snapshot']
+        warm_cache = not kwargs['no_warm_cache']
+        update_document_profiles = not kwargs['no_document_profiles'] and \
+            f'{dataset_slug}:{tablename}' in DOCUMENT_PROFILE_TABLES
+        workers = kwargs['workers']
+        index_options = {
+            'workers': kwargs['index_workers'],
+            'maintenance_work_mem': kwargs['maintenance_work_mem'],
+            'max_parallel_maintenance_workers':
+                kwargs['max_parallel_maintenance_workers'],
+        }
+        use_shadow_table = import_data and kwargs['shadow_table']
 
-        if ask_confirmation:
+        if ask_confirmation and not use_shadow_table:
             print(
                 'This operation will DESTROY the existing data for this '
                 'dataset table.'
@@ -44,6 +84,11 @@ class Command(BaseCommand):
 
         table = Table.objects.for_dataset(dataset_slug).named(tablename)
         Model = table.get_model()
+        timings = {}
+        if use_shadow_table:
+            # Data is imported and indexed in another table and then swapped
+            # with the current one (which is used until the swap)
+            Model = table.get_shadow_model()
 
         if import_data:
             # Create the table if not exists
@@ -53,8 +98,10 @@ class Command(BaseCommand):
                 except ProgrammingError:  # Does not exist
                     pass
                 finally:
+                    # The search trigger is created only after the search
+                    # data is filled and indexed, so COPY does not run it
+                    # once per row
                     Model.create_table(create_indexes=False)
-                    Model.create_triggers()
 
             # Get file object, header and set command to run
             table_name = Model._meta.db_table
@@ -64,56 +111,166 @@ class Command(BaseCommand):
             start_time = time.time()
             progress = ProgressBar(prefix='Importing data', unit='bytes')
             try:
-                import_meta = pgimport(
-                    filename=filename,
-                    encoding=encoding,
-                    dialect='excel',
-                    database_uri=database_uri,
-                    table_name=table_name,
-                    create_table=False,
-                    timeout=timeout,
-                    callback=progress.update,
-                )
+                if workers > 1:
+                    import_meta = parallel_pgimport(
+                        filename=filename,
+                        database_uri=database_uri,
+                        table_name=table_name,
+                        workers=workers,
+                        encoding=encoding,
+                        dialect='excel',
+                        timeout=timeout,
+                        callback=progress.update,
+                    )
+                else:
+                    import_meta = pgimport(
+                        filename=filename,
+                        encoding=encoding,
+                        dialect='excel',
+                        database_uri=database_uri,
+                        table_name=table_name,
+                        create_table=False,
+                        timeout=timeout,
+                        callback=progress.update,
+                    )
             except RuntimeError as exception:
                 progress.close()
                 print('ERROR: {}'.format(exception.args[0]))
                 exit(1)
             else:
                 progress.close()
-                table.last_update = timezone.now()
-                table.save()
+                if not use_shadow_table:
+                    table.import_date = timezone.now()
+                    table.save()
                 end_time = time.time()
                 duration = end_time - start_time
+                timings['import'] = duration
                 rows_imported = import_meta['rows_imported']
                 print('  done in {:7.3f}s ({} rows imported, {:.3f} rows/s).'
                       .format(duration, rows_imported, rows_imported / duration))
-            Model = table.get_model(cache=False)
+            if not use_shadow_table:
+                Model = table.get_model(cache=False)
+
+            if Model.computed_columns():
+                # Search data and normalized names
+                start = time.time()
+                progress = ProgressBar(prefix='Filling computed data', unit='rows')
+                Model.fill_computed_data(workers=workers, callback=progress.update)
+                progress.close()
+                end = time.time()
+                timings['computed_data'] = end - start
+                print('  done in {:.3f}s.'.format(end - start))
+
+        elif Model.extra['names']:
+            # The name fields may have been set after the table was imported
+            columns = Model.add_normalized_columns()
+            if columns:
+                start = time.time()
+                progress = ProgressBar(prefix='Filling normalized names', unit='rows')
+                Model.fill_computed_data(columns=columns, workers=workers,
+                                         callback=progress.update)
+                progress.close()
+                end = time.time()
+                timings['computed_data'] = end - start
+                print('  done in {:.3f}s.'.format(end - start))
 
         if vacuum:
             print('Running VACUUM ANALYSE...', end='', flush=True)
             start = time.time()
             Model.analyse_table()
             end = time.time()
+            timings['vacuum'] = end - start
             print('  done in {:.3f}s.'.format(end - start))
 
         if create_filter_indexes:
             # TODO: warn if field has_choices but not in Table.filtering
-            print('Creating filter indexes...', end='', flush=True)
+            print('Creating filter indexes...')
             start = time.time()
-            Model.create_indexes()
+            report = Model.create_indexes(**index_options)
+            end = time.time()
+            timings['indexes'] = end - start
+            for index in report:
+                print('  {name} - {status} in {duration:.3f}s '
+                      '({attempts} attempt(s)).'.format(**index))
+                if index['error']:
+                    print('    {}'.format(index['error']))
+            print('  done in {:.3f}s.'.format(end - start))
+            failed = [index['name'] for index in report
+                      if index['status'] == 'failed']
+            if failed:
+                print('ERROR: could not create indexes: {}'
+                      .format(', '.join(failed)))
+                exit(1)
+
+        if import_data and Model.extra['search']:
+            print('Creating search trigger...', end='', flush=True)
+            start = time.time()
+            Model.create_triggers()
+            end = time.time()
+            timings['trigger'] = end - start
+            print('  done in {:.3f}s.'.format(end - start))
+
+        if use_shadow_table:
+            print('Swapping tables...', end='', flush=True)
+            start = time.time()
+            try:
+                Model.swap_table(table.db_table)
+            except DatabaseError as exception:
+                # The current table is kept (and still used)
+                print('ERROR: could not swap tables: {}'
+                      .format(str(exception).strip()))
+                exit(1)
+            table.import_date = timezone.now()
+            table.save()
+            Model = table.get_model(cache=False)
             end = time.time()
+            timings['swap'] = end - start
             print('  done in {:.3f}s.'.format(end - start))
 
         if fill_choices:
-            print('Filling choices...')
+            print('Filling choices (single table scan)...')
+            start = time.time()
+            fields = table.update_choices()
+            end = time.time()
+            for field in fields:
+                print('  {} - {} choices.'.format(field.name,
+                                                  len(field.choices['data'])))
+            timings['choices'] = end - start
+            print('  done in {:.3f}s.'.format(end - start))
+
+        # Responses cached while the table was being imported (or for the
+        # old data) must not be used anymore
+        table.invalidate_cache()
+        metadata_changed()  # New import date, choices etc.
+
+        if write_snapshot:
+            # Written for the new cache generation (see `Table.snapshot_filename`)
+            print('Writing compressed snapshots...', end='', flush=True)
             start = time.time()
-            choiceables = Field.objects.for_table(table).choiceables()
-            for field in choiceables:
-                print('  {}'.format(field.name), end='', flush=True)
-                start_field = time.time()
-                field.update_choices()
-                field.save()
-                end_field = time.time()
-                print(' - done in {:.3f}s.'.format(end_field - start_field))
+            table.write_snapshots()
             end = time.time()
+            timings['snapshot'] = end - start
             print('  done in {:.3f}s.'.format(end - start))
+
+        if warm_cache:
+            start = time.time()
+            try:
+                call_command('warm_cache', dataset=dataset_slug, table=tablename)
+            except CommandError as exception:
+                # The data was imported - only the cache is cold
+                print('ERROR warming cache: {}'.format(exception))
+            end = time.time()
+            timings['warm_cache'] = end - start
+
+        if update_document_profiles:
+            # Only the sections using this table are stale (not used) after
+            # this import, and just those are built again
+            start = time.time()
+            call_command('update_document_profiles')
+            end = time.time()
+            timings['profiles'] = end - start
+
+        if timings:
+            print('Time spent in each phase:')
+            for phase, duration in timings.items():
+                print('  {:12} {:10.3f}s'.format(phase, duration))
@@ -3,7 +3,8 @@ import time
 from django.core.management.base import BaseCommand
 from django.db.utils import ProgrammingError
 
-from core.models import Dataset, Field, Table
+from core.metadata import metadata_changed
+from core.models import Dataset, Table
 
 
 class Command(BaseCommand):
@@ -32,21 +33,20 @@ class Command(BaseCommand):
                 print('  {}'.format(table.name))
                 start_table = time.time()
 
-                choiceables = Field.objects.for_table(table).choiceables()
-                for field in choiceables:
-                    start = time.time()
-                    print('    {}... '.format(field.name), end='', flush=True)
-                    try:
-                        field.update_choices()
-                        field.save()
-                    except ProgrammingError:
-                        print('ERROR: model does not exist.')
-                    else:
-                        end = time.time()
-                        print('done in {:7.3f}s.'.format(end - start))
+                try:
+                    fields = table.update_choices()
+                except ProgrammingError:
+                    print('    ERROR: model does not exist.')
+                else:
+                    for field in fields:
+                        print('    {}: {} choices.'.format(
+                            field.name, len(field.choices['data'])))
+                    table.invalidate_cache()
 
                 end_table = time.time()
                 print('    table done in {:7.3f}s.'.format(end_table - start_table))
 
             end_dataset = time.time()
             print('  dataset done in {:7.3f}s.'.format(end_dataset - start_dataset))
+
+        metadata_changed()
@@ -6,6 +6,7 @@ from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.management.base import BaseCommand
 
+from core.metadata import metadata_changed
 from core.models import Dataset, Link, Version, Table, Field
 
 
@@ -69,6 +70,7 @@ def table_update_data(row):
     row['ordering'] = str_to_list(row['ordering'])
     row['filtering'] = str_to_list(row['filtering'])
     row['search'] = str_to_list(row['search'])
+    row['names'] = str_to_list(row.get('names'))
     return {
         'dataset': row['dataset'],
         'version': row['version'],
@@ -155,3 +157,7 @@ class Command(BaseCommand):
                 sheet_name=Model.__name__,
             )
             self._update_data(Model, table, update_data_function)
+
+        # Cached pages and API responses depend on the metadata
+        Table.objects.invalidate_cache()
+        metadata_changed()
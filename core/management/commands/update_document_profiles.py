@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.document_profile import build_section, profile_sections, stale_sections
+
+
+class Command(BaseCommand):
+    help = 'Precompute the sections shown in document pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'sections', nargs='*',
+            help='Only build these sections (default: the stale ones)',
+        )
+        parser.add_argument('--all', action='store_true',
+                            help='Build all sections, even if not stale')
+
+    def handle(self, *args, **kwargs):
+        names = kwargs['sections']
+        unknown = set(names) - set(profile_sections())
+        if unknown:
+            raise CommandError('Unknown sections: {}'.format(
+                ', '.join(sorted(unknown))))
+        if not names:
+            names = list(profile_sections()) if kwargs['all'] \
+                else stale_sections()
+
+        if not names:
+            print('Document profiles are up to date.')
+            return
+        print('Updating document profiles...')
+        start = time.time()
+        for name in names:
+            section_start = time.time()
+            build_section(name)
+            print('  {} built in {:.3f}s.'.format(
+                name, time.time() - section_start))
+        print('  done in {:.3f}s.'.format(time.time() - start))
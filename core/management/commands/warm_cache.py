@@ -0,0 +1,138 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.http.request import validate_host
+from django.test import Client
+from django.urls import Resolver404, resolve, reverse
+
+from core.models import Table
+from utils.db import run_in_threads
+
+
+def default_paths(tables):
+    """First dataset page and API data page for each table"""
+    for table in tables:
+        kwargs = {'slug': table.dataset.slug, 'tablename': table.name}
+        yield reverse('core:dataset-table-detail', kwargs=kwargs)
+        yield reverse('api:dataset-table-data', kwargs=kwargs)
+
+
+def read_paths(filename):
+    """Read URL paths (one per line, most accessed first) from `filename`
+
+    Empty lines and lines starting with `#` are ignored. Can be generated
+    from access logs.
+    """
+    with open(filename) as fobj:
+        for line in fobj:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+def path_table(path):
+    """Return `(slug, tablename)` of a URL path (or `None`)"""
+    try:
+        match = resolve(path.split('?')[0])
+    except Resolver404:
+        return None
+    if 'slug' not in match.kwargs or 'tablename' not in match.kwargs:
+        return None
+    return match.kwargs['slug'], match.kwargs['tablename']
+
+
+def get_host(host=None):
+    """Return the host used in requests: `host`, `settings.SITE_HOST` or the
+    first concrete (not wildcard) host in `settings.ALLOWED_HOSTS`
+
+    Raises `CommandError` if there's none or it's not allowed (requests
+    would fail with `DisallowedHost` and their error responses be cached).
+    """
+    allowed_hosts = [value for value in settings.ALLOWED_HOSTS if value]
+    if settings.DEBUG and not allowed_hosts:
+        allowed_hosts = ['.localhost', '127.0.0.1', '[::1]']
+    if not host:
+        host = settings.SITE_HOST
+    if not host:
+        concrete_hosts = [value for value in allowed_hosts
+                          if value != '*' and not value.startswith('.')]
+        if not concrete_hosts:
+            raise CommandError(
+                'Could not resolve the host to use in requests: use --host '
+                'or set SITE_HOST'
+            )
+        host = concrete_hosts[0]
+    if not validate_host(host.split(':')[0], allowed_hosts):
+        raise CommandError('Host {} is not in ALLOWED_HOSTS'.format(repr(host)))
+    return host
+
+
+class Command(BaseCommand):
+    help = 'Request the most accessed pages so they are cached'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--file', required=False,
+            help=('File with URL paths to request, one per line (default: '
+                  'first pages of each table)'),
+        )
+        parser.add_argument('--dataset', required=False,
+                            help='Only warm pages for this dataset')
+        parser.add_argument('--table', required=False,
+                            help='Only warm pages for this table')
+        parser.add_argument('--limit', required=False, type=int,
+                            help='Maximum number of paths to request')
+        parser.add_argument('--workers', required=False, type=int, default=4)
+        parser.add_argument(
+            '--host', required=False,
+            help=('Host used in requests (default: SITE_HOST or the first '
+                  'non-wildcard of ALLOWED_HOSTS)'),
+        )
+
+    def handle(self, *args, **kwargs):
+        dataset_slug = kwargs['dataset']
+        tablename = kwargs['table']
+        host = get_host(kwargs['host'])
+
+        if kwargs['file']:
+            paths = read_paths(kwargs['file'])
+        else:
+            tables = Table.objects.filter(dataset__show=True,
+                                          import_date__isnull=False)\
+                                  .select_related('dataset')\
+                                  .order_by('dataset__slug', 'name')
+            paths = default_paths(tables)
+        if dataset_slug or tablename:
+            def wanted(path):
+                table = path_table(path)
+                return table is not None and \
+                    dataset_slug in (None, table[0]) and \
+                    tablename in (None, table[1])
+
+            paths = filter(wanted, paths)
+        paths = list(paths)[:kwargs['limit']]
+
+        def request(path):
+            # Cached API responses are keyed on the negotiated format, so
+            # these match the ones of clients accepting JSON
+            client = Client(HTTP_HOST=host, HTTP_ACCEPT='*/*')
+            start = time.time()
+            response = client.get(path)
+            if response.streaming:
+                for _ in response.streaming_content:
+                    pass
+            response.close()
+            return response.status_code, response.get('X-Cache'), time.time() - start
+
+        print('Warming cache ({} paths)...'.format(len(paths)))
+        start = time.time()
+        results = run_in_threads(request, paths, kwargs['workers'])
+        failed = 0
+        for path, (status_code, cache_status, duration) in zip(paths, results):
+            print('  {} {} {:.3f}s {}'.format(status_code, cache_status or '-',
+                                             duration, path))
+            failed += status_code >= 400
+        print('  done in {:.3f}s.'.format(time.time() - start))
+        if failed:
+            raise CommandError('{} of {} requests failed'.format(failed, len(paths)))
@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.db import connections
+from django.db.models import Prefetch
+from django.http import Http404
+
+from core.models import Dataset, MetadataVersion, Table
+
+
+# Seconds between checks of the metadata version (so changes made by other
+# processes may take this long to be seen)
+CHECK_INTERVAL = 1
+
+_lock = threading.Lock()
+_snapshot = None
+_checked_at = 0
+
+
+class MetadataSnapshot:
+    """All datasets with their links, versions, tables and fields
+
+    Loaded with one query per model; relations are prefetched, so model
+    methods like `Dataset.tables`, `Dataset.get_table` and `Table.fields`
+    don't run queries. The objects are shared by all requests of the process
+    and must not be changed.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        tables = Table.objects.select_related('version')\
+                              .prefetch_related('field_set')
+        datasets = Dataset.objects.order_by('id').prefetch_related(
+            'link_set',
+            'version_set',
+            Prefetch('table_set', queryset=tables),
+        )
+        self.datasets = OrderedDict((dataset.slug, dataset)
+                                    for dataset in datasets)
+
+    def visible_datasets(self):
+        return [dataset for dataset in self.datasets.values() if dataset.show]
+
+    def get_dataset(self, slug):
+        try:
+            return self.datasets[slug]
+        except KeyError:
+            raise Dataset.DoesNotExist(f'Dataset {slug} does not exist')
+
+    def get_table(self, slug, tablename):
+        return self.get_dataset(slug).get_table(tablename)
+
+
+def get_metadata():
+    """Return the current `MetadataSnapshot`
+
+    The snapshot is loaded again when `MetadataVersion` changes (checked at
+    most once every `CHECK_INTERVAL` seconds).
+    """
+    global _snapshot, _checked_at
+
+    snapshot = _snapshot
+    now = time.monotonic()
+    if snapshot is not None and now - _checked_at < CHECK_INTERVAL:
+        return snapshot
+
+    version = MetadataVersion.current()
+    if snapshot is None or snapshot.version != version:
+        with _lock:
+            if _snapshot is None or _snapshot.version != version:
+                _snapshot = MetadataSnapshot(version)
+            snapshot = _snapshot
+    _checked_at = now
+    return snapshot
+
+
+def preload():
+    """Load the metadata snapshot and create all dynamic models
+
+    Used to load everything in gunicorn's master process before forking
+    workers (see `brasilio/gunicorn.py`), so they start ready and share the
+    memory. Database connections are closed, since they can't be shared by
+    the forked processes.
+    """
+    snapshot = get_metadata()
+    for dataset in snapshot.datasets.values():
+        for table in dataset.table_set.all():
+            table.get_model()
+    connections.close_all()
+    return snapshot
+
+
+def get_dataset_or_404(slug):
+    try:
+        return get_metadata().get_dataset(slug)
+    except Dataset.DoesNotExist:
+        raise Http404('Dataset does not exist.')
+
+
+def get_table_or_404(slug, tablename):
+    try:
+        return get_dataset_or_404(slug).get_table(tablename)
+    except Table.DoesNotExist:
+        raise Http404('Table does not exist.')
+
+
+def metadata_changed():
+    """Make all processes load the metadata again"""
+    global _checked_at
+
+    MetadataVersion.bump()
+    _checked_at = 0  # Don't wait `CHECK_INTERVAL` in this process
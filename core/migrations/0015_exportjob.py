@@ -0,0 +1,34 @@
+# Generated by Django 2.1.1 on 2018-10-01 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_auto_20180908_1902'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('querystring', models.TextField(blank=True)),
+                ('import_date', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('finished', 'finished'), ('failed', 'failed')], default='pending', max_length=15)),
+                ('filename', models.CharField(blank=True, max_length=255, null=True)),
+                ('size', models.BigIntegerField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('table', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Table')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='exportjob',
+            unique_together={('table', 'querystring', 'import_date')},
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.1 on 2018-10-05 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_exportjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='table',
+            name='cache_generation',
+            field=models.PositiveIntegerField(blank=True, default=0),
+        ),
+    ]
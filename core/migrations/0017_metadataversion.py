@@ -0,0 +1,20 @@
+# Generated by Django 2.1.1 on 2018-10-08 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_table_cache_generation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetadataVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.1.1 on 2018-10-15 12:00
+
+import django.contrib.postgres.fields.jsonb
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_metadataversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=14, unique=True)),
+                ('document', models.CharField(max_length=14)),
+                ('data', django.contrib.postgres.fields.jsonb.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('updated_at', models.DateTimeField()),
+            ],
+        ),
+    ]
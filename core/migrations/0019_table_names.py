@@ -0,0 +1,19 @@
+# Generated by Django 2.1.1 on 2018-10-17 12:00
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_documentprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='table',
+            name='names',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=63), blank=True, null=True, size=None),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.1.1 on 2018-10-24 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_table_names'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='cache_generation',
+            field=models.PositiveIntegerField(blank=True, default=0),
+        ),
+        migrations.AlterUniqueTogether(
+            name='exportjob',
+            unique_together={('table', 'querystring', 'import_date', 'cache_generation')},
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.1.1 on 2018-10-25 12:00
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0020_exportjob_cache_generation'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='DocumentProfile',
+        ),
+        migrations.CreateModel(
+            name='DocumentProfileSection',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=63, unique=True)),
+                ('import_dates', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('built_at', models.DateTimeField()),
+            ],
+        ),
+    ]
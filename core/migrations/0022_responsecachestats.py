@@ -0,0 +1,21 @@
+# Generated by Django 2.1.1 on 2018-10-26 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_documentprofilesection'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResponseCacheStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hits', models.BigIntegerField(default=0)),
+                ('misses', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -1,16 +1,57 @@
+import gzip
 import hashlib
+import json
+import lzma
+import os
+import threading
+import time
+from datetime import timedelta
 from textwrap import dedent
-from urllib.parse import urlparse
+from urllib.parse import urlencode, urlparse
 
 import django.db.models.indexes as django_indexes
+from psycopg2 import errorcodes
 from django.contrib.postgres.fields import ArrayField, JSONField
 import django.contrib.postgres.indexes as pg_indexes
 from django.contrib.postgres.search import (SearchQuery, SearchVector,
                                             SearchVectorField)
-from django.db import connection, models
-
-
-DYNAMIC_MODEL_REGISTRY = {}
+from django.conf import settings
+from django.core.cache import caches
+from django.db import (DatabaseError, IntegrityError, connection, models,
+                       transaction)
+from django.db.models import Case, F, Func, Q, Value, When
+from django.http import QueryDict
+from django.utils import timezone
+
+from utils.db import copy_to_files, run_in_threads
+from utils.registry import Registry
+from utils.text import (NAME_TRANSLATE_FROM, NAME_TRANSLATE_TO,
+                        WHITESPACE_PATTERN, normalize_name, unaccent)
+
+
+DYNAMIC_MODEL_REGISTRY = Registry()
+INDEX_PREFIX = 'idx'
+OLD_TABLE_SUFFIX = '__old'
+SHADOW_INDEX_PREFIX = 'nxt'
+SHADOW_TABLE_SUFFIX = '__next'
+FACET_TABLE_SUFFIX = '__facets'
+NORMALIZED_SUFFIX = '_normalized'
+# Filtered facets are shared by all processes (see `settings.CACHES`)
+FACETS_CACHE_ALIAS = 'responses'
+FACETS_CACHE_TIMEOUT = 24 * 3600
+FACETS_LIMIT = 100
+PAGINATION_KEYS = ('cursor', 'format', 'page', 'page_size')
+# Errors which may not happen again if the query is retried
+RETRIABLE_ERRORS = (
+    errorcodes.DEADLOCK_DETECTED,
+    errorcodes.LOCK_NOT_AVAILABLE,
+    errorcodes.QUERY_CANCELED,  # e.g. statement or lock timeouts
+    errorcodes.SERIALIZATION_FAILURE,
+)
+SNAPSHOT_COMPRESSIONS = {
+    'gz': gzip.open,
+    'xz': lzma.open,
+}
 FIELD_TYPES = {
     'binary': models.BinaryField,
     'bool': models.BooleanField,
@@ -78,15 +119,34 @@ def model_to_code(Model):
                 ordering = {repr(ordering)}
     ''').strip()
 
-def make_index_name(tablename, index_type, fields):
+def normalize_querystring(querystring, ignore=PAGINATION_KEYS):
+    """Return sorted (key, value) pairs of non-empty values (stripped)
+
+    Used to build cache keys and deduplicate requests which are the same
+    except for the parameters' order and whitespace.
+    """
+    return sorted(
+        (key, value.strip())
+        for key, value in (querystring or {}).items()
+        if value is not None and value.strip() and key not in ignore
+    )
+
+
+def normalized_fieldname(fieldname):
+    """Name of the column with the normalized version of a name field"""
+    return fieldname + NORMALIZED_SUFFIX
+
+
+def make_index_name(tablename, index_type, fields, prefix=INDEX_PREFIX):
     idx_hash = hashlib.md5(
         f'{tablename} {index_type} {", ".join(sorted(fields))}'.encode('ascii')
     ).hexdigest()
     tablename = tablename.replace('data_', '').replace('-', '')[:12]
-    return f'idx_{tablename}_{index_type[0]}{idx_hash[-12:]}'
+    return f'{prefix}_{tablename}_{index_type[0]}{idx_hash[-12:]}'
 
 
 class DynamicModelMixin:
+    _has_facet_table = None
 
     @classmethod
     def tablename(cls):
@@ -129,41 +189,442 @@ class DynamicModelMixin:
             cursor.execute(query)
 
     @classmethod
-    def create_indexes(cls):
+    def computed_columns(cls):
+        """Return `{column: expression}` for columns computed from others
+
+        They are `search_data` (if the table has search fields) and the
+        normalized version of each name field (see `Table.names`).
+        """
+        columns = {}
+        if cls.extra['search']:
+            # TODO: replace pg_catalog.portuguese with dataset language
+            columns['search_data'] = SearchVector(
+                *cls.extra['search'],
+                config='pg_catalog.portuguese',
+            )
+        for fieldname in cls.extra['names']:
+            columns[normalized_fieldname(fieldname)] = NormalizeName(fieldname)
+        return columns
+
+    @classmethod
+    def add_normalized_columns(cls):
+        """Create missing normalized name columns and return their names
+
+        Needed for tables imported before their name fields were set in
+        `Table.names` (the columns must be filled after this).
+        """
         with connection.cursor() as cursor:
-            for index in cls._meta.indexes:
-                index_class = type(index)
-                if index_class is django_indexes.Index:
-                    index_type = 'btree'
-                elif index_class is pg_indexes.GinIndex:
-                    index_type = 'gin'
+            cursor.execute(
+                '''SELECT column_name FROM information_schema.columns
+                   WHERE table_name = %s''',
+                [cls.tablename()],
+            )
+            existing = {row[0] for row in cursor.fetchall()}
+            added = []
+            for fieldname in cls.extra['names']:
+                column = normalized_fieldname(fieldname)
+                if column not in existing:
+                    cursor.execute(
+                        f'ALTER TABLE {cls.tablename()} ADD COLUMN {column} TEXT'
+                    )
+                    added.append(column)
+        return added
+
+    @classmethod
+    def fill_computed_data(cls, columns=None, workers=1, batch_size=100000,
+                           callback=None):
+        """Fill computed columns for all rows with batched UPDATEs
+
+        Used after importing data without the search trigger (which runs once
+        per inserted row). All `columns` (default: all computed columns) are
+        set by the same UPDATE, so the table is rewritten only once. Rows are
+        split in `id` ranges of `batch_size` and each range is updated by one
+        of the `workers` threads. `callback` is called with the number of
+        rows updated after each batch.
+        """
+        computed_columns = cls.computed_columns()
+        if columns is not None:
+            computed_columns = {column: computed_columns[column]
+                                for column in columns}
+        if not computed_columns:
+            return 0
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT MIN(id), MAX(id) FROM {cls.tablename()}')
+            min_id, max_id = cursor.fetchone()
+        if min_id is None:  # Empty table
+            return 0
+
+        lock = threading.Lock()
+
+        def update_batch(start):
+            updated = cls.objects\
+                .filter(id__gte=start, id__lt=start + batch_size)\
+                .update(**computed_columns)
+            if callback:
+                with lock:
+                    callback(updated)
+            return updated
+
+        batches = range(min_id, max_id + 1, batch_size)
+        return sum(run_in_threads(update_batch, batches, workers))
+
+    @classmethod
+    def index_queries(cls):
+        queries = []
+        for index in cls._meta.indexes:
+            index_class = type(index)
+            if index_class is django_indexes.Index:
+                index_type = 'btree'
+            elif index_class is pg_indexes.GinIndex:
+                index_type = 'gin'
+            else:
+                raise ValueError('Cannot identify index type of {index}')
+
+            fieldnames = []
+            for fieldname in index.fields:
+                if fieldname.startswith('-'):
+                    value = f'{fieldname[1:]} DESC'
                 else:
-                    raise ValueError('Cannot identify index type of {index}')
+                    value = f'{fieldname} ASC'
+                if index_type == 'gin':
+                    value = value.split(' ')[0]
+                fieldnames.append(value)
+
+            fieldnames = ',\n                        '.join(fieldnames)
+            query = dedent(f'''
+                CREATE INDEX CONCURRENTLY {index.name}
+                    ON {cls.tablename()} USING {index_type} (
+                        {fieldnames}
+                    );
+            ''').strip()
+            queries.append((index.name, query))
+        return queries
 
-                fieldnames = []
-                for fieldname in index.fields:
-                    if fieldname.startswith('-'):
-                        value = f'{fieldname[1:]} DESC'
+    @classmethod
+    def create_indexes(cls, workers=1, maintenance_work_mem=None,
+                       max_parallel_maintenance_workers=None, retries=2):
+        """Create the model indexes using `workers` concurrent connections
+
+        Indexes which end up invalid (what may happen with `CREATE INDEX
+        CONCURRENTLY`) or fail with errors which may not happen again (see
+        `RETRIABLE_ERRORS`) are dropped and created again, up to `retries`
+        times; other errors are not retried. Valid indexes which already exist
+        are kept. Returns a list of dicts with `name`, `duration`, `attempts`,
+        `status` and `error` (the last error message of failed indexes), one
+        per index.
+        """
+        session_settings = [
+            ('maintenance_work_mem', maintenance_work_mem),
+            ('max_parallel_maintenance_workers', max_parallel_maintenance_workers),
+        ]
+
+        def index_is_valid(cursor, index_name):
+            # Returns `None` if the index does not exist
+            cursor.execute(
+                '''SELECT indisvalid FROM pg_index
+                   WHERE indexrelid = to_regclass(%s)''',
+                [index_name],
+            )
+            result = cursor.fetchone()
+            return result[0] if result else None
+
+        def is_retriable(error):
+            return error is None or \
+                getattr(error.__cause__, 'pgcode', None) in RETRIABLE_ERRORS
+
+        def create_index(index_query):
+            index_name, query = index_query
+            start, attempts, status, error = time.time(), 0, 'created', None
+            with connection.cursor() as cursor:
+                for name, value in session_settings:
+                    if value is not None:
+                        cursor.execute(f'SET {name} = %s', [str(value)])
+
+                is_valid = index_is_valid(cursor, index_name)
+                if is_valid:
+                    status = 'exists'
+                while not is_valid:
+                    if is_valid is False:  # Invalid: drop before rebuilding
+                        cursor.execute(
+                            f'DROP INDEX CONCURRENTLY IF EXISTS {index_name}'
+                        )
+                    if attempts > retries or not is_retriable(error):
+                        status = 'failed'
+                        break
+                    attempts += 1
+                    try:
+                        cursor.execute(query)
+                    except DatabaseError as exception:
+                        error = exception
                     else:
-                        value = f'{fieldname} ASC'
-                    if index_type == 'gin':
-                        value = value.split(' ')[0]
-                    fieldnames.append(value)
-
-                fieldnames = ',\n                            '.join(fieldnames)
-                query = dedent(f'''
-                    CREATE INDEX CONCURRENTLY {index.name}
-                        ON {cls.tablename()} USING {index_type} (
-                            {fieldnames}
-                        );
-                ''').strip()
-                cursor.execute(query)
+                        error = None
+                    is_valid = index_is_valid(cursor, index_name)
+                    if is_valid is None:  # Failed without leaving the index
+                        is_valid = False
+
+            return {
+                'name': index_name,
+                'duration': time.time() - start,
+                'attempts': attempts,
+                'status': status,
+                'error': str(error).strip() if status == 'failed' and error
+                         else None,
+            }
+
+        return run_in_threads(create_index, cls.index_queries(), workers)
+
+    @classmethod
+    def facet_tablename(cls):
+        return cls.tablename() + FACET_TABLE_SUFFIX
+
+    @classmethod
+    def create_facet_table(cls, fieldnames):
+        """Create a side table with (field, value, count) for each field
+
+        All fields are computed in the same table scan, using `GROUPING
+        SETS` (PostgreSQL's `GROUPING` accepts at most 31 arguments, so more
+        fields than that need more scans). `position` keeps the order of the
+        values as sorted by their original type (values are stored as text)
+        and the indexes allow top-K and prefix lookups per field. The table is
+        built with another name and then replaces the current one in a
+        transaction, so it's never missing or incomplete for queries.
+        """
+        quote_name = connection.ops.quote_name
+        facet_table = cls.facet_tablename()
+        new_table = facet_table + SHADOW_TABLE_SUFFIX
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {new_table}')
+            cursor.execute(dedent(f'''
+                CREATE TABLE {new_table} (
+                    field VARCHAR(63) NOT NULL,
+                    value TEXT,
+                    count BIGINT NOT NULL,
+                    position BIGINT NOT NULL
+                )
+            ''').strip())
+
+            for start in range(0, len(fieldnames), 31):
+                names = fieldnames[start:start + 31]
+                columns = ', '.join(quote_name(name) for name in names)
+                grouping_sets = ', '.join(f'({quote_name(name)})'
+                                          for name in names)
+                # `GROUPING` returns a bit mask of the columns *not* grouped
+                # in that row (the first column is the most significant bit)
+                all_bits = 2 ** len(names) - 1
+                field_cases, values = [], []
+                for index, name in enumerate(names):
+                    mask = all_bits ^ (1 << (len(names) - 1 - index))
+                    field_cases.append(f"WHEN {mask} THEN '{name}'")
+                    field = cls._meta.get_field(name)
+                    if isinstance(field, models.BooleanField):
+                        # Keep the same representation as `str(value)`
+                        values.append(
+                            f"CASE WHEN {quote_name(name)} THEN 'True' "
+                            f"WHEN NOT {quote_name(name)} THEN 'False' END"
+                        )
+                    else:
+                        values.append(f'{quote_name(name)}::text')
+                cursor.execute(dedent(f'''
+                    INSERT INTO {new_table} (field, value, count, position)
+                    SELECT
+                        CASE GROUPING({columns}) {' '.join(field_cases)} END,
+                        COALESCE({', '.join(values)}),
+                        COUNT(*),
+                        ROW_NUMBER() OVER (
+                            PARTITION BY GROUPING({columns})
+                            ORDER BY {columns}
+                        )
+                    FROM {cls.tablename()}
+                    GROUP BY GROUPING SETS ({grouping_sets})
+                ''').strip())
+
+            cursor.execute(
+                f'CREATE INDEX {new_table}_count '
+                f'ON {new_table} (field, count DESC)'
+            )
+            cursor.execute(
+                f'CREATE INDEX {new_table}_value '
+                f'ON {new_table} (field, value text_pattern_ops)'
+            )
+            cursor.execute(f'ANALYZE {new_table}')
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {facet_table}')
+            cursor.execute(f'ALTER TABLE {new_table} RENAME TO {facet_table}')
+            for suffix in ('count', 'value'):
+                cursor.execute(
+                    f'ALTER INDEX {new_table}_{suffix} '
+                    f'RENAME TO {facet_table}_{suffix}'
+                )
+
+    @classmethod
+    def has_facet_table(cls):
+        """Return whether the facet table exists (checked once per model)
+
+        It's created by `Table.update_choices`, which is followed by a cache
+        invalidation - so the model is rebuilt and checks it again.
+        """
+        if cls._has_facet_table is None:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT to_regclass(%s)', [cls.facet_tablename()])
+                cls._has_facet_table = cursor.fetchone()[0] is not None
+        return cls._has_facet_table
+
+    @classmethod
+    def facets(cls, fieldname, limit=FACETS_LIMIT, prefix=None):
+        """Return the `limit` most common (value, count) of `fieldname`"""
+        query = f'SELECT value, count FROM {cls.facet_tablename()} WHERE field = %s'
+        params = [fieldname]
+        if prefix:
+            query += ' AND value LIKE %s'
+            params.append(prefix.replace('%', r'\%').replace('_', r'\_') + '%')
+        query += ' ORDER BY count DESC, position LIMIT %s'
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            return [(str(value), count) for value, count in cursor.fetchall()]
+
+    @classmethod
+    def facet_values(cls, fieldname):
+        """Return all values of `fieldname` (as text) in their original order"""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'''SELECT value FROM {cls.facet_tablename()}
+                   WHERE field = %s ORDER BY position''',
+                [fieldname],
+            )
+            return [str(row[0]) for row in cursor.fetchall()]
 
     @classmethod
     def delete_table(cls):
         with connection.schema_editor() as schema_editor:
             schema_editor.delete_model(cls)
 
+    @classmethod
+    def swap_table(cls, target_table, lock_timeout=5, retries=5, backoff=1):
+        """Replace `target_table` with this model's table in one transaction
+
+        The current `target_table` (if it exists) is renamed to
+        `<target_table>__old`, then this model's table, its indexes, primary
+        key sequence and search trigger are renamed to the names the
+        `target_table` ones had. The old table is dropped only after the swap
+        is committed.
+
+        Renaming needs exclusive locks, which wait for running queries on the
+        table - and new queries wait for the swap. So the swap gives up after
+        `lock_timeout` seconds and is tried again (up to `retries` times,
+        waiting `backoff` seconds, doubled each time).
+        """
+        source_table = cls.tablename()
+        old_table = target_table + OLD_TABLE_SUFFIX
+
+        def index_names(cursor, tablename):
+            cursor.execute(
+                'SELECT indexname FROM pg_indexes WHERE tablename = %s',
+                [tablename],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+        def serial_sequence(cursor, tablename):
+            cursor.execute(
+                "SELECT pg_get_serial_sequence(%s, 'id')",
+                [tablename],
+            )
+            return cursor.fetchone()[0]
+
+        def swap(cursor):
+            cursor.execute('SELECT to_regclass(%s)', [target_table])
+            target_exists = cursor.fetchone()[0] is not None
+            if target_exists:
+                cursor.execute(f'DROP TABLE IF EXISTS {old_table}')
+                sequence = serial_sequence(cursor, target_table)
+                cursor.execute(
+                    f'ALTER TABLE {target_table} RENAME TO {old_table}'
+                )
+                for index_name in index_names(cursor, old_table):
+                    cursor.execute(
+                        f'ALTER INDEX {index_name} RENAME TO '
+                        f'{index_name}{OLD_TABLE_SUFFIX}'
+                    )
+                if sequence:
+                    cursor.execute(
+                        f'ALTER SEQUENCE {sequence} RENAME TO '
+                        f'{target_table}_id_seq{OLD_TABLE_SUFFIX}'
+                    )
+
+            sequence = serial_sequence(cursor, source_table)
+            cursor.execute(f'ALTER TABLE {source_table} RENAME TO {target_table}')
+            for index_name in index_names(cursor, target_table):
+                if index_name == f'{source_table}_pkey':
+                    new_name = f'{target_table}_pkey'
+                elif index_name.startswith(f'{SHADOW_INDEX_PREFIX}_'):
+                    new_name = INDEX_PREFIX + index_name[len(SHADOW_INDEX_PREFIX):]
+                else:
+                    continue
+                cursor.execute(f'ALTER INDEX {index_name} RENAME TO {new_name}')
+            if sequence:
+                cursor.execute(
+                    f'ALTER SEQUENCE {sequence} RENAME TO {target_table}_id_seq'
+                )
+            cursor.execute(
+                'SELECT 1 FROM pg_trigger WHERE tgname = %s AND tgrelid = %s::regclass',
+                [f'tgr_tsv_{source_table}', target_table],
+            )
+            if cursor.fetchone():
+                cursor.execute(
+                    f'ALTER TRIGGER tgr_tsv_{source_table} ON {target_table} '
+                    f'RENAME TO tgr_tsv_{target_table}'
+                )
+            return target_exists
+
+        for attempt in range(retries + 1):
+            try:
+                with transaction.atomic(), connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL lock_timeout = %s',
+                                   [f'{int(lock_timeout * 1000)}ms'])
+                    target_exists = swap(cursor)
+            except DatabaseError as exception:
+                pgcode = getattr(exception.__cause__, 'pgcode', None)
+                if pgcode != errorcodes.LOCK_NOT_AVAILABLE or attempt == retries:
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+            else:
+                break
+
+        if target_exists:
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP TABLE IF EXISTS {old_table}')
+
+
+class NormalizeName(Func):
+    """SQL version of `utils.text.normalize_name`"""
+
+    template = (
+        "BTRIM(REGEXP_REPLACE(UPPER(TRANSLATE(%(expressions)s, "
+        f"'{NAME_TRANSLATE_FROM}', '{NAME_TRANSLATE_TO}')), "
+        f"'{WHITESPACE_PATTERN}', ' ', 'g'))"
+    )
+
+
+class Unaccent(Func):
+    """SQL version of `utils.text.unaccent` (for Latin characters)"""
+
+    template = (
+        "TRANSLATE(%(expressions)s, "
+        f"'{NAME_TRANSLATE_FROM}', '{NAME_TRANSLATE_TO}')"
+    )
+
+
+class Obfuscate(Func):
+    """SQL version of `core.templatetags.utils.obfuscate`"""
+
+    template = (
+        "CASE WHEN LENGTH(%(expressions)s) = 11 "
+        "THEN '***' || SUBSTRING(%(expressions)s FROM 4 FOR 5) || '***' "
+        "ELSE %(expressions)s END"
+    )
+
 
 class DynamicModelQuerySet(models.QuerySet):
 
@@ -227,24 +688,167 @@ class DynamicModelQuerySet(models.QuerySet):
 
         return queryset
 
+    def filter_name(self, fieldname, name):
+        """Filter rows by a name, ignoring accents, case and extra spaces
+
+        The normalized column (which is indexed) is used if the field is in
+        `Table.names` - otherwise the unaccented name must match exactly.
+        """
+        if fieldname in self.model.extra['names']:
+            return self.filter(**{
+                normalized_fieldname(fieldname): normalize_name(name),
+            })
+        return self.filter(**{fieldname: unaccent(name)})
+
+    def keyset_ordering(self):
+        """Return the current ordering plus `id` as a unique tiebreaker
+
+        The tiebreaker is not needed (nor wanted) if all `DISTINCT ON`
+        fields are in the ordering, since they're unique in the results.
+        """
+        ordering = list(self.query.order_by or self.model._meta.ordering)
+        fieldnames = [fieldname.lstrip('-') for fieldname in ordering]
+        distinct_fields = self.query.distinct_fields
+        if distinct_fields and set(distinct_fields).issubset(fieldnames):
+            return ordering
+        if 'id' not in fieldnames:
+            ordering.append('id')
+        return ordering
+
+    def seek(self, values, reverse=False):
+        """Filter rows after the row having `values` for `keyset_ordering`
+
+        If `reverse` is `True` the rows before it are returned (in reversed
+        order). The filter follows PostgreSQL's default NULL ordering (last
+        on ascending and first on descending order), so the query can be
+        solved with one index seek.
+        """
+        ordering = self.keyset_ordering()
+        condition, equals = None, Q()
+        for fieldname, value in zip(ordering, values):
+            name = fieldname.lstrip('-')
+            descending = fieldname.startswith('-') != reverse
+            if descending:
+                if value is None:
+                    after = Q(**{f'{name}__isnull': False})
+                else:
+                    after = Q(**{f'{name}__lt': value})
+            elif value is None:
+                after = None
+            else:
+                after = Q(**{f'{name}__gt': value})
+                if self.model._meta.get_field(name).null:
+                    after |= Q(**{f'{name}__isnull': True})
+            if after is not None:
+                term = equals & after
+                condition = term if condition is None else condition | term
+            if value is None:
+                equals &= Q(**{f'{name}__isnull': True})
+            else:
+                equals &= Q(**{name: value})
+
+        if reverse:
+            ordering = [fieldname[1:] if fieldname.startswith('-')
+                        else f'-{fieldname}'
+                        for fieldname in ordering]
+        qs = self.order_by(*ordering)
+        if condition is None:
+            return qs.none()
+        return qs.filter(condition)
+
+    def export_sql(self, fields):
+        """Return a `COPY (...) TO STDOUT` query to export this queryset
+
+        Only `fields` with `show_on_frontend` are exported (in this order)
+        and the ones with `obfuscate` are obfuscated by the database, so rows
+        don't need to be processed in Python.
+        """
+        quote_name = connection.ops.quote_name
+        fields = [field for field in fields
+                  if field.show_on_frontend and field.name != 'search_data']
+        columns = []
+        for field in fields:
+            if field.obfuscate:
+                expression = Obfuscate(F(field.name))
+            elif field.type == 'bool':  # Same representation as `str(value)`
+                expression = Case(
+                    When(**{field.name: True}, then=Value('True')),
+                    When(**{field.name: False}, then=Value('False')),
+                    output_field=models.TextField(),
+                )
+            else:
+                expression = F(field.name)
+            columns.append((field.name, expression))
+        # Aliases are used because an annotation can't have a field's name
+        queryset = self.values(**{
+            f'export_{index}': expression
+            for index, (_, expression) in enumerate(columns)
+        })
+        sql, params = queryset.query.sql_with_params()
+        select = ', '.join(
+            f'{quote_name(f"export_{index}")} AS {quote_name(name)}'
+            for index, (name, _) in enumerate(columns)
+        )
+        query = f'COPY (SELECT {select} FROM ({sql}) AS data) TO STDOUT WITH CSV HEADER'
+        with connection.cursor() as cursor:
+            return cursor.mogrify(query, params).decode('utf-8')
+
+    def estimated_count(self):
+        """Return the number of rows estimated by PostgreSQL's planner"""
+        query = self.query
+        with connection.cursor() as cursor:
+            if not query.where:
+                cursor.execute(
+                    "SELECT reltuples FROM pg_class WHERE relname = %s",
+                    [query.model._meta.db_table],
+                )
+                return int(cursor.fetchone()[0])
+
+            sql, params = query.sql_with_params()
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]['Plan']['Plan Rows'])
+
+    def exact_count(self):
+        """Return the number of rows with `COUNT(*)` (never an estimate)"""
+        return super().count()
+
     def count(self):
+        """Return the exact number of rows or, for big results, an estimate
+
+        Rows are counted with `COUNT(*)` limited to
+        `settings.EXACT_COUNT_THRESHOLD` rows, so small results (most filtered
+        pages) need only this query. Bigger ones use the planner's estimate
+        (at least the threshold) and `count_is_estimate` is set to `True`.
+        Unfiltered querysets use the table statistics first (no scan at all).
+        """
         if getattr(self, '_count', None) is not None:
             return self._count
 
-        query = self.query
-        if not query.where:
+        threshold = settings.EXACT_COUNT_THRESHOLD
+        self.count_is_estimate = False
+        if not self.query.where:
             try:
-                with connection.cursor() as cursor:
-                    cursor.execute(
-                        "SELECT reltuples FROM pg_class WHERE relname = %s",
-                        [query.model._meta.db_table],
-                    )
-                    self._count = int(cursor.fetchone()[0])
-            except:
-                self._count = super().count()
+                estimate = self.estimated_count()
+            except DatabaseError:
+                estimate = None
+            if estimate is not None and estimate >= threshold:
+                self._count = estimate
+                self.count_is_estimate = True
+                return self._count
+
+        count = self.order_by()[:threshold].exact_count()
+        if count < threshold:
+            self._count = count
         else:
-            self._count = super().count()
-
+            try:
+                estimate = self.estimated_count()
+            except DatabaseError:
+                estimate = None
+            self._count = max(estimate or 0, threshold)
+            self.count_is_estimate = True
         return self._count
 
 
@@ -262,10 +866,20 @@ class Dataset(models.Model):
     source_name = models.CharField(max_length=255, null=False, blank=False)
     source_url = models.URLField(max_length=2000, null=False, blank=False)
 
+    def _is_prefetched(self, related_name):
+        # Relations are prefetched by the metadata snapshot (`core.metadata`)
+        return related_name in getattr(self, '_prefetched_objects_cache', {})
+
     @property
     def tables(self):
         # By now we're ignoring version - just take the last one
         version = self.get_last_version()
+        if self._is_prefetched('table_set'):
+            return sorted(
+                (table for table in self.table_set.all()
+                 if version is not None and table.version_id == version.id),
+                key=lambda table: table.name,
+            )
         return self.table_set.filter(version=version).order_by('name')
 
     @property
@@ -273,9 +887,19 @@ class Dataset(models.Model):
         return self.get_last_version()
 
     def get_table(self, tablename):
+        if self._is_prefetched('table_set'):
+            for table in self.table_set.all():
+                if table.name == tablename:
+                    return table
+            raise Table.DoesNotExist(f'Table {tablename} does not exist')
         return Table.objects.for_dataset(self).named(tablename)
 
     def get_default_table(self):
+        if self._is_prefetched('table_set'):
+            for table in self.table_set.all():
+                if table.default:
+                    return table
+            raise Table.DoesNotExist('Default table does not exist')
         return Table.objects.for_dataset(self).default()
 
     def __str__(self):
@@ -288,6 +912,10 @@ class Dataset(models.Model):
         return table.get_model_declaration()
 
     def get_last_version(self):
+        if self._is_prefetched('version_set'):
+            versions = sorted(self.version_set.all(),
+                              key=lambda version: version.order)
+            return versions[-1] if versions else None
         return self.version_set.order_by('order').last()
 
 
@@ -330,6 +958,11 @@ class TableQuerySet(models.QuerySet):
     def named(self, name):
         return self.get(name=name)
 
+    def invalidate_cache(self):
+        """Start a new cache generation for these tables (see
+        `Table.invalidate_cache`)"""
+        return self.update(cache_generation=models.F('cache_generation') + 1)
+
 
 class Table(models.Model):
     objects = TableQuerySet.as_manager()
@@ -345,9 +978,15 @@ class Table(models.Model):
                            null=True, blank=True)
     search = ArrayField(models.CharField(max_length=63),
                         null=True, blank=True)
+    # Fields with person names: a normalized (and indexed) version of each
+    # one is created, used by `DynamicModelQuerySet.filter_name`
+    names = ArrayField(models.CharField(max_length=63),
+                       null=True, blank=True)
     version = models.ForeignKey(Version, on_delete=models.CASCADE,
                                 null=False, blank=False)
     import_date = models.DateTimeField(null=True, blank=True)
+    cache_generation = models.PositiveIntegerField(null=False, blank=True,
+                                                   default=0)
 
     def __str__(self):
         return ('{}.{}.{}'.
@@ -364,28 +1003,71 @@ class Table(models.Model):
     def fields(self):
         return self.field_set.all()
 
-    def get_model(self, cache=True):
-        if cache and self.id in DYNAMIC_MODEL_REGISTRY:
-            return DYNAMIC_MODEL_REGISTRY[self.id]
+    @property
+    def shadow_db_table(self):
+        return self.db_table + SHADOW_TABLE_SUFFIX
+
+    def invalidate_cache(self):
+        """Start a new cache generation, so cached responses aren't used
+
+        Needed when the table's data or metadata change (see `core.cache`).
+        """
+        Table.objects.filter(id=self.id).invalidate_cache()
+        self.refresh_from_db(fields=['cache_generation'])
 
+    def get_model(self, cache=True):
+        # The model is rebuilt if the table was imported again (or its
+        # metadata changed) after it was cached, so workers don't need to be
+        # restarted after an import
+        version = (self.import_date, self.cache_generation)
         # TODO: unregister the model in Django if already registered (self.id
         # in DYNAMIC_MODEL_REGISTRY and not cache)
         # TODO: may use Django's internal registry instead of
         # DYNAMIC_MODEL_REGISTRY
+        if not cache:
+            Model = self._create_model(db_table=self.db_table)
+            DYNAMIC_MODEL_REGISTRY.set(self.id, version, Model)
+            return Model
+        return DYNAMIC_MODEL_REGISTRY.get(
+            self.id,
+            version,
+            lambda: self._create_model(db_table=self.db_table),
+        )
+
+    def get_shadow_model(self):
+        """Return a model for the shadow table, used to import data
+
+        Its table and index names are changed so they don't conflict with the
+        ones currently in use (see `DynamicModelMixin.swap_table`). This
+        model is not registered in `DYNAMIC_MODEL_REGISTRY`.
+        """
+        return self._create_model(
+            db_table=self.shadow_db_table,
+            model_suffix='Next',
+            index_prefix=SHADOW_INDEX_PREFIX,
+        )
+
+    def _create_model(self, db_table, model_suffix='',
+                      index_prefix=INDEX_PREFIX):
         name = self.dataset.slug + '-' + self.name.replace('_', '-')
         model_name = ''.join([word.capitalize() for word in name.split('-')])
+        model_name += model_suffix
         fields = {field.name: field.field_class
                   for field in self.fields}
         fields['search_data'] = SearchVectorField(null=True)
         ordering = self.ordering or []
         filtering = self.filtering or []
         search = self.search or []
+        names = self.names or []
+        for field_name in names:
+            fields[normalized_fieldname(field_name)] = \
+                models.TextField(null=True)
         indexes = []
         # TODO: add has_choices fields also
         if ordering:
             indexes.append(
                 django_indexes.Index(
-                    name=make_index_name(name, 'order', ordering),
+                    name=make_index_name(name, 'order', ordering, index_prefix),
                     fields=ordering,
                 )
             )
@@ -395,17 +1077,25 @@ class Table(models.Model):
                     continue
                 indexes.append(
                     django_indexes.Index(
-                        name=make_index_name(name, 'filter', [field_name]),
+                        name=make_index_name(name, 'filter', [field_name], index_prefix),
                         fields=[field_name]
                     )
                 )
         if search:
             indexes.append(
                 pg_indexes.GinIndex(
-                    name=make_index_name(name, 'search', ['search_data']),
+                    name=make_index_name(name, 'search', ['search_data'], index_prefix),
                     fields=['search_data']
                 )
             )
+        for field_name in names:
+            column = normalized_fieldname(field_name)
+            indexes.append(
+                django_indexes.Index(
+                    name=make_index_name(name, 'name', [column], index_prefix),
+                    fields=[column],
+                )
+            )
 
         Options = type(
             'Meta',
@@ -413,7 +1103,7 @@ class Table(models.Model):
             {
                 'ordering': ordering,
                 'indexes': indexes,
-                'db_table': self.db_table,
+                'db_table': db_table,
             },
         )
         Model = type(
@@ -428,16 +1118,162 @@ class Table(models.Model):
         )
         Model.extra = {
             'filtering': filtering,
+            'names': names,
             'ordering': ordering,
             'search': search,
         }
-        DYNAMIC_MODEL_REGISTRY[self.id] = Model
+        Model.import_date = self.import_date
+        Model.cache_generation = self.cache_generation
         return Model
 
     def get_model_declaration(self):
         Model = self.get_model()
         return model_to_code(Model)
 
+    def snapshot_filename(self, compression):
+        """Snapshot filename for the current cache generation
+
+        Metadata changes (like obfuscating or hiding fields) start a new
+        cache generation (see `invalidate_cache`), so snapshots written
+        before them are not used.
+        """
+        return os.path.join(
+            settings.MEDIA_ROOT,
+            'snapshots',
+            self.dataset.slug,
+            f'{self.name}.{self.cache_generation}.csv.{compression}',
+        )
+
+    def get_snapshot_filename(self, compression):
+        """Return the snapshot filename if it's up-to-date, else `None`"""
+        filename = self.snapshot_filename(compression)
+        if not os.path.exists(filename) or self.import_date is None:
+            return None
+        elif os.stat(filename).st_mtime < self.import_date.timestamp():
+            return None
+        return filename
+
+    def snapshot_compressions(self):
+        """Compressions of the up-to-date snapshots"""
+        return [compression for compression in SNAPSHOT_COMPRESSIONS
+                if self.get_snapshot_filename(compression) is not None]
+
+    def write_snapshots(self):
+        """Export the whole table to compressed CSV files (one per compression)
+
+        Uses the same rules as the CSV export (see
+        `DynamicModelQuerySet.export_sql`) and runs the query only once. Files
+        are written to temporary names and then renamed; snapshots of other
+        cache generations are deleted after that.
+        """
+        Model = self.get_model()
+        sql = Model.objects.all().export_sql(list(self.fields))
+        filenames, fobjs = [], []
+        for compression, open_function in SNAPSHOT_COMPRESSIONS.items():
+            filename = self.snapshot_filename(compression)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            filenames.append(filename)
+            fobjs.append(open_function(filename + '.tmp', mode='wb'))
+        try:
+            copy_to_files(sql, fobjs)
+        except Exception:
+            for fobj, filename in zip(fobjs, filenames):
+                fobj.close()
+                os.unlink(filename + '.tmp')
+            raise
+        for fobj, filename in zip(fobjs, filenames):
+            fobj.close()
+            os.replace(filename + '.tmp', filename)
+        self.delete_snapshots(keep=filenames)
+        return filenames
+
+    def delete_snapshots(self, keep=()):
+        """Delete the table's snapshots (except the files in `keep`)"""
+        path = os.path.dirname(self.snapshot_filename('gz'))
+        if not os.path.exists(path):
+            return
+        for filename in os.listdir(path):
+            filename = os.path.join(path, filename)
+            if filename.startswith(os.path.join(path, self.name + '.')) and \
+                    filename.split('.csv.')[-1] in SNAPSHOT_COMPRESSIONS and \
+                    filename not in keep:
+                os.unlink(filename)
+
+    def update_choices(self):
+        """Update facets and `choices` for all choiceable fields at once
+
+        Unlike calling `Field.update_choices` for each field, this method
+        scans the table only once (to build the facet table). Returns the
+        updated fields.
+        """
+        fields = list(Field.objects.for_table(self).choiceables())
+        if not fields:
+            return []
+
+        Model = self.get_model()
+        Model.create_facet_table([field.name for field in fields])
+        for field in fields:
+            field.choices = {'data': Model.facet_values(field.name)}
+            field.save()
+        return fields
+
+    def get_facets(self, fieldname, querystring=None, limit=FACETS_LIMIT,
+                   prefix=None):
+        """Return the most common (value, count) of `fieldname`
+
+        Filters on `fieldname` itself are ignored. Without other filters the
+        values come from the facet table (built on import). Counts for
+        filtered querysets are aggregated once and then cached in the shared
+        cache - the cache key has `import_date` and `cache_generation`, so a
+        new import invalidates it. Filters matching
+        `settings.EXACT_COUNT_THRESHOLD` rows or more are not aggregated (it
+        would be as slow as a full scan): the unfiltered counts are used.
+        """
+        Model = self.get_model()
+        filters = normalize_querystring(
+            querystring,
+            ignore=PAGINATION_KEYS + ('order-by', fieldname),
+        )
+        if not filters:
+            if Model.has_facet_table():
+                return Model.facets(fieldname, limit=limit, prefix=prefix)
+            # Not imported with facets yet: use the stored choices (no counts)
+            for field in self.fields:
+                if field.name == fieldname:
+                    break
+            values = (field.choices or {}).get('data', [])
+            if prefix:
+                values = [value for value in values if value.startswith(prefix)]
+            return [(value, None) for value in values[:limit]]
+
+        key = hashlib.md5(
+            repr((fieldname, filters, limit, prefix)).encode('utf-8')
+        ).hexdigest()
+        import_date = self.import_date.timestamp() if self.import_date else ''
+        cache_key = (f'facets:{self.id}:{self.cache_generation}:'
+                     f'{import_date}:{key}')
+        cache = caches[FACETS_CACHE_ALIAS]
+        facets = cache.get(cache_key)
+        if facets is None:
+            querystring = querystring.copy()
+            querystring.pop(fieldname, None)
+            queryset = Model.objects.filter_by_querystring(querystring)
+            threshold = settings.EXACT_COUNT_THRESHOLD
+            if queryset.order_by()[:threshold].exact_count() >= threshold:
+                facets = self.get_facets(fieldname, limit=limit, prefix=prefix)
+            else:
+                if prefix:
+                    queryset = queryset.filter(
+                        **{f'{fieldname}__startswith': prefix}
+                    )
+                queryset = queryset.order_by()\
+                                   .values_list(fieldname)\
+                                   .annotate(count=models.Count('*'))\
+                                   .order_by('-count', fieldname)[:limit]
+                facets = [(str(value), count) for value, count in queryset]
+            cache.set(cache_key, facets, FACETS_CACHE_TIMEOUT)
+        return facets
+
 
 class FieldQuerySet(models.QuerySet):
 
@@ -503,3 +1339,229 @@ class Field(models.Model):
                                .distinct(self.name)\
                                .values_list(self.name, flat=True)
         self.choices = {'data': [str(value) for value in choices]}
+
+
+class MetadataVersion(models.Model):
+    """Counter incremented when metadata changes (see `core.metadata`)"""
+
+    version = models.PositiveIntegerField(null=False, blank=False, default=0)
+
+    @classmethod
+    def current(cls):
+        return cls.objects.filter(id=1).values_list('version', flat=True)\
+                                       .first() or 0
+
+    @classmethod
+    def bump(cls):
+        updated = cls.objects.filter(id=1)\
+                             .update(version=models.F('version') + 1)
+        if not updated:
+            cls.objects.get_or_create(id=1, defaults={'version': 1})
+
+
+class ResponseCacheStats(models.Model):
+    """Hit/miss counters of the shared response cache (see `core.cache`)"""
+
+    hits = models.BigIntegerField(null=False, blank=False, default=0)
+    misses = models.BigIntegerField(null=False, blank=False, default=0)
+
+    @classmethod
+    def current(cls):
+        return cls.objects.filter(id=1).values('hits', 'misses').first() or \
+            {'hits': 0, 'misses': 0}
+
+    @classmethod
+    def add(cls, hits, misses):
+        updated = cls.objects.filter(id=1).update(
+            hits=models.F('hits') + hits,
+            misses=models.F('misses') + misses,
+        )
+        if not updated:
+            _, created = cls.objects.get_or_create(
+                id=1, defaults={'hits': hits, 'misses': misses},
+            )
+            if not created:  # Created by another process meanwhile
+                cls.add(hits, misses)
+
+    @classmethod
+    def reset(cls):
+        cls.objects.filter(id=1).update(hits=0, misses=0)
+
+
+class DocumentProfileSection(models.Model):
+    """A section of the document pages, precomputed for all documents in a
+    side table (see `core.document_profile`)
+
+    `import_dates` has the import date (in ISO format) of each table used by
+    the section when it was built - it's stale after any of them is imported
+    again.
+    """
+
+    name = models.CharField(max_length=63, null=False, blank=False,
+                            unique=True)
+    import_dates = JSONField(null=False, blank=False)
+    built_at = models.DateTimeField(null=False, blank=False)
+
+    def __str__(self):
+        return self.name
+
+
+class ExportJobQuerySet(models.QuerySet):
+
+    def pending(self):
+        return self.filter(status=ExportJob.STATUS_PENDING)
+
+    def stale(self):
+        """Running jobs started more than `settings.EXPORT_JOB_TIMEOUT`
+        seconds ago (their worker probably died)"""
+        started_before = timezone.now() - \
+            timedelta(seconds=settings.EXPORT_JOB_TIMEOUT)
+        return self.filter(status=ExportJob.STATUS_RUNNING,
+                           started_at__lt=started_before)
+
+    def fail_stale(self):
+        """Mark stale jobs as failed, so they're submitted again"""
+        return self.stale().update(
+            status=ExportJob.STATUS_FAILED,
+            error='Export did not finish in time.',
+            finished_at=timezone.now(),
+        )
+
+    def expired(self):
+        """Finished or failed jobs older than `settings.EXPORT_MAX_AGE` days
+        or for a previous import or cache generation of their table
+        (superseded)"""
+        finished_before = timezone.now() - \
+            timedelta(days=settings.EXPORT_MAX_AGE)
+        return self.filter(
+            status__in=(ExportJob.STATUS_FINISHED, ExportJob.STATUS_FAILED),
+        ).filter(
+            Q(finished_at__lt=finished_before) |
+            ~Q(import_date=F('table__import_date')) |
+            ~Q(cache_generation=F('table__cache_generation'))
+        )
+
+    def clean_up(self):
+        """Delete expired jobs and their files - returns how many"""
+        deleted = 0
+        for job in self.expired().iterator():
+            job.delete_file()
+            job.delete()
+            deleted += 1
+        return deleted
+
+    def claim_next(self):
+        """Mark the oldest pending job as running and return it (or `None`)
+
+        Uses `SELECT ... FOR UPDATE SKIP LOCKED` so many workers can claim
+        jobs at the same time without getting the same one.
+        """
+        with transaction.atomic():
+            job = self.pending()\
+                      .select_for_update(skip_locked=True)\
+                      .order_by('created_at')\
+                      .first()
+            if job is not None:
+                job.status = ExportJob.STATUS_RUNNING
+                job.started_at = timezone.now()
+                job.save()
+        return job
+
+    def submit(self, table, querystring):
+        """Return the job for this table/querystring/table version
+
+        A new job is created only if there's no job for the same request
+        (failed and stale jobs are submitted again). The table version is its
+        import date and cache generation, so metadata changes (like
+        obfuscating a field) need new exports.
+        """
+        lookup = {
+            'table': table,
+            'querystring': urlencode(normalize_querystring(querystring)),
+            'import_date': table.import_date,
+            'cache_generation': table.cache_generation,
+        }
+        job, created = self.filter(**lookup).order_by('id').first(), False
+        if job is None:
+            try:
+                with transaction.atomic():
+                    job, created = self.create(**lookup), True
+            except IntegrityError:  # Created by a concurrent request
+                job = self.filter(**lookup).order_by('id').first()
+        if not created and job.status == ExportJob.STATUS_RUNNING and \
+                ExportJob.objects.stale().filter(id=job.id).exists():
+            job.status = ExportJob.STATUS_FAILED
+        if not created and job.status == ExportJob.STATUS_FAILED:
+            job.status = ExportJob.STATUS_PENDING
+            job.error = None
+            job.save()
+        return job
+
+
+class ExportJob(models.Model):
+    objects = ExportJobQuerySet.as_manager()
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_FINISHED = 'finished'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (value, value)
+        for value in (STATUS_PENDING, STATUS_RUNNING, STATUS_FINISHED,
+                      STATUS_FAILED)
+    ]
+
+    table = models.ForeignKey(Table, on_delete=models.CASCADE,
+                              null=False, blank=False)
+    querystring = models.TextField(null=False, blank=True)
+    import_date = models.DateTimeField(null=True, blank=True)
+    cache_generation = models.PositiveIntegerField(null=False, blank=True,
+                                                   default=0)
+    status = models.CharField(max_length=15, choices=STATUS_CHOICES,
+                              null=False, blank=False, default=STATUS_PENDING)
+    filename = models.CharField(max_length=255, null=True, blank=True)
+    size = models.BigIntegerField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = [('table', 'querystring', 'import_date',
+                            'cache_generation')]
+
+    def __str__(self):
+        return '{} ?{} ({})'.format(self.table, self.querystring, self.status)
+
+    @property
+    def path(self):
+        return os.path.join(settings.MEDIA_ROOT, self.filename)
+
+    def delete_file(self):
+        if self.filename and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def run(self):
+        """Export the filtered table to a gzipped CSV and update the job"""
+        Model = self.table.get_model()
+        querystring = QueryDict(self.querystring, mutable=True)
+        queryset = Model.objects.filter_by_querystring(querystring)
+        self.filename = os.path.join(
+            'exports',
+            f'{self.table.dataset.slug}-{self.table.name}-{self.id}.csv.gz',
+        )
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            with gzip.open(self.path + '.tmp', mode='wb') as fobj:
+                copy_to_files(queryset.export_sql(list(self.table.fields)), [fobj])
+            os.replace(self.path + '.tmp', self.path)
+        except Exception as exception:
+            if os.path.exists(self.path + '.tmp'):
+                os.unlink(self.path + '.tmp')
+            self.status = self.STATUS_FAILED
+            self.error = str(exception)
+        else:
+            self.status = self.STATUS_FINISHED
+            self.size = os.path.getsize(self.path)
+        self.finished_at = timezone.now()
+        self.save()
@@ -0,0 +1,260 @@
+import base64
+import datetime
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """Keep microseconds (`DjangoJSONEncoder` truncates them to
+    milliseconds, so rows at page boundaries would be skipped or repeated)"""
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super().default(o)
+
+
+def encode_cursor(values, position, reverse=False):
+    data = json.dumps([values, position, reverse], cls=CursorEncoder)
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Return `(values, position, reverse)` from an encoded cursor
+
+    Raises `ValueError` if the cursor is invalid.
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        values, position, reverse = json.loads(data.decode('utf-8'))
+    except (TypeError, ValueError):  # binascii.Error is a ValueError
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or not isinstance(position, int):
+        raise ValueError('Invalid cursor')
+    return values, position, bool(reverse)
+
+
+class KeysetPage:
+    """A page of rows with cursors to the next and previous pages
+
+    Has the same interface as Django's `Page` used by templates (except for
+    page numbers, replaced by `next_cursor` and `previous_cursor`).
+    """
+
+    def __init__(self, object_list, position, has_next, has_previous,
+                 next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.position = position
+        self.next_cursor = next_cursor if has_next else None
+        self.previous_cursor = previous_cursor if has_previous else None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def start_index(self):
+        return self.position + 1 if self.object_list else 0
+
+    def end_index(self):
+        return self.position + len(self.object_list)
+
+
+class StreamingKeysetPage:
+    """A `KeysetPage` whose rows are fetched while being iterated
+
+    Rows come from a server-side cursor (`QuerySet.iterator`), so memory
+    usage does not depend on the page size. The cursors are only available
+    after the rows are consumed.
+    """
+
+    def __init__(self, paginator, queryset, limit, position, reverse,
+                 has_next, has_previous, chunk_size):
+        self.paginator = paginator
+        self.queryset = queryset
+        self.limit = limit
+        self.position = position
+        self.reverse = reverse
+        self._has_next = has_next
+        self._has_previous = has_previous
+        self.chunk_size = chunk_size
+        self.first_row_key = self.last_row_key = None
+        self.length = 0
+        self.consumed = False
+
+    def __iter__(self):
+        row_key = self.paginator._row_key
+        for row in self.queryset[:self.limit + 1].iterator(chunk_size=self.chunk_size):
+            if self.length == self.limit:  # There's one more row
+                if not self.reverse:
+                    self._has_next = True
+                break
+            if self.length == 0:
+                self.first_row_key = row_key(row)
+            self.last_row_key = row_key(row)
+            self.length += 1
+            yield row
+        self.consumed = True
+
+    def _check_consumed(self):
+        if not self.consumed:
+            raise RuntimeError('Page rows must be consumed before reading cursors')
+
+    @property
+    def next_cursor(self):
+        self._check_consumed()
+        if not self._has_next or self.length == 0:
+            return None
+        return encode_cursor(self.last_row_key, self.position + self.length)
+
+    @property
+    def previous_cursor(self):
+        self._check_consumed()
+        if not self._has_previous or self.length == 0:
+            return None
+        return encode_cursor(
+            self.first_row_key,
+            max(self.position - self.paginator.per_page, 0),
+            reverse=True,
+        )
+
+
+class KeysetPaginator:
+    """Paginate a `DynamicModelQuerySet` using keyset (seek) pagination
+
+    Cursors hold the ordering values of the first/last row of the current
+    page (see `DynamicModelQuerySet.seek`), so any page costs one index seek
+    instead of an `OFFSET`. `queryset` rows may be model instances or dicts
+    (in this case they must have the ordering fields).
+    """
+
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = [fieldname.lstrip('-')
+                         for fieldname in queryset.keyset_ordering()]
+
+    def _decode_cursor(self, cursor):
+        """Return `decode_cursor(cursor)` with values converted by their
+        fields (e.g. datetimes were encoded as strings)"""
+        values, position, reverse = decode_cursor(cursor)
+        if len(values) != len(self.ordering):
+            raise ValueError('Invalid cursor')
+        model_meta = self.queryset.model._meta
+        converted = []
+        for fieldname, value in zip(self.ordering, values):
+            try:
+                field = model_meta.get_field(fieldname)
+            except FieldDoesNotExist:
+                pass
+            else:
+                if value is not None:
+                    try:
+                        value = field.to_python(value)
+                    except ValidationError:
+                        raise ValueError('Invalid cursor')
+            converted.append(value)
+        return converted, position, reverse
+
+    def _row_key(self, row):
+        if isinstance(row, dict):
+            return [row[fieldname] for fieldname in self.ordering]
+        return [getattr(row, fieldname) for fieldname in self.ordering]
+
+    def get_page(self, cursor=None):
+        """Return the `KeysetPage` for `cursor` (first page if `None`)
+
+        Raises `ValueError` if the cursor is invalid.
+        """
+        if cursor:
+            values, position, reverse = self._decode_cursor(cursor)
+            queryset = self.queryset.seek(values, reverse=reverse)
+        else:
+            position, reverse = 0, False
+            queryset = self.queryset.order_by(*self.queryset.keyset_ordering())
+
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if reverse:
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, bool(cursor)
+
+        next_cursor = previous_cursor = None
+        if rows:
+            next_cursor = encode_cursor(
+                self._row_key(rows[-1]),
+                position + len(rows),
+            )
+            previous_cursor = encode_cursor(
+                self._row_key(rows[0]),
+                max(position - self.per_page, 0),
+                reverse=True,
+            )
+        return KeysetPage(rows, position, has_next, has_previous,
+                          next_cursor, previous_cursor)
+
+    def first_page(self, rows, has_next):
+        """Return the first `KeysetPage` for already fetched `rows`
+
+        `rows` must be the first `per_page` rows (at most) of the queryset,
+        e.g. read from a cache.
+        """
+        next_cursor = None
+        if rows:
+            next_cursor = encode_cursor(self._row_key(rows[-1]), len(rows))
+        return KeysetPage(rows, 0, has_next, False, next_cursor, None)
+
+    def stream_page(self, cursor=None, chunk_size=2000):
+        """Return the `StreamingKeysetPage` for `cursor` (first if `None`)
+
+        Pages before a cursor (reverse) first fetch only the ordering values
+        of their rows, so they can be streamed in the right order.
+
+        Raises `ValueError` if the cursor is invalid.
+        """
+        ordering = self.queryset.keyset_ordering()
+        if not cursor:
+            return StreamingKeysetPage(
+                self, self.queryset.order_by(*ordering), self.per_page,
+                position=0, reverse=False, has_next=False, has_previous=False,
+                chunk_size=chunk_size,
+            )
+
+        values, position, reverse = self._decode_cursor(cursor)
+        if not reverse:
+            return StreamingKeysetPage(
+                self, self.queryset.seek(values), self.per_page,
+                position=position, reverse=False, has_next=False,
+                has_previous=True, chunk_size=chunk_size,
+            )
+
+        keys = list(self.queryset.seek(values, reverse=True)
+                                 .values_list(*self.ordering)
+                                 [:self.per_page + 1])
+        if len(keys) > self.per_page:
+            # Start right after the row before this page
+            queryset = self.queryset.seek(list(keys[self.per_page]))
+            has_previous = True
+        else:
+            queryset = self.queryset.order_by(*ordering)
+            has_previous = False
+        return StreamingKeysetPage(
+            self, queryset, min(len(keys), self.per_page),
+            position=position, reverse=True, has_next=True,
+            has_previous=has_previous, chunk_size=chunk_size,
+        )
@@ -1,3 +1,650 @@
-from django.test import TestCase
+import datetime
+import io
+import os
+import random
+import tempfile
+import threading
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.admin.sites import AdminSite
+from django.core.cache import caches
+from django.db.models import F
+from django.http import HttpResponse, QueryDict
+from django.test import (RequestFactory, SimpleTestCase, TestCase,
+                         override_settings)
+from django.utils import timezone
+
+from api.serializers import make_row_serializer
+from api.views import TABLE_METADATA_CACHE, TableMetadata, get_table_metadata
+from core import cache as response_cache
+from core.admin import FieldAdmin, TableAdmin
+from core.cache import cache_table_response
+from core.document_profile import (Section, get_stored_page, is_headquarter,
+                                   profile_key, section_sql)
+from core.paginators import KeysetPaginator, decode_cursor, encode_cursor
+from core.util import count_csv_records, csv_chunks
+from core.views import exceeds_export_limit, max_export_rows
+from core.models import (Dataset, DynamicModelQuerySet, ExportJob, Field,
+                         MetadataVersion, ResponseCacheStats, Table, Version)
+from utils.db import call_concurrently
+from utils.registry import Registry
+from utils.text import (NAME_TRANSLATE_FROM, NAME_TRANSLATE_TO,
+                        normalize_name, unaccent)
+
+
+THREADS = 32
+ITERATIONS = 200
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'responses': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                  'LOCATION': 'responses-tests'},
+}
+
+
+def run_concurrently(function, threads=THREADS):
+    """Call `function(thread_number)` in many threads started together
+
+    Returns the exceptions raised.
+    """
+    barrier = threading.Barrier(threads)
+    errors = []
+
+    def worker(number):
+        barrier.wait()
+        try:
+            function(number)
+        except Exception as exception:
+            errors.append(exception)
+
+    workers = [threading.Thread(target=worker, args=(number, ))
+               for number in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return errors
+
+
+def make_table(number, import_date=None):
+    """Create an unsaved table (with its fields) which needs no database"""
+    table_id = 9000 + number
+    dataset = Dataset(id=table_id, slug=f'stress-{number}', name=f'Stress {number}')
+    version = Version(id=table_id, dataset=dataset, name='2018', order=1)
+    table = Table(id=table_id, dataset=dataset, version=version,
+                  name=f'table{number}', default=True, ordering=['id'],
+                  filtering=[], search=[], import_date=import_date)
+    # Each table has a different set of fields
+    fields = [
+        Field(id=table_id * 100 + index, dataset=dataset, table=table,
+              name=f't{number}_f{index}', title=f'Field {index}',
+              type='integer' if index % 2 else 'text', order=index,
+              show=True, obfuscate=False)
+        for index in range(number % 5 + 2)
+    ]
+    table._prefetched_objects_cache = {'field_set': fields}
+    return table
+
+
+def fieldnames(table):
+    return sorted(field.name for field in table.fields)
+
+
+class RegistryTests(SimpleTestCase):
+
+    def test_builds_once_per_key(self):
+        registry = Registry()
+        builds = []
+
+        def build(key):
+            builds.append(key)
+            return ('value', key)
+
+        def worker(number):
+            for iteration in range(ITERATIONS):
+                key = (number + iteration) % 8
+                value = registry.get(key, 1, lambda: build(key))
+                assert value == ('value', key)
+
+        assert run_concurrently(worker) == []
+        assert sorted(builds) == list(range(8))
+
+    def test_returns_requested_version(self):
+        registry = Registry()
+
+        def worker(number):
+            for iteration in range(ITERATIONS):
+                key = iteration % 4
+                version = (number + iteration) % 3
+                value = registry.get(key, version, lambda: (key, version))
+                assert value == (key, version)
+
+        assert run_concurrently(worker) == []
+
+
+class DynamicModelConcurrencyTests(SimpleTestCase):
+
+    def test_get_model(self):
+        tables = [make_table(number) for number in range(8)]
+        models = {table.id: set() for table in tables}
+
+        def worker(number):
+            for _ in range(ITERATIONS):
+                table = random.choice(tables)
+                Model = table.get_model()
+                models[table.id].add(Model)
+                assert Model._meta.db_table == table.db_table
+                assert sorted(field.name for field in Model._meta.fields
+                              if field.name not in ('id', 'search_data')) == \
+                    fieldnames(table)
+
+        assert run_concurrently(worker) == []
+        # Only one model is created for each table
+        assert all(len(created) == 1 for created in models.values())
+
+    def test_get_model_after_import(self):
+        old_date = timezone.make_aware(datetime.datetime(2018, 1, 1))
+        new_date = timezone.make_aware(datetime.datetime(2018, 2, 1))
+        tables = [make_table(20, import_date=old_date),
+                  make_table(20, import_date=new_date)]
+
+        def worker(number):
+            for iteration in range(ITERATIONS):
+                table = tables[(number + iteration) % 2]
+                assert table.get_model().import_date == table.import_date
+
+        assert run_concurrently(worker) == []
+
+
+class SerializerConcurrencyTests(SimpleTestCase):
+
+    def test_row_serializers(self):
+        tables = [make_table(number) for number in range(30, 38)]
+        serializers = {
+            table.id: make_row_serializer(table.fields, table.get_model())
+            for table in tables
+        }
+
+        def worker(number):
+            for iteration in range(ITERATIONS):
+                table = random.choice(tables)
+                row = {name: iteration for name in fieldnames(table)}
+                data = serializers[table.id](row).data
+                assert sorted(data.keys()) == fieldnames(table)
+
+        assert run_concurrently(worker) == []
+
+    def test_table_metadata_registry(self):
+        registry = Registry()
+        tables = [make_table(number) for number in range(40, 48)]
+
+        def worker(number):
+            for iteration in range(ITERATIONS):
+                table = random.choice(tables)
+                metadata = registry.get(
+                    table.id,
+                    (table.import_date, table.cache_generation),
+                    lambda: TableMetadata(table),
+                )
+                assert metadata.table is table
+                assert list(metadata.fieldnames) == fieldnames(table)
+                row = {name: iteration for name in metadata.fieldnames}
+                data = metadata.serializer_class(row).data
+                assert sorted(data.keys()) == fieldnames(table)
+
+        assert run_concurrently(worker) == []
+
+
+class DocumentProfileTests(SimpleTestCase):
+
+    def test_profile_key(self):
+        assert profile_key('12345678000195') == '12345678'
+        assert profile_key('12345678901') == '12345678901'
+        assert is_headquarter('12345678000195')
+        assert not is_headquarter('12345678000276')
+
+    def test_section_sql(self):
+        table = make_table(50)
+        Model = table.get_model()
+        documents = Model.objects.annotate(profile_key=F('t50_f0'),
+                                           profile_match=F('t50_f0'))\
+                                 .values('profile_key', 'profile_match')
+
+        queryset = Model.objects.order_by('-t50_f1')
+        sql, params = section_sql(table, queryset, F('t50_f0'), documents,
+                                  'target', limit=100)
+        assert sql.startswith('INSERT INTO target (key, count, rows)')
+        assert 'PARTITION BY profile_key ORDER BY "t50_f1" DESC, "id"' in sql
+        assert 'GROUP BY profile_key' in sql
+        assert 'DISTINCT ON' not in sql
+        assert params == [100]
+
+        # People's companies are distinct per document
+        queryset = Model.objects.distinct('t50_f0', 't50_f1')\
+                                .order_by('t50_f0', 't50_f1')
+        sql, _ = section_sql(table, queryset, F('t50_f0'), documents,
+                             'target', limit=100)
+        assert 'DISTINCT ON (documents.profile_key, source."t50_f0", ' \
+               'source."t50_f1")' in sql
+        assert 'PARTITION BY profile_key ORDER BY "t50_f0", "t50_f1"\n' in sql
+
+    def test_section_from_json(self):
+        table = make_table(51)
+        table._prefetched_objects_cache['field_set'] += [
+            Field(id=905190, dataset=table.dataset, table=table,
+                  name='t51_date', title='Date', type='date', order=90,
+                  show=True, obfuscate=False),
+            Field(id=905191, dataset=table.dataset, table=table,
+                  name='t51_value', title='Value', type='decimal', order=91,
+                  show=True, obfuscate=False,
+                  options={'max_digits': 12, 'decimal_places': 2}),
+        ]
+        rows = '[{"id": 1, "t51_date": "2018-10-01", "t51_value": 0.10}, ' \
+               '{"id": 2, "t51_date": null, "t51_value": 1234.56}]'
+
+        section = Section.from_json(table, rows, count=5)
+        assert list(section) == [
+            {'id': 1, 't51_date': datetime.date(2018, 10, 1),
+             't51_value': Decimal('0.10')},
+            {'id': 2, 't51_date': None, 't51_value': Decimal('1234.56')},
+        ]
+        assert section.is_truncated
+
+
+class SectionPaginationTests(SimpleTestCase):
+
+    def test_keyset_ordering_with_distinct(self):
+        Model = make_table(60).get_model()
+        queryset = Model.objects.order_by('t60_f0')
+        assert queryset.keyset_ordering() == ['t60_f0', 'id']
+        # DISTINCT ON fields are unique, so `id` is not needed
+        queryset = Model.objects.distinct('t60_f0', 't60_f1')\
+                                .order_by('t60_f0', 't60_f1')
+        assert queryset.keyset_ordering() == ['t60_f0', 't60_f1']
+        queryset = Model.objects.distinct('t60_f0', 't60_f1')\
+                                .order_by('t60_f0')
+        assert queryset.keyset_ordering() == ['t60_f0', 'id']
+
+    def test_first_page_from_stored_rows(self):
+        Model = make_table(61).get_model()
+        paginator = KeysetPaginator(Model.objects.order_by('-t61_f1'), 2)
+        rows = [{'t61_f1': 10, 'id': 3}, {'t61_f1': 7, 'id': 1}]
+
+        page = paginator.first_page(rows, has_next=True)
+        assert list(page) == rows
+        assert page.has_next()
+        assert not page.has_previous()
+        assert decode_cursor(page.next_cursor) == ([7, 1], 2, False)
+
+        page = paginator.first_page([], has_next=False)
+        assert not page.has_next()
+
+    def test_first_page_from_stored_section(self):
+        table = make_table(62)
+        queries = {
+            'applications': (table,
+                             table.get_model().objects.order_by('-t62_f1')),
+        }
+        obj = {'document': '12345678901', 'name': 'Ana'}
+
+        def stored_page(section):
+            with mock.patch('core.document_profile.section_queries',
+                            return_value=queries), \
+                    mock.patch('core.document_profile.get_stored_section',
+                               return_value=section):
+                return get_stored_page('applications', obj, per_page=2)
+
+        rows = [{'t62_f0': 'a', 't62_f1': 10, 'id': 3}]
+        page, count = stored_page(Section(table, rows, 5))
+        assert count == 5
+        assert list(page) == rows
+        assert page.has_next()
+        # Stale sections and rows without the ordering fields are queried
+        assert stored_page(None) is None
+        assert stored_page(Section(table, [{'t62_f0': 'a'}], 5)) is None
+
+    def test_cursor_keeps_microseconds(self):
+        table = make_table(85)
+        table._prefetched_objects_cache['field_set'].append(Field(
+            id=908599, dataset=table.dataset, table=table, name='t85_date',
+            title='Date', type='datetime', order=99, show=True, obfuscate=False,
+        ))
+        Model = table.get_model()
+        paginator = KeysetPaginator(Model.objects.order_by('-t85_date'), 2)
+        value = timezone.make_aware(datetime.datetime(2020, 1, 1, 1, 1, 1, 123456))
+
+        cursor = encode_cursor([value, 3], 2)
+        assert decode_cursor(cursor)[0] == ['2020-01-01T01:01:01.123456+00:00', 3]
+        assert paginator._decode_cursor(cursor) == ([value, 3], 2, False)
+        with self.assertRaises(ValueError):
+            paginator._decode_cursor(encode_cursor(['not a date', 3], 2))
+
+
+class NormalizedNameTests(SimpleTestCase):
+
+    def test_normalize_name(self):
+        assert normalize_name('  José\tda   Conceição ') == 'JOSE DA CONCEICAO'
+        assert normalize_name('ANDRÉ\u00a0MÜLLER') == 'ANDRE MULLER'
+        assert normalize_name('Jose da Conceicao') == \
+            normalize_name('JOSÉ DA CONCEIÇÃO')
+
+    def test_translation_matches_unaccent(self):
+        # The same mapping is used by the SQL function (`NormalizeName`)
+        assert len(NAME_TRANSLATE_FROM) >= len(NAME_TRANSLATE_TO)
+        for char, ascii_char in zip(NAME_TRANSLATE_FROM, NAME_TRANSLATE_TO):
+            assert unaccent(char) == ascii_char
+        for char in NAME_TRANSLATE_FROM[len(NAME_TRANSLATE_TO):]:
+            assert unaccent(char) == ''
+        assert "'" not in NAME_TRANSLATE_FROM + NAME_TRANSLATE_TO
+
+    def test_filter_name(self):
+        table = make_table(82)
+        table.names = ['t82_f0']
+        Model = table.get_model()
+        assert 't82_f0_normalized' in [field.name for field in Model._meta.fields]
+        assert 't82_f0_normalized' in Model.computed_columns()
+
+        where = Model.objects.filter_name('t82_f0', 'Ana  Müller').query.where
+        lookup = where.children[0]
+        assert lookup.lhs.target.name == 't82_f0_normalized'
+        assert lookup.rhs == 'ANA MULLER'
+
+        # Fields not in `Table.names` are compared with the unaccented name
+        where = Model.objects.filter_name('t82_f2', 'Ana Müller').query.where
+        lookup = where.children[0]
+        assert lookup.lhs.target.name == 't82_f2'
+        assert lookup.rhs == 'Ana Muller'
+
+
+class CallConcurrentlyTests(SimpleTestCase):
+
+    def test_functions_run_at_the_same_time(self):
+        # Would raise `BrokenBarrierError` if functions ran one at a time
+        barrier = threading.Barrier(4, timeout=5)
+
+        def function(number):
+            barrier.wait()
+            return number * 2
+
+        functions = {number: lambda number=number: function(number)
+                     for number in range(4)}
+        results = call_concurrently(functions, workers=4)
+        assert results == {0: 0, 1: 2, 2: 4, 3: 6}
+
+    def test_exceptions_are_returned(self):
+        def fail():
+            raise ValueError('failed')
+
+        results = call_concurrently({'ok': lambda: 1, 'fail': fail},
+                                    workers=2)
+        assert results['ok'] == 1
+        assert isinstance(results['fail'], ValueError)
+
+
+class FacetTests(SimpleTestCase):
+
+    def test_facets_without_facet_table(self):
+        table = make_table(83)
+        field = table.fields[0]
+        field.choices = {'data': ['AC', 'AL', 'AM', 'BA']}
+        Model = table.get_model()
+        Model._has_facet_table = False  # Not imported with facets yet
+
+        assert table.get_facets(field.name) == \
+            [('AC', None), ('AL', None), ('AM', None), ('BA', None)]
+        assert table.get_facets(field.name, limit=2) == [('AC', None), ('AL', None)]
+        assert table.get_facets(field.name, prefix='A', limit=2) == \
+            [('AC', None), ('AL', None)]
+        assert table.get_facets(field.name, prefix='B') == [('BA', None)]
+
+    @override_settings(CACHES=LOCMEM_CACHES, EXACT_COUNT_THRESHOLD=1000)
+    def test_big_filtered_facets_use_unfiltered_counts(self):
+        table = make_table(87)
+        field = table.fields[0]
+        field.choices = {'data': ['AC', 'BA']}
+        table.get_model()._has_facet_table = False
+        querystring = QueryDict('t87_f1=1')
+
+        with mock.patch.object(DynamicModelQuerySet, 'exact_count',
+                               return_value=1000) as exact_count:
+            for _ in range(2):
+                assert table.get_facets(field.name, querystring) == \
+                    [('AC', None), ('BA', None)]
+            # Not aggregated and counted only once (then cached)
+            assert exact_count.call_count == 1
+            # in the shared cache
+            caches['responses'].clear()
+            table.get_facets(field.name, querystring)
+            assert exact_count.call_count == 2
+
+
+class CSVChunksTests(SimpleTestCase):
+
+    def test_count_records(self):
+        data = b'1,a\n2,"b\nc"\n3,"d ""e"""\n4,f'
+        assert count_csv_records(data) == 4
+        assert count_csv_records(data + b'\n') == 4
+        assert count_csv_records(b'1,a\n2,b\n') == 2
+        assert count_csv_records(b'') == 0
+
+    def test_chunks_end_on_records(self):
+        data = b''.join(f'{number},"line\n{number}"\n'.encode('ascii')
+                        for number in range(100))
+        chunks = list(csv_chunks(io.BytesIO(data), chunk_size=50))
+        assert b''.join(chunks) == data
+        assert sum(count_csv_records(chunk) for chunk in chunks) == 100
+
+
+@override_settings(EXACT_COUNT_THRESHOLD=1000)
+class CountTests(SimpleTestCase):
+
+    def count(self, queryset, exact, estimate):
+        with mock.patch.object(DynamicModelQuerySet, 'exact_count',
+                               return_value=exact) as exact_count, \
+                mock.patch.object(DynamicModelQuerySet, 'estimated_count',
+                                  return_value=estimate) as estimated_count:
+            count = queryset.count()
+        return count, exact_count.call_count, estimated_count.call_count
+
+    def test_small_filtered_count_is_exact(self):
+        queryset = make_table(84).get_model().objects.filter(t84_f0='a')
+        # One (bounded) query - the planner is not asked
+        assert self.count(queryset, 10, 5000) == (10, 1, 0)
+        assert not queryset.count_is_estimate
+
+    def test_big_filtered_count_is_estimated(self):
+        queryset = make_table(84).get_model().objects.filter(t84_f0='a')
+        assert self.count(queryset, 1000, 5000) == (5000, 1, 1)
+        assert queryset.count_is_estimate
+        # Estimates are never less than the rows known to exist
+        queryset = make_table(84).get_model().objects.filter(t84_f0='a')
+        assert self.count(queryset, 1000, 20)[0] == 1000
+
+    def test_big_unfiltered_count_uses_statistics(self):
+        queryset = make_table(84).get_model().objects.all()
+        assert self.count(queryset, 1000, 5000) == (5000, 0, 1)
+        assert queryset.count_is_estimate
+
+    def test_export_limit_is_counted_exactly(self):
+        queryset = make_table(84).get_model().objects.all()
+        with mock.patch.object(DynamicModelQuerySet, 'exact_count',
+                               autospec=True,
+                               return_value=max_export_rows) as exact_count:
+            assert not exceeds_export_limit(queryset)
+        # The count stops right after the limit
+        counted, = exact_count.call_args[0]
+        assert counted.query.high_mark == max_export_rows + 1
+        with mock.patch.object(DynamicModelQuerySet, 'exact_count',
+                               return_value=max_export_rows + 1):
+            assert exceeds_export_limit(queryset)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ResponseCacheTests(SimpleTestCase):
+
+    def test_headers_are_replayed(self):
+        @cache_table_response('tests')
+        def view(request, slug, tablename):
+            response = HttpResponse(b'data', content_type='text/csv')
+            response['Vary'] = 'Accept'
+            response['Allow'] = 'GET, HEAD'
+            return response
+
+        request = RequestFactory().get('/')
+        with mock.patch('core.cache.table_import_state',
+                        return_value=(1, None, 0)):
+            misses = response_cache._stats['misses']
+            response = view(request, slug='a', tablename='b')
+            assert response['X-Cache'] == 'MISS'
+            assert response_cache._stats['misses'] == misses + 1
+
+            hits = response_cache._stats['hits']
+            response = view(request, slug='a', tablename='b')
+        assert response['X-Cache'] == 'HIT'
+        assert response_cache._stats['hits'] == hits + 1
+        assert response.content == b'data'
+        assert response['Content-Type'] == 'text/csv'
+        assert response['Vary'] == 'Accept'
+        assert response['Allow'] == 'GET, HEAD'
+
+    def test_counters_are_flushed_to_the_database(self):
+        with mock.patch.object(ResponseCacheStats, 'add') as add:
+            response_cache.flush_stats()
+            add.reset_mock()
+            response_cache._count('hits')
+            response_cache._count('hits')
+            response_cache._count('misses')
+            # Not flushed before the interval
+            assert add.call_count == 0
+            response_cache.flush_stats()
+        add.assert_called_with(2, 1)
+        assert response_cache._stats['hits'] == 0
+
+
+class SnapshotTests(SimpleTestCase):
+
+    def test_snapshots_of_other_generations_are_not_used(self):
+        with tempfile.TemporaryDirectory() as path, \
+                override_settings(MEDIA_ROOT=path):
+            table = make_table(86, import_date=timezone.now())
+            old_filename = table.snapshot_filename('gz')
+            os.makedirs(os.path.dirname(old_filename))
+            open(old_filename, mode='wb').close()
+            assert table.get_snapshot_filename('gz') == old_filename
+            assert table.snapshot_compressions() == ['gz']
+
+            table.cache_generation += 1  # e.g. a field is obfuscated
+            assert table.get_snapshot_filename('gz') is None
+            assert table.snapshot_compressions() == []
+
+            filename = table.snapshot_filename('gz')
+            open(filename, mode='wb').close()
+            table.delete_snapshots(keep=[filename])
+            assert not os.path.exists(old_filename)
+            assert os.path.exists(filename)
+
+
+class MetadataAdminTests(TestCase):
+
+    def setUp(self):
+        self.dataset = Dataset.objects.create(slug='admin-test', name='Admin test',
+                                              show=True)
+        self.version = Version.objects.create(dataset=self.dataset, name='2018',
+                                              order=1)
+        self.table = Table.objects.create(
+            dataset=self.dataset, version=self.version, name='data',
+            default=True, ordering=['id'], filtering=[], search=[],
+        )
+        self.field = Field.objects.create(
+            dataset=self.dataset, version=self.version, table=self.table,
+            name='secret', title='Secret', type='text', order=1, show=True,
+            obfuscate=False,
+        )
+        self.request = RequestFactory().post('/admin/')
+
+    def generation(self):
+        return Table.objects.get(id=self.table.id).cache_generation
+
+    def test_field_change_invalidates_table(self):
+        metadata = get_table_metadata('admin-test', 'data')
+        generation = self.generation()
+        metadata_version = MetadataVersion.current()
+
+        self.field.obfuscate = True
+        FieldAdmin(Field, AdminSite()).save_model(self.request, self.field,
+                                                  None, True)
+
+        table = Table.objects.get(id=self.table.id)
+        assert table.cache_generation == generation + 1
+        assert MetadataVersion.current() == metadata_version + 1
+        # Registries are keyed by `(import_date, cache_generation)`
+        new_metadata = get_table_metadata('admin-test', 'data')
+        assert new_metadata is not metadata
+        assert new_metadata.cache_generation == table.cache_generation
+        assert [field.obfuscate for field in new_metadata.fields] == [True]
+        assert table.get_model() is not metadata.Model
+        assert TABLE_METADATA_CACHE.get(table.id, (table.import_date,
+                                                   table.cache_generation),
+                                        lambda: None) is new_metadata
+
+    def test_field_delete_invalidates_table(self):
+        generation = self.generation()
+        FieldAdmin(Field, AdminSite()).delete_model(self.request, self.field)
+        assert self.generation() == generation + 1
+
+    def test_table_change_invalidates_table(self):
+        generation = self.generation()
+        self.table.ordering = ['-id']
+        TableAdmin(Table, AdminSite()).save_model(self.request, self.table,
+                                                  None, True)
+        assert self.generation() == generation + 1
+
+
+class ExportJobTests(TestCase):
+
+    def setUp(self):
+        dataset = Dataset.objects.create(slug='export-test', name='Export test')
+        version = Version.objects.create(dataset=dataset, name='2018', order=1)
+        self.table = Table.objects.create(
+            dataset=dataset, version=version, name='data', default=True,
+            ordering=['id'], filtering=[], search=[],
+            import_date=timezone.now(),
+        )
+
+    def test_stale_job_is_submitted_again(self):
+        job = ExportJob.objects.submit(self.table, {})
+        job = ExportJob.objects.claim_next()
+        assert job.status == ExportJob.STATUS_RUNNING
+        assert ExportJob.objects.submit(self.table, {}).status == \
+            ExportJob.STATUS_RUNNING
+
+        # The worker died long ago
+        ExportJob.objects.filter(id=job.id).update(
+            started_at=timezone.now() - datetime.timedelta(days=1),
+        )
+        assert ExportJob.objects.submit(self.table, {}).status == \
+            ExportJob.STATUS_PENDING
+
+    def test_superseded_jobs_expire(self):
+        job = ExportJob.objects.submit(self.table, {})
+        ExportJob.objects.filter(id=job.id).update(
+            status=ExportJob.STATUS_FINISHED, finished_at=timezone.now(),
+        )
+        assert not ExportJob.objects.expired().exists()
+
+        Table.objects.filter(id=self.table.id).update(import_date=timezone.now())
+        assert list(ExportJob.objects.expired()) == [job]
+        assert ExportJob.objects.clean_up() == 1
+        assert not ExportJob.objects.exists()
+
+    def test_metadata_change_needs_new_export(self):
+        job = ExportJob.objects.submit(self.table, {})
+        ExportJob.objects.filter(id=job.id).update(
+            status=ExportJob.STATUS_FINISHED, finished_at=timezone.now(),
+        )
+        self.table.invalidate_cache()  # e.g. a field is obfuscated
+        assert list(ExportJob.objects.expired()) == [job]
+        new_job = ExportJob.objects.submit(self.table, {})
+        assert new_job.id != job.id
+        assert new_job.status == ExportJob.STATUS_PENDING
+        assert ExportJob.objects.submit(self.table, {}).id == new_job.id
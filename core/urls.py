@@ -23,6 +23,7 @@ urlpatterns = [
     # Dataset-specific pages (specials)
     path('especiais', views_special.index, name='specials'),
     path('especiais/documento/<document>', login_required(views_special.document_detail, login_url=sign_up_url), name='special-document-detail'),
+    path('especiais/documento/<document>/<section>', login_required(views_special.document_section, login_url=sign_up_url), name='special-document-section'),
     path('especiais/caminho', login_required(views_special.trace_path, login_url=sign_up_url), name='special-trace-path'),
     path('especiais/grupos', login_required(views_special.company_groups, login_url=sign_up_url), name='special-company-groups'),
 ]
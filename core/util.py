@@ -3,13 +3,18 @@ import gc
 import gzip
 import io
 import lzma
+import queue
+import threading
 from textwrap import dedent
 
 import django.db.models.fields
+import psycopg2
 from django.db import connection, reset_queries, transaction
 from django.db.utils import ProgrammingError
+from rows.fields import slug
 from rows.plugins.utils import ipartition
-from core.models import Table
+from rows.utils import open_compressed
+from core.metadata import get_metadata
 
 
 def create_object(Model, data):
@@ -28,7 +33,7 @@ def create_object(Model, data):
 
 
 def get_company_by_document(document):
-    Documents = Table.objects.for_dataset('documentos-brasil').named('documents').get_model()
+    Documents = get_metadata().get_table('documentos-brasil', 'documents').get_model()
     doc_prefix = document[:8]
     headquarter_prefix = doc_prefix + '0001'
     branches = Documents.objects.filter(
@@ -59,3 +64,175 @@ def get_company_by_document(document):
                 pass
 
     return obj
+
+
+def csv_chunks(fobj, chunk_size, quotechar=b'"'):
+    """Split a binary CSV stream into chunks ending on record boundaries
+
+    A line break is a record boundary only if there's an even number of
+    quote chars before it (escaped quotes are doubled, so they don't change
+    the parity) - this way quoted values with line breaks are not split.
+    """
+    remainder = b''
+    while True:
+        data = fobj.read(chunk_size)
+        if not data:
+            if remainder:
+                yield remainder
+            break
+
+        data = remainder + data
+        end = len(data)
+        while True:
+            end = data.rfind(b'\n', 0, end)
+            if end == -1 or data.count(quotechar, 0, end) % 2 == 0:
+                break
+        if end == -1:  # Record bigger than chunk_size, read more data
+            remainder = data
+        else:
+            yield data[:end + 1]
+            remainder = data[end + 1:]
+
+
+def count_csv_records(data, quotechar=b'"'):
+    """Count the records of a chunk of CSV (see `csv_chunks`)
+
+    Line breaks inside quoted values (an odd number of quote chars before
+    them in the record) don't end records.
+    """
+    if quotechar not in data:
+        records = data.count(b'\n')
+    else:
+        records, quotes, start = 0, 0, 0
+        while True:
+            end = data.find(b'\n', start)
+            if end == -1:
+                break
+            quotes += data.count(quotechar, start, end)
+            if quotes % 2 == 0:
+                records += 1
+            start = end + 1
+    if data and not data.endswith(b'\n'):
+        records += 1
+    return records
+
+
+def parallel_pgimport(filename, database_uri, table_name, workers,
+                      encoding='utf-8', dialect='excel', callback=None,
+                      timeout=0.1, chunk_size=8388608):
+    """Import a CSV into PostgreSQL using `workers` concurrent COPY streams
+
+    The (decompressed) file is split in chunks aligned to CSV records and
+    each worker thread runs one `COPY ... FROM STDIN` per chunk using its own
+    connection. The rows imported by each COPY are checked against the
+    records in its chunk and transactions are committed only after all
+    chunks were imported. The table must be empty (just created for the
+    import): if any commit fails, the ones already committed are undone by
+    truncating it. `timeout` is the time (in seconds) between checks for
+    worker errors while waiting. Returns the same dict `pgimport` does.
+    """
+    dialect = csv.get_dialect(dialect)
+    quotechar = dialect.quotechar.encode(encoding)
+    fobj = open_compressed(filename, mode='rb')
+    header_line = fobj.readline().decode(encoding)
+    header = next(csv.reader([header_line], dialect=dialect))
+    field_names = ', '.join(slug(field_name) for field_name in header)
+    copy_sql = dedent(f'''
+        COPY {table_name} ({field_names}) FROM STDIN WITH (
+            FORMAT csv,
+            DELIMITER '{dialect.delimiter.replace("'", "''")}',
+            QUOTE '{dialect.quotechar.replace("'", "''")}',
+            ENCODING '{encoding}'
+        )
+    ''').strip()
+
+    chunks = queue.Queue(maxsize=workers * 2)
+    lock = threading.Lock()
+    connections, errors = [], []
+    status = {'bytes_written': len(header_line.encode(encoding)),
+              'rows_imported': 0}
+
+    def worker():
+        try:
+            conn = psycopg2.connect(database_uri)
+        except psycopg2.Error as exception:
+            errors.append(exception)
+            conn = None
+        else:
+            with lock:
+                connections.append(conn)
+
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            elif errors:  # Some worker failed - just consume the queue
+                continue
+            try:
+                with conn.cursor() as cursor:
+                    cursor.copy_expert(copy_sql, io.BytesIO(chunk))
+                    rows_imported = cursor.rowcount
+            except psycopg2.Error as exception:
+                errors.append(exception)
+                continue
+            records = count_csv_records(chunk, quotechar)
+            if rows_imported != records:
+                errors.append(RuntimeError(
+                    f'Row count mismatch: {rows_imported} rows imported from '
+                    f'a chunk with {records} records'
+                ))
+                continue
+
+            with lock:
+                status['bytes_written'] += len(chunk)
+                status['rows_imported'] += rows_imported
+                if callback:
+                    callback(len(chunk), status['bytes_written'])
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for chunk in csv_chunks(fobj, chunk_size, quotechar):
+            while not errors:
+                try:
+                    chunks.put(chunk, timeout=timeout)
+                except queue.Full:
+                    continue
+                break
+            if errors:
+                break
+    finally:
+        for _ in threads:
+            chunks.put(None)
+        for thread in threads:
+            thread.join()
+        fobj.close()
+
+    committed = []
+    try:
+        if errors:
+            raise RuntimeError(str(errors[0]).strip())
+        try:
+            for conn in connections:
+                conn.commit()
+                committed.append(conn)
+        except psycopg2.Error as exception:
+            raise RuntimeError(str(exception).strip())
+    except RuntimeError:
+        for conn in connections:
+            if conn not in committed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:  # Connection lost (rolled back)
+                    pass
+        if committed:
+            with committed[0].cursor() as cursor:
+                cursor.execute(f'TRUNCATE {table_name}')
+            committed[0].commit()
+        raise
+    finally:
+        for conn in connections:
+            conn.close()
+
+    return status
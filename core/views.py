@@ -1,23 +1,28 @@
-import csv
+import copy
+import os
+import random
+import re
 import uuid
 
 from django.conf import settings
 from django.core.mail import EmailMessage
 from django.core.paginator import Paginator
-from django.http import HttpResponseBadRequest, StreamingHttpResponse
-from django.shortcuts import get_object_or_404, redirect, render
+from django.http import (HttpResponse, HttpResponseBadRequest,
+                         HttpResponseNotModified, StreamingHttpResponse)
+from django.shortcuts import redirect, render
 from django.urls import reverse
+from django.views.decorators.http import condition
 
-from core.models import Dataset, Table
+from core.cache import cache_table_response, table_import_state
+from core.metadata import get_dataset_or_404, get_metadata
+from core.models import FACETS_LIMIT, Table, normalize_querystring
 from core.forms import ContactForm
-from core.templatetags.utils import obfuscate
+from core.paginators import KeysetPaginator
+from utils.db import stream_copy
+from utils.http import make_etag
 
 
-max_export_rows = 350000
-
-class Echo:
-    def write(self, value):
-        return value
+max_export_rows = 2000000
 
 
 def contact(request):
@@ -51,22 +56,100 @@ def contact(request):
     return render(request, 'contact.html', {'form': form, 'sent': sent})
 
 
-def queryset_to_csv(data, fields):
-    header = None
-    for row in data.iterator():
-        row_data = {}
-        for field in fields:
-            if not field.show_on_frontend or field.name == 'search_data':
-                continue
-            else:
-                value = getattr(row, field.name)
-                if field.obfuscate:
-                    value = obfuscate(value)
-                row_data[field.name] = value
-        if header is None:
-            header = list(row_data.keys())
-            yield header
-        yield [row_data[field] for field in header]
+def _read_file_range(fobj, length, chunk_size=65536):
+    try:
+        while length > 0:
+            data = fobj.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fobj.close()
+
+
+def serve_file(request, filename, content_type, download_name, etag,
+               content_encoding=None):
+    """Serve a file supporting ETag (If-None-Match) and single HTTP ranges"""
+    size = os.path.getsize(filename)
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        return HttpResponseNotModified()
+
+    start, end, status = 0, size - 1, 200
+    range_header = request.META.get('HTTP_RANGE', '').strip()
+    if_range = request.META.get('HTTP_IF_RANGE')
+    match = re.match(r'^bytes=(\d*)-(\d*)$', range_header)
+    if match and any(match.groups()) and (not if_range or if_range == etag):
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            if last:
+                end = min(int(last), size - 1)
+        else:  # Suffix range: last N bytes
+            start = max(size - int(last), 0)
+        if start > end:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        status = 206
+
+    fobj = open(filename, mode='rb')
+    fobj.seek(start)
+    length = end - start + 1
+    response = StreamingHttpResponse(
+        _read_file_range(fobj, length),
+        content_type=content_type,
+        status=status,
+    )
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Length'] = str(length)
+    response['ETag'] = etag
+    response['Content-Disposition'] = f'attachment; filename="{download_name}"'
+    if status == 206:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    if content_encoding:
+        response['Content-Encoding'] = content_encoding
+    return response
+
+
+def exceeds_export_limit(queryset):
+    """Whether `queryset` has more than `max_export_rows` rows
+
+    Rows are counted exactly, but `COUNT(*)` stops after `max_export_rows +
+    1` rows (estimates may be far from the real count).
+    """
+    queryset = queryset.order_by()[:max_export_rows + 1]
+    return queryset.exact_count() > max_export_rows
+
+
+def serve_snapshot(request, table, download_format):
+    """Serve the full-table snapshot for `download_format` (if available)
+
+    `csv` is served from the gzip snapshot with `Content-Encoding: gzip` if
+    the client accepts it; `csv.gz` and `csv.xz` are served as is. Returns
+    `None` if there's no up-to-date snapshot to be served.
+    """
+    if download_format == 'csv':
+        accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+        if 'gzip' not in accept_encoding:
+            return None
+        compression, content_encoding = 'gz', 'gzip'
+        content_type = 'text/csv;charset=UTF-8'
+    else:
+        compression, content_encoding = download_format.split('.')[-1], None
+        content_type = {'gz': 'application/gzip', 'xz': 'application/x-xz'}[compression]
+
+    filename = table.get_snapshot_filename(compression)
+    if filename is None:
+        return None
+    stat = os.stat(filename)
+    etag = (f'"{table.id}-{table.cache_generation}-{int(stat.st_mtime)}-'
+            f'{stat.st_size}-{compression}"')
+    download_name = f'{table.dataset.slug}-{table.name}.{download_format}'
+    response = serve_file(request, filename, content_type, download_name,
+                          etag, content_encoding=content_encoding)
+    response['Vary'] = 'Accept-Encoding'
+    return response
 
 
 def index(request):
@@ -78,21 +161,64 @@ def donate(request):
 
 
 def home(request):
+    datasets = get_metadata().visible_datasets()
     context = {
-        'datasets': Dataset.objects.filter(show=True).order_by('?')[:6],
+        'datasets': random.sample(datasets, min(6, len(datasets))),
     }
     return render(request, 'home.html', context)
 
 
 def dataset_list(request):
+    datasets = get_metadata().visible_datasets()
     context = {
-        'datasets': Dataset.objects.filter(show=True).order_by('name'),
+        'datasets': sorted(datasets, key=lambda dataset: dataset.name),
     }
     return render(request, 'dataset-list.html', context)
 
 
+def table_etag(request, slug, tablename, *extra):
+    """ETag for a table's data
+
+    Changes when the table is imported, its cache is invalidated or the
+    querystring is different.
+    """
+    state = table_import_state(request, slug, tablename)
+    if state is None:
+        return None
+    querystring = normalize_querystring(request.GET, ignore=())
+    return make_etag(*state, querystring, *extra)
+
+
+def table_last_modified(request, slug, tablename):
+    state = table_import_state(request, slug, tablename)
+    return state[1] if state is not None else None
+
+
+def dataset_detail_etag(request, slug, tablename=''):
+    if not tablename:
+        return None
+    # The page shows the logged in user
+    return table_etag(request, slug, tablename, request.user.pk)
+
+
+def dataset_detail_last_modified(request, slug, tablename=''):
+    if not tablename:
+        return None
+    return table_last_modified(request, slug, tablename)
+
+
+def dataset_detail_cache_vary(request):
+    # Pages for logged in users and downloads are not cached
+    if request.user.is_authenticated or 'format' in request.GET:
+        return None
+    return ()
+
+
+@condition(etag_func=dataset_detail_etag,
+           last_modified_func=dataset_detail_last_modified)
+@cache_table_response('dataset-detail', vary=dataset_detail_cache_vary)
 def dataset_detail(request, slug, tablename=''):
-    dataset = get_object_or_404(Dataset, slug=slug)
+    dataset = get_dataset_or_404(slug)
     if not tablename:
         tablename = dataset.get_default_table().name
         return redirect(reverse('core:dataset-table-detail',
@@ -104,15 +230,31 @@ def dataset_detail(request, slug, tablename=''):
         return HttpResponseBadRequest(f'Table does not exist.', status=404)
 
     querystring = request.GET.copy()
-    page_number = querystring.pop('page', ['1'])[0].strip() or '1'
-    download_csv = querystring.pop('format', ['']) == ['csv']
+    page_number = querystring.pop('page', [''])[0].strip()
+    cursor = querystring.pop('cursor', [''])[0].strip()
+    download_format = querystring.pop('format', [''])[0]
+    download_csv = download_format in ('csv', 'csv.gz', 'csv.xz')
     try:
-        page = int(page_number)
+        page = int(page_number or '1')
     except ValueError:
         return HttpResponseBadRequest('Invalid page number.', status=404)
 
-    version = dataset.version_set.order_by('-order').first()
-    fields = table.fields
+    if download_csv and not any(querystring.values()):
+        response = serve_snapshot(request, table, download_format)
+        if response is not None:
+            return response
+    if download_format in ('csv.gz', 'csv.xz'):
+        if any(querystring.values()):
+            message = 'Compressed downloads are available only for the whole table.'
+        else:
+            message = ('There is no up-to-date compressed snapshot of this '
+                       'table (use format=csv).')
+        return HttpResponseBadRequest(message, status=404)
+
+    version = dataset.get_last_version()
+    # Fields are shared by all requests (see `core.metadata`), so facets are
+    # set on copies
+    fields = [copy.copy(field) for field in table.fields]
 
     all_data = table.get_model().objects.filter_by_querystring(querystring)
 
@@ -120,15 +262,18 @@ def dataset_detail(request, slug, tablename=''):
         fieldnames_to_show = [field.name
                               for field in fields
                               if field.show_on_frontend]
+        # Keyset pagination needs the ordering fields on each row
+        fieldnames_to_show += [
+            fieldname.lstrip('-')
+            for fieldname in all_data.keyset_ordering()
+            if fieldname.lstrip('-') not in fieldnames_to_show
+        ]
         all_data = all_data.values(*fieldnames_to_show)
     else:
-        if all_data.count() <= max_export_rows:
+        if not exceeds_export_limit(all_data):
             filename = '{}-{}.csv'.format(slug, uuid.uuid4().hex)
-            pseudo_buffer = Echo()
-            writer = csv.writer(pseudo_buffer, dialect=csv.excel)
-            csv_rows = queryset_to_csv(all_data, fields)
             response = StreamingHttpResponse(
-                (writer.writerow(row) for row in csv_rows),
+                stream_copy(all_data.export_sql(fields)),
                 content_type='text/csv;charset=UTF-8',
             )
             response['Content-Disposition'] = ('attachment; filename="{}"'
@@ -136,25 +281,57 @@ def dataset_detail(request, slug, tablename=''):
             response.encoding = 'UTF-8'
             return response
         else:
-            return HttpResponseBadRequest('Max rows exceeded.', status=404)
+            export_url = reverse('api:dataset-table-export',
+                                 kwargs={'slug': slug, 'tablename': tablename})
+            return HttpResponseBadRequest(
+                'Max rows exceeded. Request a background export with '
+                f'POST {export_url}?{querystring.urlencode()}',
+                status=404,
+            )
 
-    paginator = Paginator(all_data, 20)
-    data = paginator.get_page(page)
+    if page_number:  # Old links with page numbers (uses OFFSET)
+        paginator = Paginator(all_data, 20)
+        data = paginator.get_page(page)
+    else:
+        paginator = KeysetPaginator(all_data, 20)
+        try:
+            data = paginator.get_page(cursor or None)
+        except ValueError:
+            return HttpResponseBadRequest('Invalid cursor.', status=404)
 
     for key, value in list(querystring.items()):
         if not value:
             del querystring[key]
+    for field in fields:
+        if field.has_choices and field.frontend_filter:
+            facets = table.get_facets(field.name, querystring,
+                                      limit=FACETS_LIMIT + 1)
+            # Fields with more values are filled with the help of the facets
+            # API (autocomplete by prefix) instead of a `<select>`
+            field.has_more_facets = len(facets) > FACETS_LIMIT
+            field.facets = facets[:FACETS_LIMIT]
+            selected = querystring.get(field.name)
+            if selected and selected not in [value for value, _ in field.facets]:
+                field.facets.append((selected, None))
+    total_count = all_data.count()
+    if all_data.count_is_estimate:
+        exportable = not exceeds_export_limit(all_data)
+    else:
+        exportable = total_count <= max_export_rows
     context = {
         'data': data,
         'dataset': dataset,
         'table': table,
         'fields': fields,
-        'max_export_rows': max_export_rows,
+        'exportable': exportable,
         'query_dict': querystring,
         'querystring': querystring.urlencode(),
         'slug': slug,
+        'snapshot_formats': [f'csv.{compression}' for compression
+                             in table.snapshot_compressions()],
         'table': table,
-        'total_count': all_data.count(),
+        'total_count': total_count,
+        'total_count_is_estimate': all_data.count_is_estimate,
         'version': version,
     }
     return render(request, 'dataset-detail.html', context)
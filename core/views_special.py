@@ -1,45 +1,31 @@
-from collections import defaultdict
-from functools import lru_cache
-from unicodedata import normalize
+from functools import partial
+from urllib.parse import urlencode
 
 from cryptography.fernet import Fernet, InvalidToken
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.postgres.search import SearchQuery
-from django.http import Http404
-from django.shortcuts import get_object_or_404, redirect, render
+from django.http import (Http404, HttpResponseBadRequest, JsonResponse,
+                         StreamingHttpResponse)
+from django.shortcuts import redirect, render
 from django.urls import reverse
+from django.utils.text import slugify
 
+from core.document_profile import (count_section, document_data,
+                                   get_company_state, get_datasets,
+                                   get_document, get_section_page,
+                                   get_stored_page, is_headquarter,
+                                   section_names, section_queries)
 from core.forms import TracePathForm, CompanyGroupsForm
-from core.models import Dataset
-from core.util import get_company_by_document
+from core.paginators import decode_cursor
+from core.templatetags.utils import obfuscate
+from utils.db import call_concurrently, stream_copy
 from graphs.serializers import PathSerializer, CNPJCompanyGroupsSerializer
 
 
 cipher_suite = Fernet(settings.FERNET_KEY)
 
 
-@lru_cache()
-def get_datasets():
-    slugs = (
-        'documentos-brasil:documents',
-        'eleicoes-brasil:candidatos',
-        'eleicoes-brasil:filiados',
-        'gastos-deputados:cota_parlamentar',
-        'gastos-diretos:gastos',
-        'socios-brasil:socios',
-        'socios-brasil:empresas',
-        'socios-brasil:holdings',
-    )
-    datasets = defaultdict(dict)
-    for slug in slugs:
-        dataset_slug, tablename = slug.split(':')
-        dataset = Dataset.objects.get(slug=dataset_slug)
-        datasets[dataset_slug][tablename] = \
-            dataset.get_table(tablename)
-
-    return datasets
-
-
 def index(request):
     return render(request, 'specials/index.html', {})
 
@@ -49,10 +35,6 @@ def _get_fields(table, remove):
             for field in table.field_set.all()
             if field.show_on_frontend and field.name not in remove]
 
-def unaccent(text):
-    return normalize('NFKD', text).encode('ascii', errors='ignore')\
-                                  .decode('ascii')
-
 
 def redirect_company(from_document, to_document, warn):
     url = reverse(
@@ -64,17 +46,38 @@ def redirect_company(from_document, to_document, warn):
     return redirect(url)
 
 
-def document_detail(request, document):
-    datasets = get_datasets()
-    Candidatos = datasets['eleicoes-brasil']['candidatos'].get_model()
-    Documents = datasets['documentos-brasil']['documents'].get_model()
-    Empresas = datasets['socios-brasil']['empresas'].get_model()
-    Holdings = datasets['socios-brasil']['holdings'].get_model()
-    Socios = datasets['socios-brasil']['socios'].get_model()
-    FiliadosPartidos = datasets['eleicoes-brasil']['filiados'].get_model()
-    GastosDeputados = datasets['gastos-deputados']['cota_parlamentar'].get_model()
-    GastosDiretos = datasets['gastos-diretos']['gastos'].get_model()
-
+# Title and CSV file name prefix of each section of the document page
+SECTIONS = {
+    'applications': ('Candidaturas', 'candidaturas'),
+    'branches': ('Matriz/Filiais', 'branches'),
+    'camara_spending': ('Gastos da Cota Parlamentar (Câmara dos Deputados)',
+                        'gastos-deputados'),
+    'companies': ('Sociedades', 'sociedades'),
+    'federal_spending': ('Gastos Diretos do Governo Federal',
+                         'gastos-diretos'),
+    'filiations': ('Filiações', 'filiacoes'),
+    'partners': ('Quadro Societário', 'quadro-societario'),
+}
+# Fields not shown in each section (they have the document's data)
+HIDDEN_FIELDS = {
+    'applications': ['cpf_candidato', 'nome_candidato'],
+    'branches': ['document_type', 'sources', 'text'],
+    'camara_spending': ['txtcnpjcpf', 'txtfornecedor'],
+    'companies': ['cpf_cnpj_socio', 'nome_socio'],
+    'federal_spending': ['codigo_favorecido', 'nome_favorecido'],
+    'filiations': [],
+    'partners': ['cnpj', 'razao_social'],
+}
+# Companies' section comes from another table (holdings)
+HIDDEN_COMPANY_FIELDS = dict(HIDDEN_FIELDS, companies=['cnpj_socia'])
+
+
+def clean_document(document):
+    """Return `(document, encrypted)` for a document from the URL
+
+    Documents which are not CPFs or CNPJs are decrypted (raises `Http404` if
+    it's not possible).
+    """
     encrypted = False
     if len(document) not in (11, 14):  # encrypted
         try:
@@ -86,130 +89,157 @@ def document_detail(request, document):
         else:
             encrypted = True
     document = document.replace('.', '').replace('-', '').replace('/', '').strip()
-    document_size = len(document)
-    is_company = document_size == 14
-    is_person = document_size == 11
+    return document, encrypted
 
-    branches = Documents.objects.none()
-    branches_cnpjs = []
 
+def document_detail(request, document):
+    """Render the document page with placeholders for its sections
+
+    Each section is loaded by the browser from `document_section` when it
+    becomes visible.
+    """
+    url_document = document
+    document, encrypted = clean_document(document)
+    is_company = len(document) == 14
+
+    try:
+        row = get_document(document)
+    except ObjectDoesNotExist:
+        raise Http404
+    # For companies, from here only HQs or companies without HQs
+    if is_company and document != row.document:
+        warn = not is_headquarter(row.document)
+        return redirect_company(document, row.document, warn=warn)
+    obj = document_data(row)
     if is_company:
-        doc_prefix = document[:8]
-        try:
-            obj = get_company_by_document(document)
-        except Documents.DoesNotExist:
-            raise Http404
-        # From here only HQs or companies without HQs
-        if document != obj.document:
-            if obj.document[:12].endswith('0001'):  # HQ
-                return redirect_company(document, obj.document, warn=False)
-            else:
-                return redirect_company(document, obj.document, warn=True)
+        obj['state'] = get_company_state(document)
+
+    sections = [
+        {
+            'name': name,
+            'title': SECTIONS[name][0],
+            'url': reverse('core:special-document-section',
+                           args=[url_document, name]),
+        }
+        for name in section_names(document)
+    ]
+    context = {
+        'doc_prefix': document[:8] if is_company else None,
+        'encrypted': encrypted,
+        'obj': obj,
+        'original_document': request.GET.get('original_document', None),
+        'sections': sections,
+    }
+    return render(request, 'specials/document-detail.html', context)
 
-        branches = Documents.objects.filter(
-            docroot=obj.docroot,
-            document_type='CNPJ',
-        )
-        branches_cnpjs = [branch.document for branch in branches]
-
-    else:  # not a company
-        doc_prefix = None
-        obj = get_object_or_404(Documents, document=document)
-
-    obj_dict = obj.__dict__
-    partners_data = Socios.objects.none()
-    companies_data = Socios.objects.none()
-    applications_data = Candidatos.objects.none()
-    filiations_data = FiliadosPartidos.objects.none()
-    applications_fields = _get_fields(
-        datasets['eleicoes-brasil']['candidatos'],
-        remove=['cpf_candidato', 'nome_candidato']
-    )
-    companies_fields = _get_fields(
-        datasets['socios-brasil']['socios'],
-        remove=['cpf_cnpj_socio', 'nome_socio'],
-    )
-    camara_spending_fields = _get_fields(
-        datasets['gastos-deputados']['cota_parlamentar'],
-        remove=['txtcnpjcpf', 'txtfornecedor'],
-    )
-    federal_spending_fields = _get_fields(
-        datasets['gastos-diretos']['gastos'],
-        remove=['codigo_favorecido', 'nome_favorecido'],
-    )
-    partners_fields = _get_fields(
-        datasets['socios-brasil']['socios'],
-        remove=['cnpj', 'razao_social'],
-    )
-    filiations_fields = _get_fields(
-        datasets['eleicoes-brasil']['filiados'],
-        remove=[],
-    )
-    branches_fields = _get_fields(
-        datasets['documentos-brasil']['documents'],
-        remove=['document_type', 'sources', 'text'],
-    )
 
-    if is_company:
-        partners_data = \
-            Socios.objects.filter(cnpj__in=branches_cnpjs)\
-                          .order_by('nome_socio')
-        company = Empresas.objects.filter(cnpj=obj.document).first()
-        obj_dict['state'] = company.uf if company else ''
-        companies_data = Holdings.objects.filter(cnpj_socia__in=branches_cnpjs)\
-                                         .order_by('razao_social')
-        companies_fields = _get_fields(
-            datasets['socios-brasil']['holdings'],
-            remove=['cnpj_socia'],
+def _serialize_row(row, fields):
+    return {
+        field.name: obfuscate(row[field.name]) if field.obfuscate
+                    else row[field.name]
+        for field in fields
+    }
+
+
+def document_section(request, document, section):
+    """One page of a document page's section (HTML fragment or JSON)
+
+    Pages are paginated with keyset cursors (`cursor` query parameter) and
+    the JSON version is returned if `format=json`. All the section's rows
+    are downloaded with `format=csv`.
+
+    The first page is read from the precomputed section if it's not stale.
+    Otherwise the page and the total are queried at the same time (by the
+    pool of `utils.db.call_concurrently`, so each query is also limited by
+    `settings.DOCUMENT_SECTION_TIMEOUT`).
+    """
+    url_document = document
+    document, _ = clean_document(document)
+    is_company = len(document) == 14
+    if section not in section_names(document):
+        raise Http404
+    json_format = request.GET.get('format') == 'json'
+    csv_format = request.GET.get('format') == 'csv'
+    cursor = request.GET.get('cursor') or None
+    if cursor:
+        try:
+            decode_cursor(cursor)
+        except ValueError:
+            return HttpResponseBadRequest('Invalid cursor.', status=404)
+
+    try:
+        row = get_document(document)
+    except ObjectDoesNotExist:
+        raise Http404
+    if row.document != document:  # Pages are only for HQs
+        raise Http404
+    obj = document_data(row)
+
+    table, queryset = section_queries(obj)[section]
+    hidden_fields = HIDDEN_COMPANY_FIELDS if is_company else HIDDEN_FIELDS
+    fields = _get_fields(table, remove=hidden_fields[section])
+    title, caption = SECTIONS[section]
+    if csv_format:
+        filename = '{}-{}.csv'.format(caption, slugify(obj['name']))
+        response = StreamingHttpResponse(
+            stream_copy(queryset.export_sql(fields)),
+            content_type='text/csv;charset=UTF-8',
         )
+        response['Content-Disposition'] = ('attachment; filename="{}"'
+                                           .format(filename))
+        response.encoding = 'UTF-8'
+        return response
+
+    result = get_stored_page(section, obj) if cursor is None else None
+    if result is None:
+        results = call_concurrently(
+            {
+                'page': partial(get_section_page, section, obj, cursor=cursor),
+                'count': partial(count_section, section, obj),
+            },
+            workers=settings.DOCUMENT_SECTION_WORKERS,
+            timeout=settings.DOCUMENT_SECTION_TIMEOUT,
+        )
+        result = results['page'], results['count']
+    unavailable = any(isinstance(value, Exception) for value in result)
+    page, count = (None, None) if unavailable else result
+
+    url = reverse('core:special-document-section',
+                  args=[url_document, section])
+    links = {'next': None, 'previous': None}
+    if page is not None:
+        for key, page_cursor in (('next', page.next_cursor),
+                                 ('previous', page.previous_cursor)):
+            if page_cursor is not None:
+                query = {'cursor': page_cursor}
+                if json_format:
+                    query['format'] = 'json'
+                links[key] = f'{url}?{urlencode(query)}'
+
+    if json_format:
+        if unavailable:
+            return JsonResponse({'detail': 'Section unavailable.'},
+                                status=503)
+        return JsonResponse({
+            'count': count,
+            'next': links['next'],
+            'previous': links['previous'],
+            'results': [_serialize_row(row, fields) for row in page],
+        })
 
-        # all appearances of 'obj.document'
-        camara_spending_data = \
-            GastosDeputados.objects.filter(txtcnpjcpf__in=branches_cnpjs)\
-                                   .order_by('-datemissao')
-        federal_spending_data = \
-            GastosDiretos.objects.filter(codigo_favorecido__in=branches_cnpjs)\
-                                 .order_by('-data_pagamento')
-    elif is_person:
-        companies_data = \
-            Socios.objects.filter(nome_socio=unaccent(obj.name))\
-                          .distinct('cnpj', 'razao_social')\
-                          .order_by('razao_social')
-        applications_data = \
-            Candidatos.objects.filter(cpf_candidato=obj.document)
-        filiations_data = \
-            FiliadosPartidos.objects.filter(nome_do_filiado=unaccent(obj.name))
-
-        # all appearances of 'obj.document'
-        camara_spending_data = \
-            GastosDeputados.objects.filter(txtcnpjcpf=obj.document)\
-                                   .order_by('-datemissao')
-        federal_spending_data = \
-            GastosDiretos.objects.filter(codigo_favorecido=obj.document)\
-                                 .order_by('-data_pagamento')
-
-    original_document = request.GET.get('original_document', None)
     context = {
-        'applications_data': applications_data,
-        'applications_fields': applications_fields,
-        'branches': branches,
-        'branches_fields': branches_fields,
-        'camara_spending_data': camara_spending_data,
-        'camara_spending_fields': camara_spending_fields,
-        'companies_data': companies_data,
-        'companies_fields': companies_fields,
-        'doc_prefix': doc_prefix,
-        'encrypted': encrypted,
-        'federal_spending_data': federal_spending_data,
-        'federal_spending_fields': federal_spending_fields,
-        'filiations_data': filiations_data,
-        'filiations_fields': filiations_fields,
-        'obj': obj_dict,
-        'original_document': original_document,
-        'partners_data': partners_data,
-        'partners_fields': partners_fields,
+        'caption': f'{caption}-{obj["name"]}',
+        'count': count,
+        'csv_url': f'{url}?{urlencode({"format": "csv"})}',
+        'fields': fields,
+        'links': links,
+        'name': section,
+        'obj': obj,
+        'page': page,
+        'title': title,
+        'unavailable': unavailable,
     }
-    return render(request, 'specials/document-detail.html', context)
+    return render(request, 'specials/document-section.html', context)
 
 
 def _get_path(origin, destination):
@@ -0,0 +1,204 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from django.db import close_old_connections, connection, transaction
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def run_in_threads(function, items, workers):
+    """Call `function(item)` for each item using `workers` threads
+
+    Django opens one database connection per thread, so each worker uses its
+    own connection, which is closed when the worker finishes. Results are
+    returned in the same order as `items` and the first exception raised by
+    `function` is re-raised (remaining items are not processed).
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    tasks = queue.Queue()
+    for index, item in enumerate(items):
+        tasks.put((index, item))
+
+    def worker():
+        try:
+            while not errors:
+                try:
+                    index, item = tasks.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    results[index] = function(item)
+                except Exception as exception:
+                    errors.append(exception)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+def _get_executor(workers):
+    """Return the process-wide thread pool with `workers` threads"""
+    executor = _executors.get(workers)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(workers)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=workers)
+                _executors[workers] = executor
+    return executor
+
+
+def _call_with_statement_timeout(function, timeout):
+    close_old_connections()
+    try:
+        if timeout is None:
+            return function()
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL statement_timeout = %s',
+                               [int(timeout * 1000)])
+            return function()
+    finally:
+        close_old_connections()
+
+
+def call_concurrently(functions, workers, timeout=None):
+    """Call the functions in `functions` (a dict) at the same time
+
+    They run in a thread pool shared by the process (with `workers` threads),
+    so each one uses the database connection of its thread. If `timeout`
+    (in seconds) is given, PostgreSQL cancels queries running for longer
+    than it, and results not ready `timeout` seconds after the call (e.g.:
+    the pool is busy) are not waited for.
+
+    Returns a dict with the same keys and the results - or the exceptions
+    raised (`TimeoutError` for results not waited for).
+    """
+    executor = _get_executor(workers)
+    futures = {
+        key: executor.submit(_call_with_statement_timeout, function, timeout)
+        for key, function in functions.items()
+    }
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    results = {}
+    for key, future in futures.items():
+        remaining = None
+        if deadline is not None:
+            remaining = max(deadline - time.monotonic(), 0)
+        try:
+            results[key] = future.result(timeout=remaining)
+        except TimeoutError as exception:
+            future.cancel()  # Not started yet
+            results[key] = exception
+        except Exception as exception:
+            results[key] = exception
+    return results
+
+
+class _QueueWriter:
+    """File-like object which puts written data in a queue (in chunks)"""
+
+    def __init__(self, put, chunk_size):
+        self.put = put
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer.extend(data)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            if not self.put(bytes(self.buffer)):
+                raise IOError('Stream consumer is gone')
+            self.buffer.clear()
+
+
+def stream_copy(sql, chunk_size=65536, max_chunks=16):
+    """Run a `COPY ... TO STDOUT` query and yield its output in chunks
+
+    The query runs in another thread (with its own database connection)
+    while the chunks are consumed, using a bounded queue so memory usage
+    does not depend on the result size. If the generator is closed before
+    the end (e.g.: the client disconnected) the query is aborted.
+    """
+    chunks = queue.Queue(maxsize=max_chunks)
+    stop = threading.Event()
+    end = object()
+    errors = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=1)
+            except queue.Full:
+                continue
+            else:
+                return True
+        return False
+
+    def copy():
+        writer = _QueueWriter(put, chunk_size)
+        try:
+            with connection.cursor() as cursor:
+                cursor.copy_expert(sql, writer)
+            writer.flush()
+        except Exception as exception:
+            errors.append(exception)
+        finally:
+            connection.close()
+            put(end)
+
+    thread = threading.Thread(target=copy, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is end:
+                break
+            yield chunk
+    finally:
+        stop.set()
+
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+class _TeeWriter:
+    """File-like object which writes the same data to many file objects"""
+
+    def __init__(self, fobjs):
+        self.fobjs = fobjs
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        for fobj in self.fobjs:
+            fobj.write(data)
+        return len(data)
+
+
+def copy_to_files(sql, fobjs):
+    """Run a `COPY ... TO STDOUT` query writing its output to all `fobjs`"""
+    with connection.cursor() as cursor:
+        cursor.copy_expert(sql, _TeeWriter(fobjs))
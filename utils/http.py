@@ -0,0 +1,7 @@
+import hashlib
+
+
+def make_etag(*parts):
+    """Return a weak ETag for `parts` (which must have a stable `repr`)"""
+    digest = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+    return f'W/"{digest}"'
@@ -0,0 +1,57 @@
+import threading
+
+
+class Registry:
+    """Thread-safe registry of objects built per key and version
+
+    Readers never lock: they look up an immutable snapshot (a dict which is
+    never changed after being published). Writers build the object and
+    publish a new snapshot while holding a lock, so an object is built only
+    once per key/version even if many threads ask for it at the same time.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = {}
+
+    def _publish(self, key, version, value):
+        entries = dict(self._entries)
+        entries[key] = (version, value)
+        self._entries = entries  # Replacing the reference is atomic
+
+    def get(self, key, version, build):
+        """Return the object for `key`, calling `build()` if needed
+
+        The object is built again if the registered one is for another
+        `version`.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+            value = build()
+            self._publish(key, version, value)
+            return value
+
+    def set(self, key, version, value):
+        with self._lock:
+            self._publish(key, version, value)
+
+    def lookup(self, key):
+        """Return the registered object for `key` (or `None`)"""
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
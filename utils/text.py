@@ -0,0 +1,54 @@
+import re
+from unicodedata import normalize
+
+
+# Also used in SQL (PostgreSQL regular expressions understand it)
+WHITESPACE_PATTERN = r'[ \t\n\r\f\v]+'
+WHITESPACE_REGEXP = re.compile(WHITESPACE_PATTERN)
+
+
+def unaccent(text):
+    return normalize('NFKD', text).encode('ascii', errors='ignore')\
+                                  .decode('ascii')
+
+
+def _make_translation():
+    """Map Latin characters to their unaccented versions
+
+    Returns `(from_chars, to_chars)` as used by PostgreSQL's `translate`:
+    characters in `from_chars` after the length of `to_chars` are removed
+    (e.g. combining accents), so the same mapping can be applied in Python
+    and in SQL without needing the `unaccent` extension.
+    """
+    replaced, removed = [], []
+    for code in range(0x00A0, 0x0250):
+        char = chr(code)
+        ascii_char = unaccent(char)
+        if ascii_char == char or len(ascii_char) > 1:
+            continue
+        elif ascii_char:
+            replaced.append((char, ascii_char))
+        else:
+            removed.append(char)
+    removed.extend(chr(code) for code in range(0x0300, 0x0370))
+    from_chars = ''.join(char for char, _ in replaced) + ''.join(removed)
+    to_chars = ''.join(ascii_char for _, ascii_char in replaced)
+    return from_chars, to_chars
+
+
+NAME_TRANSLATE_FROM, NAME_TRANSLATE_TO = _make_translation()
+_NAME_TRANSLATION = str.maketrans(
+    NAME_TRANSLATE_FROM[:len(NAME_TRANSLATE_TO)],
+    NAME_TRANSLATE_TO,
+    NAME_TRANSLATE_FROM[len(NAME_TRANSLATE_TO):],
+)
+
+
+def normalize_name(name):
+    """Unaccent, uppercase and collapse the whitespace of `name`
+
+    Same as the SQL function `core.models.NormalizeName`, used to fill the
+    normalized name columns of dynamic tables.
+    """
+    name = name.translate(_NAME_TRANSLATION).upper()
+    return WHITESPACE_REGEXP.sub(' ', name).strip(' ')